@@ -0,0 +1,385 @@
+# 回测性能测试
+# 按给定的转债数量x年数生成确定的模拟cb_daily.db3(上市/强赎/到期退市, 正股走势带动转股价值/价格/溢价率),
+# 分别统计test_group, generate_test_data的耗时, 以及其中 加载数据/选债/持仓定价/收益计算/生成html 各阶段的耗时,
+# 结果写到json里, 可以和其他提交的结果对比. 不需要联网, 也不会动db目录下的数据
+#
+# python -m backtest.benchmark --out bench.json
+# python -m backtest.benchmark --scales 50x1,200x3 --repeat 3 --compare old_bench.json
+# python -m backtest.benchmark --parity --scales 60x2 检查内存数据面板和查库的回测结果是否一致
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+from prettytable import PrettyTable
+
+from backtest import data_panel, eligibility, jsl_test, test_series
+from utils import db_utils, trade_calendar
+
+# 默认的规模: (转债数量, 年数)
+default_scales = [(50, 1), (150, 2), (300, 4)]
+
+default_cases = ['test_group', 'test_group_single', 'generate_test_data']
+
+# 各阶段统计的函数: (阶段, 模块, 函数名)
+phase_targets = [
+    ('load', data_panel, 'load_data_panel'),
+    ('load', eligibility, 'load_eligibility'),
+    ('load', trade_calendar, 'load_trade_calendar'),
+    ('selection', jsl_test, 'get_start_rows'),
+    ('selection', jsl_test, 'get_push_rows'),
+    ('pricing', jsl_test, 'get_hold_rows'),
+    ('result', jsl_test, 'calc_test_result'),
+    ('result', test_series, 'build_series'),
+    ('result', test_series, 'calc_metrics'),
+    ('render', jsl_test, 'generate_test_group_html'),
+    ('render', jsl_test, 'generate_timeline_html'),
+    ('render', test_series, 'generate_series_html'),
+]
+
+# 一致性检查的轮动周期x转债数量
+parity_periods = [(5, 10), (10, 15), (1, 5)]
+# 一致性检查的自定义选债表达式(建仓和调仓都用它)
+parity_exprs = ['rank(premium_rt) where price < 200 top 30 then rank(double_low, curr_iss_amt)']
+
+start_day = datetime.datetime(2018, 1, 2)
+trade_days_per_year = 244
+
+
+def generate_fixture(path, bond_count, years, seed=1):
+    """生成模拟的cb_daily.db3, 同样的参数每次生成的数据都一样"""
+    if os.path.exists(path):
+        os.remove(path)
+
+    rng = np.random.default_rng(seed)
+    days = get_fixture_days(int(years * trade_days_per_year))
+    day_strs = [str(day) for day in days]
+    n = len(days)
+
+    history = []
+    enforces = []
+    for k in range(bond_count):
+        bond_id = str((110000 if k % 2 == 0 else 123000) + k)
+        bond_nm = '模拟' + str(k) + '转债'
+        # 三成在回测开始前就已经上市了, 其他的陆续上市
+        list_idx = 0 if rng.random() < 0.3 else int(rng.integers(0, max(n - 20, 1)))
+        # 6年到期
+        end_idx = min(list_idx + 6 * trade_days_per_year, n)
+        size = end_idx - list_idx
+
+        # 正股走势(几何布朗运动) => 转股价值
+        sigma = rng.uniform(0.25, 0.6) / np.sqrt(trade_days_per_year)
+        stock = np.exp(np.cumsum(rng.normal(0, sigma, size))) * rng.uniform(0.7, 1.1)
+        convert_value = 100 * stock
+        # 价格 ≈ 纯债价值和转股价值中大的那个 + 期权的时间价值, 两者接近时溢价最高
+        floor = rng.uniform(85, 105)
+        price = (convert_value ** 4 + floor ** 4) ** 0.25
+        price *= np.exp(rng.normal(0, 0.004, size) + rng.uniform(0, 0.08))
+
+        # 强赎: 连续30个交易日中至少有15个交易日转股价值不低于130, 公告后大约20个交易日退市
+        high = np.convolve(convert_value >= 130, np.ones(30), mode='full')[:size] >= 15
+        enforce_dt = None
+        delist_idx = end_idx if end_idx < n else None
+        if high.any():
+            i = int(high.argmax())
+            enforce_dt = day_strs[list_idx + i]
+            delist_idx = min(list_idx + i + int(rng.integers(15, 25)), end_idx)
+            size = delist_idx - list_idx
+        if enforce_dt is not None or delist_idx is not None:
+            enforces.append((bond_id, bond_nm, enforce_dt,
+                             None if delist_idx is None or delist_idx >= n else day_strs[delist_idx]))
+
+        # 转股价值高于100时慢慢转股, 剩余规模减少
+        amount = rng.uniform(1, 30)
+        convert_rate = np.clip((convert_value[:size] - 100) / 30 * 0.002, 0, 0.02)
+        amounts = amount * np.cumprod(1 - convert_rate)
+        years_left = 6 - np.arange(size) / trade_days_per_year
+        ytm_rt = (110 / price[:size]) ** (1 / np.maximum(years_left, 0.1)) - 1
+        volume = rng.uniform(0.005, 0.1, size) * amounts * price[:size]
+
+        for i in range(size):
+            history.append((bond_id, bond_nm, day_strs[list_idx + i], round(float(ytm_rt[i]), 5),
+                            round(float(price[i] / convert_value[i] - 1), 5), round(float(convert_value[i]), 3),
+                            round(float(price[i]), 3), round(float(volume[i]), 2), round(float(amounts[i]), 3),
+                            round(float(volume[i] / price[i] / amounts[i]), 5)))
+
+    con = sqlite3.connect(path)
+    with con:
+        cur = con.cursor()
+        cur.execute("""
+            create table cb_history(
+                id integer PRIMARY KEY autoincrement,
+                bond_id text, bond_nm text, last_chg_dt text, ytm_rt real, premium_rt real, convert_value real,
+                price real, volume real, stock_volume real, curr_iss_amt real, amt_change real, turnover_rt real
+            )""")
+        cur.execute("create table cb_enforce(bond_id text, bond_name text, enforce_dt text, delist_dt text)")
+        cur.execute("create table cb_backtest_data(name text PRIMARY KEY, data text)")
+        cur.executemany("""insert into cb_history(bond_id, bond_nm, last_chg_dt, ytm_rt, premium_rt, convert_value, price, volume, curr_iss_amt, turnover_rt)
+                        values(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", history)
+        cur.executemany("insert into cb_enforce(bond_id, bond_name, enforce_dt, delist_dt) values(?, ?, ?, ?)",
+                        enforces)
+    con.close()
+    return {'bonds': bond_count, 'years': years, 'days': n, 'rows': len(history), 'enforces': len(enforces)}
+
+
+def get_fixture_days(count):
+    # 只去掉周末, 不管节假日
+    days = []
+    day = start_day
+    while len(days) < count:
+        if day.weekday() < 5:
+            days.append(day)
+        day += datetime.timedelta(days=1)
+    return days
+
+
+@contextlib.contextmanager
+def use_daily_db(path):
+    """回测期间查的都是path这个库, 结束后恢复"""
+    get_db_daily_file = db_utils.get_db_daily_file
+    db_utils.get_db_daily_file = lambda: path
+    reset_caches()
+    try:
+        yield
+    finally:
+        db_utils.get_db_daily_file = get_db_daily_file
+        reset_caches()
+
+
+def reset_caches():
+    # 换了库文件, 连接也要重新建
+    db_utils.close_connections()
+    trade_calendar.reset_trade_calendar()
+    data_panel.panel_cache.clear()
+    eligibility.eligibility_cache.clear()
+    test_series.html_cache.clear()
+
+
+@contextlib.contextmanager
+def time_phases(phases):
+    """统计各阶段函数的累计耗时, phases: {阶段: 秒}"""
+    originals = []
+    for phase, module, name in phase_targets:
+        func = getattr(module, name)
+        originals.append((module, name, func))
+        setattr(module, name, wrap_phase(phases, phase, func))
+    try:
+        yield phases
+    finally:
+        for module, name, func in originals:
+            setattr(module, name, func)
+
+
+def wrap_phase(phases, phase, func):
+    def wrapper(*args, **kwargs):
+        begin = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            phases[phase] = phases.get(phase, 0) + time.perf_counter() - begin
+    return wrapper
+
+
+def run_case(case, start):
+    if case == 'test_group':
+        jsl_test.test_group(start)
+    elif case == 'test_group_single':
+        # 单个策略还要生成持仓时间线
+        jsl_test.test_group(start, strategy_types=['双低策略'])
+    elif case == 'test_group_sql':
+        jsl_test.test_group(start, use_panel=False)
+    elif case == 'generate_test_data':
+        jsl_test.generate_test_data('benchmark_test', start, None)
+        test_series.get_back_test_html('benchmark_test')
+    else:
+        raise Exception('unknown benchmark case: ' + case)
+
+
+def time_case(case, start, repeat):
+    """每次都从冷缓存开始跑, 取总耗时最少的那次"""
+    best = None
+    for i in range(repeat):
+        reset_caches()
+        phases = {}
+        with time_phases(phases), open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            begin = time.perf_counter()
+            run_case(case, start)
+            seconds = time.perf_counter() - begin
+        if best is None or seconds < best['seconds']:
+            phases['other'] = seconds - sum(phases.values())
+            best = {'seconds': round(seconds, 4), 'phases': {k: round(v, 4) for k, v in sorted(phases.items())}}
+    return best
+
+
+def run_benchmark(scales=None, cases=None, repeat=1, fixture_dir=None, seed=1):
+    if scales is None:
+        scales = default_scales
+    if cases is None:
+        cases = default_cases
+
+    # 进程池里的耗时统计不到, 统一在当前进程跑
+    max_workers = jsl_test.max_workers
+    jsl_test.max_workers = 1
+    if fixture_dir is not None:
+        os.makedirs(fixture_dir, exist_ok=True)
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for bond_count, years in scales:
+                path = os.path.join(fixture_dir or tmp_dir, 'cb_daily_' + str(bond_count) + 'x' + str(years) + '.db3')
+                begin = time.perf_counter()
+                fixture = generate_fixture(path, bond_count, years, seed)
+                fixture['seconds'] = round(time.perf_counter() - begin, 4)
+                print('generate fixture: ' + str(fixture))
+
+                scale = {'scale': str(bond_count) + 'x' + str(years), 'fixture': fixture, 'cases': {}}
+                with use_daily_db(path):
+                    for case in cases:
+                        scale['cases'][case] = time_case(case, start_day, repeat)
+                        print(scale['scale'] + ' ' + case + ': ' + str(scale['cases'][case]))
+                results.append(scale)
+    finally:
+        jsl_test.max_workers = max_workers
+
+    return {'env': get_env(), 'seed': seed, 'repeat': repeat, 'results': results}
+
+
+def build_parity_configs(strategy_types=None, periods=None, exprs=None):
+    """[(用内存数据面板的回测参数, 同样参数查库的)]"""
+    pairs = []
+    for strategy_type in strategy_types or jsl_test.default_strategy_types:
+        for roll_period, bond_count in periods or parity_periods:
+            pairs.append(tuple(jsl_test.build_test_configs([strategy_type], False, roll_period, bond_count,
+                                                           use_panel=use_panel)[0][0] for use_panel in (True, False)))
+    for expr in parity_exprs if exprs is None else exprs:
+        for roll_period, bond_count in periods or parity_periods:
+            pairs.append(tuple(jsl_test.build_test_configs(['双低策略'], False, roll_period, bond_count, select_expr=expr,
+                                                           exchange_expr=expr, use_panel=use_panel)[0][0]
+                               for use_panel in (True, False)))
+    return pairs
+
+
+def check_parity(start, pairs):
+    """
+    内存数据面板和查库各回测一遍, 每天的结果应该完全一样
+    返回不一致的[(回测参数, 第一个不一致的交易日, 面板的结果, 查库的结果)]
+    """
+    configs = [config for pair in pairs for config in pair]
+    jsl_test.global_test_context.need_time_data = False
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        results = jsl_test.run_test_configs(configs, start)
+
+    diffs = []
+    for k, (config, sql_config) in enumerate(pairs):
+        panel_rows = results[2 * k]
+        sql_rows = results[2 * k + 1]
+        for day in sorted(panel_rows.keys() | sql_rows.keys()):
+            if panel_rows.get(day) != sql_rows.get(day):
+                diffs.append((config, day, panel_rows.get(day), sql_rows.get(day)))
+                break
+    return diffs
+
+
+def run_parity(scales=None, fixture_dir=None, seed=1, start=start_day):
+    if scales is None:
+        scales = default_scales
+    pairs = build_parity_configs()
+    diffs = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for bond_count, years in scales:
+            path = os.path.join(fixture_dir or tmp_dir, 'cb_daily_' + str(bond_count) + 'x' + str(years) + '.db3')
+            generate_fixture(path, bond_count, years, seed)
+            with use_daily_db(path):
+                for config, day, panel_row, sql_row in check_parity(start, pairs):
+                    diffs.append([str(bond_count) + 'x' + str(years), config.select_expr or config.strategy_type,
+                                  config.roll_period, config.bond_count, str(day), panel_row, sql_row])
+            print(str(bond_count) + 'x' + str(years) + ': check ' + str(len(pairs)) + ' configs, diffs: '
+                  + str(len([diff for diff in diffs if diff[0] == str(bond_count) + 'x' + str(years)])))
+    return diffs
+
+
+def get_env():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit or None,
+        'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def compare(old, new):
+    """两次结果的耗时对比, ratio<1表示变快了"""
+    table = PrettyTable()
+    table.field_names = ['scale', 'case', 'phase', 'old', 'new', 'ratio']
+    old_scales = {scale['scale']: scale for scale in old['results']}
+    for scale in new['results']:
+        old_scale = old_scales.get(scale['scale'])
+        if old_scale is None:
+            continue
+        for case, data in scale['cases'].items():
+            old_data = old_scale['cases'].get(case)
+            if old_data is None:
+                continue
+            items = [('total', old_data['seconds'], data['seconds'])]
+            items += [(phase, old_data['phases'].get(phase), seconds) for phase, seconds in data['phases'].items()]
+            for phase, old_seconds, seconds in items:
+                ratio = round(seconds / old_seconds, 2) if old_seconds else None
+                table.add_row([scale['scale'], case, phase, old_seconds, seconds, ratio])
+    return table
+
+
+def parse_scales(text):
+    scales = []
+    for item in text.split(','):
+        bond_count, years = item.lower().split('x')
+        scales.append((int(bond_count), float(years) if '.' in years else int(years)))
+    return scales
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='回测性能测试')
+    parser.add_argument('--scales', help='转债数量x年数, 逗号分隔, 比如: 50x1,150x2,300x4')
+    parser.add_argument('--cases', help='逗号分隔: ' + ','.join(default_cases + ['test_group_sql']))
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--fixture-dir', help='保留生成的模拟数据库')
+    parser.add_argument('--out', default='benchmark.json')
+    parser.add_argument('--compare', help='和之前的结果对比')
+    parser.add_argument('--parity', action='store_true', help='只检查内存数据面板和查库的回测结果是否一致')
+    parser.add_argument('--start', help='一致性检查的回测开始日期(yyyy-mm-dd)')
+    args = parser.parse_args()
+
+    if args.parity:
+        start = start_day if args.start is None else datetime.datetime.strptime(args.start, '%Y-%m-%d')
+        diffs = run_parity(None if args.scales is None else parse_scales(args.scales), args.fixture_dir, args.seed,
+                           start)
+        for diff in diffs:
+            print('parity diff: ' + str(diff))
+        if len(diffs) > 0:
+            raise Exception('panel and sql backtest results are different.')
+        raise SystemExit(0)
+
+    result = run_benchmark(None if args.scales is None else parse_scales(args.scales),
+                           None if args.cases is None else args.cases.split(','),
+                           args.repeat, args.fixture_dir, args.seed)
+    with open(args.out, 'w') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print('save benchmark result: ' + args.out)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            print(compare(json.load(f), result))
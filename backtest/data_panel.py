@@ -0,0 +1,262 @@
+# 回测用的内存数据面板
+# 一次性把cb_history读到内存, 组织成 交易日 x 转债 的二维数组,
+# 回测时按日期下标直接取截面数据, 不再每个交易日都去查库
+import operator
+
+import numpy as np
+
+from backtest.eligibility import get_eligibility, get_eligibility_version
+from utils import db_utils
+from utils.trade_calendar import parse_day, TradeCalendar
+
+# 缓存已加载的面板, 数据没变化时直接复用
+panel_cache = {}
+
+operators = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '=': operator.eq,
+}
+
+
+def sql_round(values, digits=2):
+    """
+    和sqlite的round(x, digits)结果一致: 四舍五入时远离0(np.round是四舍六入五成双),
+    并且和sqlite一样先放大一点点消掉二进制误差(143.865 => 143.87, np.round得到143.86)
+    """
+    scale = 10 ** digits
+    return np.sign(values) * np.floor(np.abs(values) * scale * (1 + 3e-16) + 0.5) / scale
+
+
+class DataPanel:
+
+    def __init__(self, days, bond_ids, bond_nms, price, premium_rt, ytm_rt, curr_iss_amt, enforce_idx, delist_idx,
+                 missing_price=None):
+        # 交易日历(升序), 也就是面板的行
+        self.calendar = TradeCalendar(days)
+        self.days = days
+        # 转债
+        self.bond_ids = bond_ids
+        self.bond_nms = bond_nms
+        self.bond_index = {bond_id: i for i, bond_id in enumerate(bond_ids)}
+        # 交易日 x 转债, 没有数据的为nan
+        self.price = price
+        self.premium_rt = premium_rt
+        self.ytm_rt = ytm_rt
+        self.curr_iss_amt = curr_iss_amt
+        # 有记录但是价格为NULL的(异常数据)
+        self.missing_price = np.zeros(price.shape, dtype=bool) if missing_price is None else missing_price
+        # 排序/过滤用不取整的值(和sql的order by一致), 返回给回测的值再按sqlite的规则取整
+        self.double_low = price + premium_rt * 100
+        # 每个转债开始强赎(或退市)/退市的交易日下标, 没有的为len(days)
+        self.enforce_idx = enforce_idx
+        self.delist_idx = delist_idx
+        day_idx = np.arange(len(days))[:, None]
+        # 强赎或退市(不能再买入)
+        self.is_enforce = day_idx >= enforce_idx[None, :]
+        # 已退市(需要卖出)
+        self.is_delist = day_idx >= delist_idx[None, :]
+        # 各选债规则第一级筛选的排名缓存 {(过滤条件, 排序字段): 交易日 x 名次}
+        self.rank_cache = {}
+        # 往前数N个交易日的价格/涨幅缓存 {N: (交易日 x 转债, 交易日 x 转债)}
+        self.lag_cache = {}
+        # 自定义表达式的计算结果缓存 {表达式: 交易日 x 转债}
+        self.value_cache = {}
+
+    def get_day_idx(self, day):
+        return self.calendar.index_of(day)
+
+    def get_next_day(self, current):
+        return self.calendar.next_day(current)
+
+    def get_hold_rows(self, current, bond_ids, pre_day):
+        """和jsl_test.get_hold_rows的字段一致: bond_id, bond_nm, price, premium_rt, is_delist, pre_price, rise_rate"""
+        rows = []
+        i = self.get_day_idx(current)
+        if i is None:
+            return rows
+
+        pre_prices, rise_rates = self.get_lag_data(pre_day)
+        for bond_id in bond_ids:
+            j = self.bond_index.get(bond_id)
+            if j is None or (np.isnan(self.price[i, j]) and not self.missing_price[i, j]):
+                continue
+
+            row = (bond_id, self.bond_nms[j], self.get_value(self.price, i, j), self.get_value(self.premium_rt, i, j),
+                   1 if self.is_delist[i, j] else None, self.get_value(pre_prices, i, j),
+                   self.get_value(rise_rates, i, j))
+            # 异常数据, 和查库一样返回None
+            if row[2] is None or row[2] == 0:
+                print('error row:' + str(row))
+                return None
+            rows.append(row)
+        return rows
+
+    def get_lag_data(self, lag):
+        """
+        往前数lag个交易日(不够的话取最早的那天, 第一天没有)的价格, 以及到当天的涨幅(%)
+        不同的pre_day各算一次, 之后的回测直接复用
+        """
+        data = self.lag_cache.get(lag)
+        if data is not None:
+            return data
+
+        n = len(self.days)
+        pre_prices = np.full(self.price.shape, np.nan)
+        if lag <= 0:
+            pre_prices = self.price.copy()
+        elif n > 1:
+            pre_idx = np.maximum(np.arange(1, n) - lag, 0)
+            pre_prices[1:] = self.price[pre_idx]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rise_rates = sql_round((self.price - pre_prices) / pre_prices * 100)
+        # 之前的价格为0时, sqlite除以0得到NULL
+        rise_rates[~np.isfinite(rise_rates)] = np.nan
+
+        data = (pre_prices, rise_rates)
+        self.lag_cache[lag] = data
+        return data
+
+    def build_rows(self, i, candidates):
+        """和各策略选债sql的字段一致: bond_id, bond_nm, price, premium_rt, double_low"""
+        double_lows = sql_round(self.double_low[i, candidates])
+        return [(self.bond_ids[j], self.bond_nms[j], float(self.price[i, j]), self.get_value(self.premium_rt, i, j),
+                 None if np.isnan(double_low) else float(double_low)) for j, double_low in zip(candidates, double_lows)]
+
+    def top(self, i, candidates, fields, limit):
+        return self.top_by(i, candidates, [self.get_sort_key(field) for field in fields], limit)
+
+    def top_by(self, i, candidates, sort_keys, limit):
+        """sort_keys: 排序用的 交易日 x 转债 数组, 第一个为主排序"""
+        if len(candidates) > limit > 0:
+            # 候选较多时先用主排序字段粗选, 和第limit名并列的都保留, 再对剩下的精确排序
+            first = sort_keys[0][i, candidates]
+            threshold = np.partition(first, limit - 1)[limit - 1]
+            candidates = candidates[(first <= threshold) | np.isnan(threshold)]
+        # np.lexsort以最后一个key为主排序, 转债下标放在最前面, 保证排序稳定
+        keys = [candidates]
+        for sort_key in reversed(sort_keys):
+            keys.append(sort_key[i, candidates])
+        return candidates[np.lexsort(keys)][0:limit]
+
+    def get_sort_key(self, field):
+        # 字段前加'-'表示倒序
+        if field.startswith('-'):
+            return -getattr(self, field[1:])
+        # 和sql一样, 升序时空值排在最前面(倒序时排在最后, nan本来就排在最后)
+        return self.get_values(('asc', field),
+                               lambda: np.where(np.isnan(getattr(self, field)), -np.inf, getattr(self, field)))
+
+    def get_stage_ranks(self, filters, fields, depth):
+        """
+        所有交易日按fields排序后的前depth个转债下标(交易日 x depth), 不足的用-1补齐
+        同一个策略不同的转债数量(5/10/15/20只)只是取的长短不一样, 所以按最大的数量算一次, 之后都从缓存里截取
+        filters: 过滤条件[(字段, 比较符, 值)]
+        """
+        def build():
+            mask = np.ones(self.price.shape, dtype=bool)
+            for field, op, value in filters:
+                mask &= operators[op](getattr(self, field), value)
+            return mask, [self.get_sort_key(field) for field in fields]
+
+        return self.get_ranks((tuple(filters), tuple(fields)), build, depth)
+
+    def get_ranks(self, key, build, depth):
+        """
+        和get_stage_ranks一样, 按key缓存
+        build: 返回(过滤条件, [排序用的 交易日 x 转债 数组]), 过滤条件为 交易日 x 转债 的bool数组
+        """
+        ranks = self.rank_cache.get(key)
+        depth = min(depth, len(self.bond_ids))
+        if ranks is not None and ranks.shape[1] >= depth:
+            return ranks
+
+        mask, sort_keys = build()
+        mask = mask & ~np.isnan(self.price) & ~self.is_enforce
+
+        # 和top()的排序规则一致, 不满足条件的排到最后
+        keys = [np.broadcast_to(np.arange(len(self.bond_ids)), mask.shape)]
+        for sort_key in reversed(sort_keys):
+            keys.append(np.broadcast_to(sort_key, mask.shape))
+        keys.append(~mask)
+        ranks = np.lexsort(keys, axis=-1)[:, 0:depth].astype(np.int32)
+        ranks[np.arange(depth)[None, :] >= mask.sum(axis=1)[:, None]] = -1
+
+        self.rank_cache[key] = ranks
+        return ranks
+
+    def get_values(self, key, build):
+        """按key缓存的 交易日 x 转债 数组, 比如自定义表达式的计算结果"""
+        values = self.value_cache.get(key)
+        if values is None:
+            values = np.broadcast_to(build(), self.price.shape)
+            self.value_cache[key] = values
+        return values
+
+    @staticmethod
+    def get_value(values, i, j):
+        value = values[i, j]
+        return None if np.isnan(value) else float(value)
+
+
+def load_data_panel(cur, eligibility):
+    cur.execute("""
+        select bond_id, bond_nm, last_chg_dt, price, premium_rt, ytm_rt, curr_iss_amt
+        from cb_history
+        where price is not NULL
+        order by last_chg_dt, bond_id
+    """)
+    rows = cur.fetchall()
+
+    days = sorted({parse_day(row[2]) for row in rows})
+    day_index = {day: i for i, day in enumerate(days)}
+    bond_ids = sorted({row[0] for row in rows})
+    bond_index = {bond_id: i for i, bond_id in enumerate(bond_ids)}
+
+    shape = (len(days), len(bond_ids))
+    price = np.full(shape, np.nan)
+    premium_rt = np.full(shape, np.nan)
+    ytm_rt = np.full(shape, np.nan)
+    curr_iss_amt = np.full(shape, np.nan)
+    # 名称取最新的那条记录
+    bond_nms = [None] * len(bond_ids)
+
+    # 同一天同一转债有多条记录时, 和sql一样以后面的为准
+    i = np.fromiter((day_index[parse_day(row[2])] for row in rows), dtype=np.int64, count=len(rows))
+    j = np.fromiter((bond_index[row[0]] for row in rows), dtype=np.int64, count=len(rows))
+    price[i, j] = [row[3] for row in rows]
+    premium_rt[i, j] = [np.nan if row[4] is None else row[4] for row in rows]
+    ytm_rt[i, j] = [np.nan if row[5] is None else row[5] for row in rows]
+    curr_iss_amt[i, j] = [np.nan if row[6] is None else row[6] for row in rows]
+    for row in rows:
+        bond_nms[bond_index[row[0]]] = row[1]
+
+    enforce_idx, delist_idx = eligibility.get_indexes(days, bond_ids)
+
+    # 价格为NULL的记录不参与选债, 但是持有的转债遇到了要和查库一样当成异常数据
+    missing_price = np.zeros(shape, dtype=bool)
+    cur.execute("select bond_id, last_chg_dt from cb_history where price is NULL")
+    for bond_id, day in cur.fetchall():
+        i = day_index.get(parse_day(day))
+        j = bond_index.get(bond_id)
+        if i is not None and j is not None:
+            missing_price[i, j] = True
+
+    return DataPanel(days, bond_ids, bond_nms, price, premium_rt, ytm_rt, curr_iss_amt, enforce_idx, delist_idx,
+                     missing_price)
+
+
+def get_data_panel():
+    with db_utils.get_daily_connect() as con:
+        cur = con.cursor()
+        # 数据有更新(每天爬完数据后, 或者强赎/退市数据有变化)才重新加载
+        cur.execute("select max(last_chg_dt), count(*) from cb_history")
+        version = (cur.fetchone(), get_eligibility_version(cur))
+        panel = panel_cache.get(version)
+        if panel is None:
+            panel = load_data_panel(cur, get_eligibility(cur))
+            panel_cache.clear()
+            panel_cache[version] = panel
+        return panel
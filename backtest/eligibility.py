@@ -0,0 +1,99 @@
+# 转债的可交易状态
+# 从cb_enforce一次性算出每个转债 第一天不能再买入(强赎或退市)的日期 和 退市日期,
+# 选债和强赎/退市卖出都直接查这两个向量, 不用每个交易日都去子查询cb_enforce
+import bisect
+
+import numpy as np
+
+from utils import db_utils
+from utils.trade_calendar import parse_day
+
+# 已加载的可交易状态 {'version': ..., 'eligibility': ...}
+eligibility_cache = {}
+
+
+class Eligibility:
+
+    def __init__(self, enforce_days, delist_days):
+        # {bond_id: 日期}, 从这天开始不能再买入
+        self.enforce_days = enforce_days
+        # {bond_id: 日期}, 从这天开始已退市(需要卖出)
+        self.delist_days = delist_days
+        # sql函数的参数是字符串, 缓存一下解析结果
+        self.parsed_days = {}
+
+    def is_eligible(self, bond_id, day):
+        enforce_day = self.enforce_days.get(bond_id)
+        return enforce_day is None or parse_day(day) < enforce_day
+
+    def is_delist(self, bond_id, day):
+        delist_day = self.delist_days.get(bond_id)
+        return delist_day is not None and parse_day(day) >= delist_day
+
+    def get_indexes(self, days, bond_ids):
+        """面板用的 每个转债开始不能买入/退市的交易日下标, 没有的为len(days)"""
+        enforce_idx = np.full(len(bond_ids), len(days), dtype=np.int64)
+        delist_idx = np.full(len(bond_ids), len(days), dtype=np.int64)
+        for k, bond_id in enumerate(bond_ids):
+            enforce_day = self.enforce_days.get(bond_id)
+            if enforce_day is not None:
+                enforce_idx[k] = bisect.bisect_left(days, enforce_day)
+            delist_day = self.delist_days.get(bond_id)
+            if delist_day is not None:
+                delist_idx[k] = bisect.bisect_left(days, delist_day)
+        return enforce_idx, delist_idx
+
+    def install(self, con):
+        # 注册成sql函数, 选债sql里用is_eligible(bond_id, :current)代替cb_enforce的子查询
+        con.create_function('is_eligible', 2, self.sql_is_eligible, deterministic=True)
+
+    def sql_is_eligible(self, bond_id, day):
+        enforce_day = self.enforce_days.get(bond_id)
+        if enforce_day is None:
+            return 1
+        parsed = self.parsed_days.get(day)
+        if parsed is None:
+            parsed = parse_day(day)
+            self.parsed_days[day] = parsed
+        return 1 if parsed < enforce_day else 0
+
+
+def get_eligibility_version(cur):
+    # cb_enforce的校验和: 任何一条的日期改了(不只是最新的那条)都会变,
+    # 再按bond_id加权, 日期挪到别的转债上也能发现. 写cb_enforce的地方很多(还有手工改的), 不靠写入方维护版本号
+    cur.execute("""
+        select count(*),
+               total(julianday(enforce_dt)), total(julianday(delist_dt)),
+               total(julianday(enforce_dt) * bond_id), total(julianday(delist_dt) * bond_id)
+        from cb_enforce
+    """)
+    return cur.fetchone()
+
+
+def load_eligibility(cur):
+    enforce_days = {}
+    delist_days = {}
+    cur.execute("select bond_id, enforce_dt, delist_dt from cb_enforce")
+    for bond_id, enforce_dt, delist_dt in cur.fetchall():
+        # 强赎或退市, 取早的那天(同一转债有多条记录的也一样)
+        for dt in (enforce_dt, delist_dt):
+            if dt is not None:
+                day = parse_day(dt)
+                enforce_days[bond_id] = min(enforce_days.get(bond_id, day), day)
+        if delist_dt is not None:
+            day = parse_day(delist_dt)
+            delist_days[bond_id] = min(delist_days.get(bond_id, day), day)
+    return Eligibility(enforce_days, delist_days)
+
+
+def get_eligibility(cur=None):
+    if cur is None:
+        with db_utils.get_daily_connect() as con:
+            return get_eligibility(con.cursor())
+
+    # cb_enforce有变化才重新加载
+    version = get_eligibility_version(cur)
+    if eligibility_cache.get('version') != version:
+        eligibility_cache['eligibility'] = load_eligibility(cur)
+        eligibility_cache['version'] = version
+    return eligibility_cache['eligibility']
@@ -16,19 +16,45 @@
 #   强赎
 # 异常情况:
 #   价格为0, 直接忽略那一天的数据
+import collections
+import concurrent.futures
+import contextlib
+import copy
 import datetime
+import heapq
+import multiprocessing
+import os
 import threading
 
+from backtest.data_panel import get_data_panel
+from backtest.eligibility import get_eligibility
+from backtest.strategy_expr import get_expr_selector
+from backtest.strategy_spec import strategy_specs, strategy_selectors
+from backtest.test_checkpoint import get_checkpoint_key, get_checkpoint_name, load_checkpoints, save_checkpoints
+from backtest.test_series import new_chart, save_back_test_series
+from backtest.test_timeline import HoldingsRecorder
 from backtest.test_utils import get_next_day, calc_test_result, init_test_result, do_push_bond, \
     get_total_money, update_bond, get_pre_total_money
-from backtest.view_test import generate_line_html, generate_timeline_html
+from backtest.view_test import generate_test_group_html, generate_timeline_html
 from utils import db_utils
 from utils.bond_utils import is_too_expensive, parse_bond_ids_params
+from utils.trade_calendar import get_trade_calendar
 
 global_test_context = threading.local()
 
 
-def test(start):
+def test(start, state=None):
+    """从start开始回测, 有断点(state)时从断点接着往后跑, 返回最后的回测状态"""
+    if state is None:
+        state = start_test(start)
+        if state is None:
+            return None
+
+    run_test_days(state)
+    return state
+
+
+def start_test(start):
     # {"yyyy-mm-dd":{"xxx":100},{"yyy":200}}
     start_total_money = 1000000
     group, start, remain_money = start_roll(start, start_total_money)
@@ -37,62 +63,86 @@ def test(start):
 
     add_time_data(start, group)
 
-    test_result = init_test_result(start, start_total_money, remain_money)
+    return {
+        'group': group,
+        'test_result': init_test_result(start, start_total_money, remain_money),
+        # 最后一次记录收益的交易日
+        'previous_day': start,
+        # 最后处理过的交易日
+        'trade_day': start,
+        # 轮动周期计数器
+        'roll_counter': 0,
+        # 下一个交易日是否需要重新开启一轮
+        'need_new_roll': False,
+        'total_money': start_total_money,
+    }
+
+
+def run_test_days(state):
+    end = datetime.datetime.now()
+    trade_day = next_trade_day(state['trade_day'])
+    while trade_day is not None and str(trade_day) <= str(end):
+        run_test_day(state, trade_day)
+        trade_day = next_trade_day(state['trade_day'])
 
-    previous_day = start
-    next_day = get_next_day(start)
-    if next_day is None:
-        raise Exception('not found next day with ' + str(start))
 
-    end = datetime.datetime.now()
+def run_test_day(state, trade_day):
+    """按当前的回测参数处理一个交易日, 换新一轮时可能会往后跳过几天, 最后处理过的交易日记在state['trade_day']"""
     # 轮动周期
     roll_period = global_test_context.roll_period
-    # 轮动周期计数器
-    roll_counter = 0
-    # 交易次数
-    trade_times = 0
-    trade_day = next_day
-    while str(trade_day) <= str(end):
-        while True:
+    test_result = state['test_result']
 
-            break_roll, previous_day, total_money = do_trade(trade_day, group, previous_day, test_result)
+    if state['need_new_roll']:
+        group, trade_day = new_roll(trade_day, state['previous_day'], state['group'], test_result,
+                                    state['total_money'])
 
-            add_time_data(trade_day, group)
+        add_time_data(trade_day, group)
 
-            # previous_day = trade_day
-            trade_day = get_next_day(trade_day)
-            roll_counter += 1
-            trade_times += 1
+        state['group'] = group
+        state['previous_day'] = trade_day
+        state['roll_counter'] = 0
+        # 一直没找到满足条件的转债, 有新数据时再接着找
+        state['need_new_roll'] = group is None
+    else:
+        break_roll, previous_day, total_money = do_trade(trade_day, state['group'], state['previous_day'],
+                                                         test_result)
 
-            # 当轮动到期或者高估时, 提前终止轮动, 重新开启一轮
-            if roll_counter >= roll_period or break_roll or trade_day is None:
-                break
+        add_time_data(trade_day, state['group'])
 
-        if trade_day is None:
-            break
+        state['previous_day'] = previous_day
+        state['total_money'] = total_money
+        state['roll_counter'] += 1
+        # 当轮动到期或者高估时, 提前终止轮动, 重新开启一轮
+        state['need_new_roll'] = state['roll_counter'] >= roll_period or break_roll
 
-        group, trade_day = new_roll(trade_day, previous_day, group, test_result, total_money)
+    state['trade_day'] = trade_day
 
-        add_time_data(trade_day, group)
 
-        previous_day = trade_day
-        trade_day = get_next_day(trade_day)
-        roll_counter = 0
-        if trade_day is None:
-            break
+def next_trade_day(current, cur=None):
+    panel = global_test_context.panel
+    if panel is not None:
+        return panel.get_next_day(current)
+    return get_next_day(current, cur)
 
-    return test_result['rows']
+
+def open_daily_cursor():
+    # 内存模式下不需要连接数据库
+    if global_test_context.panel is not None:
+        return contextlib.nullcontext()
+    con = db_utils.get_daily_connect()
+    # 连接是复用的, 同一个连接只注册一次(重复注册会让缓存的预编译sql失效)
+    installed = getattr(global_test_context, 'installed', None)
+    if installed is None or installed[0] is not con or installed[1] is not global_test_context.eligibility:
+        global_test_context.eligibility.install(con)
+        global_test_context.installed = (con, global_test_context.eligibility)
+    return con
 
 
 def add_time_data(day, group):
     if global_test_context.need_time_data is False or group is None:
         return
 
-    data = {}
-    for bond_id, bond in group.items():
-        data.setdefault(bond['bond_nm'], int(bond['price'] * bond['amount']))
-        # data.setdefault(bond['bond_nm'], int(bond['price']))
-    global_test_context.time_data.setdefault(day, data)
+    global_test_context.timeline.record(day, group)
 
 
 def do_trade(current_day, group, previous_day, test_result):
@@ -100,8 +150,9 @@ def do_trade(current_day, group, previous_day, test_result):
     params = {"current": current_day, "pre_day": global_test_context.pre_day}
     keys = sorted(group.keys())
     ids = parse_bond_ids_params(keys, params)
-    with db_utils.get_daily_connect() as con:
-        cur = con.cursor()
+    params.setdefault("bond_ids", keys)
+    with open_daily_cursor() as con:
+        cur = None if con is None else con.cursor()
         rows = get_hold_rows(cur, ids, params)
         # 异常数据, 跳过
         if rows is None:
@@ -122,7 +173,7 @@ def do_trade(current_day, group, previous_day, test_result):
             return True, current_day, total_money
 
         # 根据条件对转债进行轮换(不影响当天收益)
-        break_roll = exchange_bond(cur, current_day, group, ids, params, rows, test_result)
+        break_roll = exchange_bond(cur, current_day, group, params, rows, test_result)
         return break_roll, current_day, total_money
 
 
@@ -135,32 +186,30 @@ def get_hold_rows(cur, ids, params):
     #                  group by cb_history.bond_id
     #                  order by last_chg_dt)
     # fixme 未考虑价格为null的情况
+    panel = global_test_context.panel
+    if panel is not None:
+        return panel.get_hold_rows(params['current'], params['bond_ids'], params['pre_day'])
+
+    # 往前数pre_day个交易日(不够的话取最早的那天)
+    params.setdefault("pre_dt", get_trade_calendar(cur).offset(params['current'], -params['pre_day'], clamp=True))
     cur.execute("""
         select a.bond_id,
                a.bond_nm,
                a.price,
                a.premium_rt,
-               c.is_delist,
                b.price                                       as pre_price,
                round((a.price - b.price) / b.price * 100, 2) as rise_rate
         from cb_history a
                  left join (select *
                             from cb_history
-                            where last_chg_dt = (SELECT last_chg_dt
-                                                 FROM (SELECT DISTINCT (last_chg_dt)
-                                                       FROM cb_history
-                                                       WHERE last_chg_dt < :current
-                                                       ORDER BY last_chg_dt DESC
-                                                       LIMIT :pre_day)
-                                                 ORDER BY last_chg_dt
-                                                 LIMIT 1)) b on a.bond_id = b.bond_id
-                 left join (select bond_id, 1 as is_delist
-                            from cb_enforce
-                            where delist_dt <= :current) c on a.bond_id = c.bond_id
+                            where last_chg_dt = :pre_dt) b on a.bond_id = b.bond_id
         where a.bond_id in (""" + ids + """)
           and a.last_chg_dt = :current         
             """, params)
-    rows = cur.fetchall()
+    # 是否退市直接查预先算好的退市日期
+    eligibility = global_test_context.eligibility
+    rows = [row[0:4] + (1 if eligibility.is_delist(row[0], params['current']) else None,) + row[4:]
+            for row in cur.fetchall()]
     # 异常数据, 返回None
     for row in rows:
         if row[2] is None or row[2] == 0:
@@ -170,7 +219,7 @@ def get_hold_rows(cur, ids, params):
     return rows
 
 
-def exchange_bond(cur, current_day, group, ids, params, rows, test_result):
+def exchange_bond(cur, current_day, group, params, rows, test_result):
     # 止盈满足卖出条件的转债
     pop_num, pop_total_money = pop_bond(group, rows, current_day)
 
@@ -181,13 +230,13 @@ def exchange_bond(cur, current_day, group, ids, params, rows, test_result):
     # 持有的所有现金
     total_money = pop_total_money + test_result.get('remain_money')
     # 新加入了转债, 分配资金
-    return push_bond(group, cur, pop_num, ids, params, total_money, test_result)
+    return push_bond(group, cur, pop_num, params, total_money, test_result)
 
 
-def push_bond(group, cur, buy_num, exclude_ids, params, total_money, test_result):
+def push_bond(group, cur, buy_num, params, total_money, test_result):
     # 卖出几只, 就买入几只
     params.setdefault("count", buy_num)
-    rows = global_test_context.get_push_rows(cur, exclude_ids, params)
+    rows = get_push_rows(cur, params)
 
     # 没有找到满足条件的转债, 一个也不买, 下一个交易日重新开仓
     if len(rows) == 0:
@@ -195,6 +244,7 @@ def push_bond(group, cur, buy_num, exclude_ids, params, total_money, test_result
         return True
 
     remain_money = do_push_bond(group, rows, total_money)
+    add_buy_money(test_result, round(total_money - remain_money, 2))
 
     # 对新的组合再次检查, 看是否满足条件
     expensive = global_test_context.need_check_double_low and is_too_expensive(None, group, global_test_context.max_double_low)
@@ -234,7 +284,7 @@ def pop_bond(group, rows, current_day):
             group.pop(bond_id)
             sell_num += 1
         # 强赎/退市的轮出
-        elif row[4] is not None and row[4] == 1:
+        elif global_test_context.eligibility.is_delist(bond_id, current_day):
             print("pop bond:" + bond_nm + " when delist or enforce at " + str(current_day))
             sell_total_money += price * bond.get("amount")
             group.pop(bond_id)
@@ -257,23 +307,39 @@ def new_roll(new_day, previous_day, group, test_result, total_money):
     calc_test_result(test_result, total_money, new_day, previous_day)
     if remain_money is not None:
         test_result['remain_money'] = remain_money
+        add_buy_money(test_result, get_roll_buy_money(old_group, group))
 
     # if sorted(group.keys()) != sorted(old_group.keys()):
     #     print("begin new roll. group:\n" + str(sorted(group.items())) + "\n" + str(sorted(old_group.items())))
     return group, new_day
 
 
+def get_roll_buy_money(old_group, group):
+    # 重新开启一轮时, 原来就持有的只算加仓的部分
+    buy_money = 0
+    for bond_id, bond in group.items():
+        old_bond = None if old_group is None else old_group.get(bond_id)
+        old_amount = 0 if old_bond is None else old_bond['amount']
+        if bond['amount'] > old_amount:
+            buy_money += (bond['amount'] - old_amount) * bond['price']
+    return round(buy_money, 2)
+
+
+def add_buy_money(test_result, buy_money):
+    test_result['buy_money'] = round(test_result.get('buy_money', 0) + buy_money, 2)
+
+
 def start_roll(current_day, total_money):
     # 买入的组合转债信息 {code:{amount:xxx}}
     group = {}
-    with db_utils.get_daily_connect() as con:
-        cur = con.cursor()
-        rows = global_test_context.get_start_rows(cur, current_day)
+    with open_daily_cursor() as con:
+        cur = None if con is None else con.cursor()
+        rows = get_start_rows(cur, current_day)
 
         # 没找到可转债, 或者太贵了, 不满足轮动条件, 不买, 进入下一个交易日
         if len(rows) == 0 or (global_test_context.need_check_double_low and is_too_expensive(rows, max_double_low=global_test_context.max_double_low)):
             # 取下一个交易日
-            next_day = get_next_day(current_day, cur)
+            next_day = next_trade_day(current_day, cur)
             if next_day is not None:
                 return start_roll(next_day, total_money)
             else:
@@ -286,453 +352,334 @@ def start_roll(current_day, total_money):
     return group, current_day, remain_money
 
 
+def get_start_rows(cur, current_day):
+    selector = global_test_context.start_selector
+    panel = global_test_context.panel
+    if panel is not None:
+        return selector.select_rows(panel, current_day, global_test_context.bond_count)
+    return selector.query_rows(cur, current_day, global_test_context.bond_count)
+
+
+def get_push_rows(cur, params):
+    selector = global_test_context.push_selector
+    panel = global_test_context.panel
+    if panel is not None:
+        return selector.select_rows(panel, params['current'], params['count'], params['bond_ids'])
+    return selector.query_rows(cur, params['current'], params['count'], params['bond_ids'])
+
+
+default_strategy_types = ['低溢价策略', '低余额+低溢价+双低策略', '低余额+双低策略', '低溢价+双低策略', '双低策略', '高收益率策略',
+                          '低价格策略']
+
+# 一组回测参数, 不可变, 可以直接交给子进程执行
+TestConfig = collections.namedtuple('TestConfig', ['strategy_type', 'roll_period', 'bond_count', 'max_price',
+                                                   'max_rise', 'max_double_low', 'pre_day', 'select_expr',
+                                                   'exchange_expr', 'use_panel'])
+
+# 单策略回测时的轮动周期x转债数量
+single_strategy_periods = [1, 5, 10, 15, 20]
+single_strategy_counts = [5, 10, 15, 20]
+
+# 并行回测的进程数, None表示cpu核数
+max_workers = None
+
+
 def test_group(start,
                end=None,
                roll_period=10,
                bond_count=15,
-               strategy_types=['低溢价策略', '低余额+低溢价+双低策略', '低余额+双低策略', '低溢价+双低策略', '双低策略', '高收益率策略', '低价格策略'],
+               strategy_types=default_strategy_types,
                is_single_strategy=False,
                pre_day=7,
                max_rise=30,
                max_price=None,
                max_double_low=150,
-               select_sql=None,
-               exchange_sql=None,
-               is_save_test_result=False
+               select_expr=None,
+               exchange_expr=None,
+               is_save_test_result=False,
+               use_panel=True,
+               on_progress=None,
+               workers=None
                ):
-    global_test_context.need_check_double_low = True
-    global_test_context.roll_period = roll_period
-    global_test_context.bond_count = bond_count
-    global_test_context.pre_day = pre_day
-    global_test_context.max_rise = max_rise
-    global_test_context.max_double_low = max_double_low
-    global_test_context.select_sql = select_sql
-    global_test_context.exchange_sql = exchange_sql
-    if len(strategy_types) == 1:
-        global_test_context.max_price = max_price
-
-    if end is None:
-        end = datetime.datetime.now()
-
-    new_rows = init_rows(start, end)
-    line_names = [] if is_single_strategy else strategy_types
-
-    title = strategy_types[0] + "回测结果" if is_single_strategy else None
-    roll_period = None if is_single_strategy else roll_period
+    configs, line_names = build_test_configs(strategy_types, is_single_strategy, roll_period, bond_count,
+                                             pre_day=pre_day, max_rise=max_rise, max_price=max_price,
+                                             max_double_low=max_double_low, select_expr=select_expr,
+                                             exchange_expr=exchange_expr, use_panel=use_panel)
 
     global_test_context.need_time_data = len(strategy_types) == 1 and is_single_strategy is False
     if global_test_context.need_time_data:
-        global_test_context.time_data = {}
+        global_test_context.timeline = HoldingsRecorder()
 
-    for strategy_type in strategy_types:
-        roll_maker = None
-        if strategy_type == '低溢价策略':
-            roll_maker = low_premium_roll
-        elif strategy_type == '低余额+低溢价+双低策略':
-            roll_maker = low_remain_plus_premium_plus_double_low_roll
-        elif strategy_type == '低余额+双低策略':
-            roll_maker = low_remain_plus_double_low_roll
-        elif strategy_type == '低溢价+双低策略':
-            roll_maker = low_premium_plus_double_low_roll
-        elif strategy_type == '双低策略':
-            roll_maker = double_low_roll
-        elif strategy_type == '高收益率策略':
-            roll_maker = high_yield_roll
-        elif strategy_type == '低价格策略':
-            roll_maker = low_price_roll
-
-        if roll_maker is not None:
-            roll_by_strategy(roll_maker, start, is_single_strategy, line_names, new_rows)
-
-    html = generate_line_html(new_rows, roll_period, start, end, bond_count, line_names, title=title)
+    results = run_test_configs(configs, start, on_progress=on_progress, workers=workers)
+
+    html = generate_test_group_html(results, start, end, roll_period, bond_count, strategy_types,
+                                    is_single_strategy, line_names)
 
     if is_save_test_result:
-        do_save_back_test_result(strategy_types[0], html)
+        save_back_test_series(strategy_types[0], start, end, [
+            new_chart(results, roll_period, bond_count, strategy_types, is_single_strategy, line_names)])
 
     if global_test_context.need_time_data:
-        html += '<br/><br/>' + generate_timeline_html(global_test_context.time_data)
+        html += '<br/><br/>' + generate_timeline_html(global_test_context.timeline)
 
     return html
 
 
-def low_price_roll(new_rows, start):
-    global_test_context.max_price = 130 if global_test_context.max_price is None else global_test_context.max_price
-    global_test_context.need_check_double_low = False
-    global_test_context.get_start_rows = low_price_get_start_rows
-    global_test_context.get_push_rows = low_price_get_push_rows
-    fill_rate(new_rows, start)
-
-
-def high_yield_roll(new_rows, start):
-    global_test_context.max_price = 130 if global_test_context.max_price is None else global_test_context.max_price
-    global_test_context.need_check_double_low = False
-    global_test_context.get_start_rows = high_ytm_get_start_rows
-    global_test_context.get_push_rows = high_ytm_get_push_rows
-    fill_rate(new_rows, start)
-
-
-def double_low_roll(new_rows, start):
-    global_test_context.max_price = 130 if global_test_context.max_price is None else global_test_context.max_price
-    global_test_context.get_start_rows = double_low_get_start_rows
-    global_test_context.get_push_rows = double_low_get_push_rows
-    fill_rate(new_rows, start)
-
-
-def low_premium_plus_double_low_roll(new_rows, start):
-    global_test_context.max_price = 200 if global_test_context.max_price is None else global_test_context.max_price
-    global_test_context.get_start_rows = get_start_rows
-    global_test_context.get_push_rows = get_push_rows
-    fill_rate(new_rows, start)
-
-
-def low_remain_plus_double_low_roll(new_rows, start):
-    global_test_context.max_price = 200 if global_test_context.max_price is None else global_test_context.max_price
-    global_test_context.get_start_rows = low_remain_get_start_rows
-    global_test_context.get_push_rows = low_remain_get_push_rows
-    fill_rate(new_rows, start)
-
-
-def low_remain_plus_premium_plus_double_low_roll(new_rows, start):
-    global_test_context.max_price = 200 if global_test_context.max_price is None else global_test_context.max_price
-    global_test_context.get_start_rows = low_remain_premium_get_start_rows
-    global_test_context.get_push_rows = low_remain_premium_get_push_rows
-    fill_rate(new_rows, start)
-
-
-def roll_by_strategy(roll_maker, start, is_single_strategy, line_names, new_rows):
-    if is_single_strategy:
-        roll_pre_line(line_names, new_rows, 1, 5, start, roll_maker)
-        roll_pre_line(line_names, new_rows, 1, 10, start, roll_maker)
-        roll_pre_line(line_names, new_rows, 1, 15, start, roll_maker)
-        roll_pre_line(line_names, new_rows, 1, 20, start, roll_maker)
-        roll_pre_line(line_names, new_rows, 5, 5, start, roll_maker)
-        roll_pre_line(line_names, new_rows, 5, 10, start, roll_maker)
-        roll_pre_line(line_names, new_rows, 5, 15, start, roll_maker)
-        roll_pre_line(line_names, new_rows, 5, 20, start, roll_maker)
-        roll_pre_line(line_names, new_rows, 10, 5, start, roll_maker)
-        roll_pre_line(line_names, new_rows, 10, 10, start, roll_maker)
-        roll_pre_line(line_names, new_rows, 10, 15, start, roll_maker)
-        roll_pre_line(line_names, new_rows, 10, 20, start, roll_maker)
-        roll_pre_line(line_names, new_rows, 15, 5, start, roll_maker)
-        roll_pre_line(line_names, new_rows, 15, 10, start, roll_maker)
-        roll_pre_line(line_names, new_rows, 15, 15, start, roll_maker)
-        roll_pre_line(line_names, new_rows, 15, 20, start, roll_maker)
-        roll_pre_line(line_names, new_rows, 20, 5, start, roll_maker)
-        roll_pre_line(line_names, new_rows, 20, 10, start, roll_maker)
-        roll_pre_line(line_names, new_rows, 20, 15, start, roll_maker)
-        roll_pre_line(line_names, new_rows, 20, 20, start, roll_maker)
-    else:
-        roll_maker(new_rows, start)
-
-
-def roll_pre_line(line_names, new_rows, period, count, start, roll_maker):
-    name = str(count) + "只转债" + str(period) + "日轮动"
-    line_names.append(name)
-    global_test_context.roll_period = period
-    global_test_context.bond_count = count
-    roll_maker(new_rows, start)
-
-
-def low_premium_roll(new_rows, start):
-    global_test_context.max_price = 20000
-    global_test_context.need_check_double_low = False
-    global_test_context.get_start_rows = low_premium_get_start_rows
-    global_test_context.get_push_rows = low_premium_get_push_rows
-    fill_rate(new_rows, start)
-
-
-def fill_rate(new_rows, start):
-    rows = test(start)
-    rate_value = 0
-    # fixme 这里先写死, 总投入可能做成一个配置变量
-    total_money = 1000000
-    for day, rates in new_rows.items():
-        rate = rows.get(day)
-        if rate is not None:
-            rate_value = rate['all_rate']
-            total_money = rate["total_money"]
-        rates.append([rate_value, total_money])
-
-
-def init_rows(start, end):
-    new_rows = {}
-    for i in range((end - start).days + 1):
-        day = start + datetime.timedelta(days=i)
-        new_rows.setdefault(day, [])
-    return new_rows
-
-
-def get_start_rows(cur, start):
-
-    cur.execute("""
-    select bond_id, bond_nm, price, premium_rt, round(price + premium_rt * 100, 2)
-    from (select *
-          from cb_history
-          where price < 200
-            and last_chg_dt = :start
-            and bond_id not in (SELECT bond_id from cb_enforce where enforce_dt <= :start or delist_dt <= :start)
-            and price is not NULL
-          order by premium_rt
-          limit 30)
-    order by price + premium_rt * 100, premium_rt
-    limit :count            
-                """ if global_test_context.select_sql is None else global_test_context.select_sql,
-                {"start": start, 'count': global_test_context.bond_count})
-    rows = cur.fetchall()
-    return rows
-
-
-def get_push_rows(cur, ids, params):
-    cur.execute("""
-        select bond_id, bond_nm,price, premium_rt, round(price + premium_rt * 100, 2)
-            from (select *
-                  from cb_history
-                  where last_chg_dt = :current
-                    and bond_id not in (SELECT bond_id from cb_enforce where enforce_dt <= :current or delist_dt <= :current)
-                    and bond_id not in (""" + ids + """)
-                  order by premium_rt
-                  limit 30)
-            order by price + premium_rt * 100, premium_rt
-            limit :count """ if global_test_context.exchange_sql is None else global_test_context.exchange_sql, params)
-    return cur.fetchall()
-
-
-def low_remain_get_start_rows(cur, start):
-    cur.execute("""
-    select bond_id, bond_nm, price, premium_rt, round(price + premium_rt * 100, 2)
-    from (select *
-          from cb_history
-          where price < 200
-            and last_chg_dt = :start
-            and bond_id not in (SELECT bond_id from cb_enforce where enforce_dt <= :start or delist_dt <= :start)
-            and price is not NULL
-          order by curr_iss_amt
-          limit 30)
-    order by price + premium_rt * 100, curr_iss_amt
-    limit :count            
-                """ if global_test_context.select_sql is None else global_test_context.select_sql,
-                {"start": start, 'count': global_test_context.bond_count})
-    rows = cur.fetchall()
-    return rows
+def build_test_configs(strategy_types, is_single_strategy, roll_period, bond_count, pre_day=7, max_rise=30,
+                       max_price=None, max_double_low=150, select_expr=None, exchange_expr=None, use_panel=True):
+    configs = []
+    line_names = [] if is_single_strategy else list(strategy_types)
+    # 不同的策略价格上限不一样, 所以只针对单个策略
+    if len(strategy_types) != 1:
+        max_price = None
 
+    # 表达式写错了在提交时就报错
+    for text in (select_expr, exchange_expr):
+        if text is not None:
+            get_expr_selector(text)
 
-def low_remain_get_push_rows(cur, ids, params):
-    cur.execute("""
-        select bond_id, bond_nm,price, premium_rt, round(price + premium_rt * 100, 2)
-            from (select *
-                  from cb_history
-                  where last_chg_dt = :current
-                    and bond_id not in (SELECT bond_id from cb_enforce where enforce_dt <= :current or delist_dt <= :current)
-                    and bond_id not in (""" + ids + """)
-                  order by curr_iss_amt
-                  limit 30)
-            order by price + premium_rt * 100, curr_iss_amt
-            limit :count """, params)
-    return cur.fetchall()
-
-
-def low_remain_premium_get_start_rows(cur, start):
-    cur.execute("""
-        select bond_id, bond_nm, price, premium_rt, round(price + premium_rt * 100, 2)
-        from (select *
-              from (select *
-                    from cb_history
-                    where price < 200
-                      and last_chg_dt = :start
-                      and bond_id not in (SELECT bond_id from cb_enforce where enforce_dt <= :start or delist_dt <= :start)
-                      and price is not NULL
-                    order by premium_rt
-                    limit 60)
-              order by curr_iss_amt
-              limit 30)
-        order by price + premium_rt * 100, curr_iss_amt
-        limit :count            
-                """ if global_test_context.select_sql is None else global_test_context.select_sql,
-                {"start": start, 'count': global_test_context.bond_count})
-    rows = cur.fetchall()
-    return rows
-
-
-def low_remain_premium_get_push_rows(cur, ids, params):
-    cur.execute("""
-        select bond_id, bond_nm, price, premium_rt, round(price + premium_rt * 100, 2)
-        from (select *
-              from (select *
-                    from cb_history
-                    where price < 200
-                      and last_chg_dt = :current
-                      and bond_id not in (SELECT bond_id from cb_enforce where enforce_dt <= :current or delist_dt <= :current)
-                      and price is not NULL
-                    order by premium_rt
-                    limit 60)
-              where bond_id not in (""" + ids + """)
-              order by curr_iss_amt
-              limit 30)
-        order by price + premium_rt * 100, curr_iss_amt
-        limit :count """, params)
-    return cur.fetchall()
-
-
-def double_low_get_start_rows(cur, start):
-    cur.execute("""
-    select bond_id, bond_nm, price, premium_rt, round(price + premium_rt * 100, 2)
-          from cb_history
-          where price < 130
-            and last_chg_dt = :start
-            and bond_id not in (SELECT bond_id from cb_enforce where enforce_dt <= :start or delist_dt <= :start)
-            and price is not NULL
-          order by price + premium_rt * 100, premium_rt
-          limit :count            
-                """ if global_test_context.select_sql is None else global_test_context.select_sql,
-                {"start": start, 'count': global_test_context.bond_count})
-    rows = cur.fetchall()
-    return rows
-
-
-def double_low_get_push_rows(cur, ids, params):
-    cur.execute("""
-        select bond_id, bond_nm,price, premium_rt, round(price + premium_rt * 100, 2)
-                  from cb_history
-                  where last_chg_dt = :current
-                    and bond_id not in (SELECT bond_id from cb_enforce where enforce_dt <= :current or delist_dt <= :current)
-                    and bond_id not in (""" + ids + """)
-                  order by price + premium_rt * 100, premium_rt
-                  limit :count """, params)
-    return cur.fetchall()
-
-
-def high_ytm_get_start_rows(cur, start):
-    cur.execute("""
-    select bond_id, bond_nm, price, premium_rt
-          from cb_history
-          where price < 130
-            and last_chg_dt = :start
-            and bond_id not in (SELECT bond_id from cb_enforce where enforce_dt <= :start or delist_dt <= :start)
-          order by ytm_rt desc
-          limit :count            
-                """ if global_test_context.select_sql is None else global_test_context.select_sql,
-                {"start": start, 'count': global_test_context.bond_count})
-    rows = cur.fetchall()
-    return rows
-
-
-def high_ytm_get_push_rows(cur, ids, params):
-    cur.execute("""
-        select bond_id, bond_nm,price, premium_rt
-                  from cb_history
-                  where last_chg_dt = :current
-                    and bond_id not in (SELECT bond_id from cb_enforce where enforce_dt <= :current or delist_dt <= :current)
-                    and bond_id not in (""" + ids + """)
-                  order by ytm_rt desc
-                  limit :count """, params)
-    return cur.fetchall()
-
-
-def low_premium_get_start_rows(cur, start):
-    cur.execute("""
-    select bond_id, bond_nm, price, premium_rt
-          from cb_history
-          where last_chg_dt = :start
-            and bond_id not in (SELECT bond_id from cb_enforce where enforce_dt <= :start or delist_dt <= :start)
-            and price is not NULL
-          order by premium_rt
-          limit :count            
-                """ if global_test_context.select_sql is None else global_test_context.select_sql,
-                {"start": start, 'count': global_test_context.bond_count})
-    rows = cur.fetchall()
-    return rows
+    for strategy_type in strategy_types:
+        if strategy_type not in strategy_specs:
+            if not is_single_strategy:
+                line_names.remove(strategy_type)
+            continue
+
+        if is_single_strategy:
+            for period in single_strategy_periods:
+                for count in single_strategy_counts:
+                    line_names.append(str(count) + "只转债" + str(period) + "日轮动")
+                    configs.append(TestConfig(strategy_type, period, count, max_price, max_rise, max_double_low,
+                                              pre_day, select_expr, exchange_expr, use_panel))
+        else:
+            configs.append(TestConfig(strategy_type, roll_period, bond_count, max_price, max_rise, max_double_low,
+                                      pre_day, select_expr, exchange_expr, use_panel))
+    return configs, line_names
+
+
+def run_test_configs(configs, start, resume=False, on_progress=None, workers=None):
+    """
+    resume为True时从上次保存的断点接着回测, 跑完后再保存新的断点
+    on_progress(num): 又跑完了num组回测参数时回调, 用来更新进度
+    workers: 进程数, 默认按max_workers, 为1时在当前线程里跑
+    """
+    keys = [None] * len(configs)
+    states = [None] * len(configs)
+    if resume:
+        # 自定义表达式的回测不保存断点
+        keys = [None if config.select_expr is not None or config.exchange_expr is not None
+                else get_checkpoint_key(config, start, strategy_specs[config.strategy_type]) for config in configs]
+        checkpoints = load_checkpoints({key for key in keys if key is not None})
+        # 参数一样的回测(比如一个查库一个用内存数据)共用同一个断点, 各自拷贝一份, 一起推进时才不会互相影响
+        states = [copy.deepcopy(checkpoints[key]) if key in checkpoints else None for key in keys]
+        print('resume backtest from checkpoints: ' + str(len([state for state in states if state is not None])) + "/"
+              + str(len(configs)))
+
+    workers = min(workers or max_workers or os.cpu_count() or 1, len(configs))
+    # 需要记录持仓时间线的只有一个回测, 直接在当前线程执行
+    if len(configs) <= 1 or global_test_context.need_time_data:
+        need_time_data = global_test_context.need_time_data
+        states = [report_progress(run_test(config, start, need_time_data, state), on_progress)
+                  for config, state in zip(configs, states)]
+    elif workers == 1:
+        # 所有组合一起按交易日推进
+        states = run_multi_test(configs, start, states, on_progress)
+    else:
+        mp_context = get_mp_context()
+        # 先在父进程加载好内存数据和选债排名, fork出来的子进程可以直接共享(forkserver的子进程各自加载)
+        panel_configs = [config for config in configs if config.use_panel]
+        if len(panel_configs) > 0 and mp_context is None:
+            panel = get_data_panel()
+            max_count = max(config.bond_count for config in panel_configs)
+            for selector in {selector for config in panel_configs for selector in get_config_selectors(config)}:
+                selector.warm(panel, max_count)
+            for pre_day in {config.pre_day for config in panel_configs}:
+                panel.get_lag_data(pre_day)
+
+        # 每个进程分一批回测参数, 批内的组合一起按交易日推进
+        chunks = [list(range(len(configs)))[i::workers] for i in range(workers)]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as executor:
+            futures = [executor.submit(run_multi_test, [configs[i] for i in chunk], start, [states[i] for i in chunk])
+                       for chunk in chunks]
+            for chunk, future in zip(chunks, futures):
+                for i, state in zip(chunk, future.result()):
+                    states[i] = report_progress(state, on_progress)
+
+    if resume:
+        save_checkpoints([(key, get_checkpoint_name(config, start), state)
+                          for key, config, state in zip(keys, configs, states) if key is not None and state is not None])
+
+    return [{} if state is None else state['test_result']['rows'] for state in states]
+
+
+def get_mp_context():
+    # 在web服务的后台线程里(定时任务)直接fork, 子进程会带着别的线程当时拿着的锁(stdout/日志/连接池),
+    # 子进程里一用就可能卡死, 这时改用forkserver; 主线程里(命令行)还是fork, 可以共享父进程加载好的数据
+    if threading.current_thread() is threading.main_thread():
+        return None
+    return multiprocessing.get_context('forkserver')
+
+
+def report_progress(state, on_progress):
+    if on_progress is not None:
+        on_progress(1)
+    return state
+
+
+def run_test(config, start, need_time_data=False, state=None):
+    panel = get_data_panel() if config.use_panel else None
+    set_test_context(config, need_time_data, panel, get_eligibility())
+    return test(start, state)
+
+
+def run_multi_test(configs, start, states=None, on_progress=None):
+    """
+    多组回测参数一起按交易日推进, 共用同一份内存数据, 每个组合各自维护自己的状态(持仓/零头/轮动计数/收益)
+    每天轮流切换到各组合的回测参数处理当天, 返回各组回测的最后状态
+    on_progress: 按已处理的交易日折算成完成了几组回测参数回调
+    """
+    states = [None] * len(configs) if states is None else list(states)
+    panel = get_data_panel() if any(config.use_panel for config in configs) else None
+    eligibility = get_eligibility()
+    contexts = [(config, panel if config.use_panel else None) for config in configs]
+
+    # (下一个要处理的交易日, 组合下标), 换新一轮时有的组合会往后跳过几天, 等其他组合跟上来再处理
+    pending = []
+    for k, state in enumerate(states):
+        config, config_panel = contexts[k]
+        set_test_context(config, False, config_panel, eligibility)
+        if state is None:
+            state = start_test(start)
+            states[k] = state
+        push_pending(pending, state, k)
 
+    end = datetime.datetime.now()
+    calendar = get_trade_calendar()
+    first_idx = None if len(pending) == 0 else calendar.index_of(pending[0][0])
+    total_days = 0 if first_idx is None else len(calendar) - first_idx
+    done_days = 0
+    reported = 0
+    current = None
+    while len(pending) > 0 and str(pending[0][0]) <= str(end):
+        trade_day, k = heapq.heappop(pending)
+        if trade_day != current:
+            current = trade_day
+            done_days += 1
+            reported = report_days_progress(len(configs), done_days, total_days, reported, on_progress)
+
+        config, config_panel = contexts[k]
+        set_test_context(config, False, config_panel, eligibility)
+        state = states[k]
+        run_test_day(state, trade_day)
+        push_pending(pending, state, k)
+
+    if on_progress is not None and reported < len(configs):
+        on_progress(len(configs) - reported)
+    return states
+
+
+def push_pending(pending, state, k):
+    if state is None:
+        return
+    trade_day = next_trade_day(state['trade_day'])
+    if trade_day is not None:
+        heapq.heappush(pending, (trade_day, k))
+
+
+def report_days_progress(config_num, done_days, total_days, reported, on_progress):
+    if on_progress is None or total_days <= 0:
+        return reported
+    # 最后一组留到全部跑完时再报
+    num = min(config_num * done_days // total_days, config_num - 1)
+    if num > reported:
+        on_progress(num - reported)
+        return num
+    return reported
+
+
+def get_config_selectors(config):
+    """(建仓, 调仓)的选债规则, 有自定义表达式的用表达式"""
+    start_selector, push_selector = strategy_selectors[config.strategy_type]
+    if config.select_expr is not None:
+        start_selector = get_expr_selector(config.select_expr)
+    if config.exchange_expr is not None:
+        push_selector = get_expr_selector(config.exchange_expr)
+    return start_selector, push_selector
+
+
+def set_test_context(config, need_time_data, panel, eligibility):
+    spec = strategy_specs[config.strategy_type]
+    global_test_context.need_check_double_low = spec['need_check_double_low']
+    global_test_context.need_time_data = need_time_data
+    global_test_context.roll_period = config.roll_period
+    global_test_context.bond_count = config.bond_count
+    global_test_context.pre_day = config.pre_day
+    global_test_context.max_rise = config.max_rise
+    global_test_context.max_double_low = config.max_double_low
+    global_test_context.max_price = spec['max_price'] if config.max_price is None else config.max_price
+    global_test_context.panel = panel
+    global_test_context.eligibility = eligibility
+    global_test_context.start_selector, global_test_context.push_selector = get_config_selectors(config)
+
+
+def generate_long_year_back_test_data(resume=False):
+    start = datetime.datetime.strptime('2018-01-01', '%Y-%m-%d')
+    end = None
+    generate_test_data('long_year_back_test', start, end, resume)
 
-def low_premium_get_push_rows(cur, ids, params):
-    cur.execute("""
-        select bond_id, bond_nm,price, premium_rt
-                  from cb_history
-                  where last_chg_dt = :current
-                    and bond_id not in (SELECT bond_id from cb_enforce where enforce_dt <= :current or delist_dt <= :current)
-                    and bond_id not in (""" + ids + """)
-                  order by premium_rt
-                  limit :count """, params)
-    return cur.fetchall()
 
+def generate_good_year_back_test_data(resume=False):
+    start = datetime.datetime.strptime('2021-01-01', '%Y-%m-%d')
+    end = None
+    generate_test_data('good_year_back_test', start, end, resume)
 
-def low_price_get_start_rows(cur, start):
-    cur.execute("""
-    select bond_id, bond_nm, price, premium_rt
-          from cb_history
-          where last_chg_dt = :start
-            and bond_id not in (SELECT bond_id from cb_enforce where enforce_dt <= :start or delist_dt <= :start)
-            and price is not NULL
-          order by price
-          limit :count            
-                """ if global_test_context.select_sql is None else global_test_context.select_sql,
-                {"start": start, 'count': global_test_context.bond_count})
-    rows = cur.fetchall()
-    return rows
 
+def generate_bad_year_back_test_data(resume=False):
+    start = datetime.datetime.strptime('2018-01-01', '%Y-%m-%d')
+    end = datetime.datetime.strptime('2019-01-01', '%Y-%m-%d')
+    generate_test_data('bad_year_back_test', start, end, resume)
 
-def low_price_get_push_rows(cur, ids, params):
-    cur.execute("""
-        select bond_id, bond_nm,price, premium_rt
-                  from cb_history
-                  where last_chg_dt = :current
-                    and bond_id not in (SELECT bond_id from cb_enforce where enforce_dt <= :current or delist_dt <= :current)
-                    and bond_id not in (""" + ids + """)
-                  order by price
-                  limit :count """, params)
-    return cur.fetchall()
 
+def generate_test_data(name, start, end, resume=False):
+    # 20组(轮动周期x转债数量)一起放到进程池里跑
+    groups = []
+    configs = []
+    for period in single_strategy_periods:
+        for count in single_strategy_counts:
+            group_configs, line_names = build_test_configs(default_strategy_types, False, period, count)
+            groups.append((period, count, line_names, len(group_configs)))
+            configs.extend(group_configs)
 
-def generate_long_year_back_test_data():
-    start = datetime.datetime.strptime('2018-01-01', '%Y-%m-%d')
-    end = None
-    generate_test_data('long_year_back_test', start, end)
+    global_test_context.need_time_data = False
+    results = run_test_configs(configs, start, resume)
 
+    charts = []
+    i = 0
+    for period, count, line_names, size in groups:
+        charts.append(new_chart(results[i:i + size], period, count, default_strategy_types, False, line_names))
+        i += size
+    save_back_test_series(name, start, end, charts)
 
-def generate_good_year_back_test_data():
-    start = datetime.datetime.strptime('2021-01-01', '%Y-%m-%d')
-    end = None
-    generate_test_data('good_year_back_test', start, end)
 
+def generate_strategy_test_data(start, strategy_types=None, resume=False):
+    # 每个策略各20条回测线, 所有策略一起放到进程池里跑, 分别保存
+    if strategy_types is None:
+        strategy_types = default_strategy_types
 
-def generate_bad_year_back_test_data():
-    start = datetime.datetime.strptime('2018-01-01', '%Y-%m-%d')
-    end = datetime.datetime.strptime('2019-01-01', '%Y-%m-%d')
-    generate_test_data('bad_year_back_test', start, end)
-
-
-def generate_test_data(name, start, end):
-    content = '<br/><br/>'
-    content += test_group(start, end=end, roll_period=1, bond_count=5)
-    content += test_group(start, end=end, roll_period=1, bond_count=10)
-    content += test_group(start, end=end, roll_period=1, bond_count=15)
-    content += test_group(start, end=end, roll_period=1, bond_count=20)
-    content += test_group(start, end=end, roll_period=5, bond_count=5)
-    content += test_group(start, end=end, roll_period=5, bond_count=10)
-    content += test_group(start, end=end, roll_period=5, bond_count=15)
-    content += test_group(start, end=end, roll_period=5, bond_count=20)
-    content += test_group(start, end=end, roll_period=10, bond_count=5)
-    content += test_group(start, end=end, roll_period=10, bond_count=10)
-    content += test_group(start, end=end, roll_period=10, bond_count=15)
-    content += test_group(start, end=end, roll_period=10, bond_count=20)
-    content += test_group(start, end=end, roll_period=15, bond_count=5)
-    content += test_group(start, end=end, roll_period=15, bond_count=10)
-    content += test_group(start, end=end, roll_period=15, bond_count=15)
-    content += test_group(start, end=end, roll_period=15, bond_count=20)
-    content += test_group(start, end=end, roll_period=20, bond_count=5)
-    content += test_group(start, end=end, roll_period=20, bond_count=10)
-    content += test_group(start, end=end, roll_period=20, bond_count=15)
-    content += test_group(start, end=end, roll_period=20, bond_count=20)
-    do_save_back_test_result(name, content)
-
-
-def do_save_back_test_result(name, data):
-    with db_utils.get_daily_connect() as con:
-        cur = con.cursor()
-        result = cur.execute("update cb_backtest_data set data=:data where name=:name", {"name": name, "data": data})
-        if result.rowcount != 1:
-            print('update cb_backtest_data is failure. row:' + name)
-        else:
-            print('update cb_backtest_data is successful. row:' + name)
+    groups = []
+    configs = []
+    for strategy_type in strategy_types:
+        group_configs, line_names = build_test_configs([strategy_type], True, None, None)
+        groups.append((strategy_type, line_names, len(group_configs)))
+        configs.extend(group_configs)
+
+    global_test_context.need_time_data = False
+    results = run_test_configs(configs, start, resume)
+
+    i = 0
+    for strategy_type, line_names, size in groups:
+        save_back_test_series(strategy_type, start, None, [
+            new_chart(results[i:i + size], None, None, [strategy_type], True, line_names)])
+        i += size
 
 
 if __name__ == "__main__":
@@ -0,0 +1,405 @@
+# 自定义选债表达式
+# 代替原来直接执行的选债/调仓sql, 只能引用cb_history的几个字段, 解析一次后按原文缓存,
+# 在内存数据面板上向量化选债(和内置策略一样快), 也可以生成等价的sql查库
+#
+# 语法:
+#   rank(排序表达式, ...) [where 过滤条件] [top 数量] [then rank(...) ...]
+#   排序表达式越小越靠前, 倒序加负号; 多个rank用then连接, 逐级筛选; 最后一级的top不写时取需要买入的数量
+# 例子:
+#   rank(price + premium_rt*100) where price < 130 top 15
+#   rank(premium_rt) where price < 200 top 30 then rank(double_low, curr_iss_amt)
+#   rank(-ytm_rt) where price < 130 and (premium_rt < 0.3 or curr_iss_amt < 3)
+import re
+
+import numpy as np
+
+from backtest.data_panel import operators
+from backtest.strategy_spec import fields
+from utils.bond_utils import parse_bond_ids_params
+
+# 已编译的表达式 {表达式原文: ExprSelector}
+expr_selector_cache = {}
+
+keywords = {'rank', 'where', 'top', 'then', 'and', 'or', 'not'}
+
+# 函数: 参数个数下限
+functions = {'abs': 1, 'min': 2, 'max': 2}
+
+compare_operators = {'<': '<', '<=': '<=', '>': '>', '>=': '>=', '=': '=', '==': '=', '!=': '!=', '<>': '!='}
+
+token_pattern = re.compile(r'\s*(?:(?P<number>\d+(?:\.\d*)?|\.\d+)|(?P<name>[A-Za-z_][A-Za-z_0-9]*)'
+                           r'|(?P<op><=|>=|==|!=|<>|[-+*/(),<>=]))')
+
+
+def tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = token_pattern.match(text, pos)
+        if match is None or match.end() == pos:
+            raise Exception('invalid expression at ' + str(pos) + ': ' + text[pos:pos + 10])
+        kind = match.lastgroup
+        value = match.group(kind)
+        start = match.start(kind)
+        if kind == 'name':
+            value = value.lower()
+            if value in keywords:
+                kind = value
+        tokens.append((kind, value, start))
+        pos = match.end()
+    tokens.append(('end', None, len(text)))
+    return tokens
+
+
+class Parser:
+    """
+    递归下降解析, 语法树用元组表示:
+    ('num', 值), ('field', 字段), ('neg', x), ('arith', 运算符, a, b), ('call', 函数, [参数]),
+    ('cmp', 比较符, a, b), ('and', a, b), ('or', a, b), ('not', x)
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos]
+
+    def next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def accept(self, kind, value=None):
+        token = self.peek()
+        if token[0] == kind and (value is None or token[1] == value):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, kind, value=None):
+        if not self.accept(kind, value):
+            self.error('expect ' + (value or kind))
+
+    def error(self, message):
+        token = self.peek()
+        raise Exception('invalid expression at ' + str(token[2]) + ': ' + message + ', but got ' +
+                        ('end' if token[0] == 'end' else token[1]))
+
+    def parse_rule(self):
+        """返回逐级筛选[(排序表达式列表, 过滤条件或None, 数量或None)]"""
+        stages = [self.parse_stage()]
+        while self.accept('then'):
+            stages.append(self.parse_stage())
+        if self.peek()[0] != 'end':
+            self.error('expect then')
+        for keys, where, limit in stages[:-1]:
+            if limit is None:
+                raise Exception('invalid expression: top is required except the last rank')
+        return stages
+
+    def parse_stage(self):
+        self.expect('rank')
+        self.expect('op', '(')
+        keys = [self.parse_value()]
+        while self.accept('op', ','):
+            keys.append(self.parse_value())
+        self.expect('op', ')')
+
+        where = None
+        if self.accept('where'):
+            where = self.parse_condition()
+
+        limit = None
+        if self.accept('top'):
+            token = self.next()
+            if token[0] != 'number' or not token[1].isdigit() or int(token[1]) <= 0:
+                self.pos -= 1
+                self.error('expect a positive integer after top')
+            limit = int(token[1])
+        return keys, where, limit
+
+    def parse_value(self):
+        node = self.parse_or()
+        if is_condition(node):
+            raise Exception('invalid expression: rank needs a number, not a condition')
+        return node
+
+    def parse_condition(self):
+        node = self.parse_or()
+        if not is_condition(node):
+            raise Exception('invalid expression: where needs a condition, like price < 130')
+        return node
+
+    def parse_or(self):
+        node = self.parse_and()
+        while self.accept('or'):
+            node = ('or', check_condition(node), check_condition(self.parse_and()))
+        return node
+
+    def parse_and(self):
+        node = self.parse_not()
+        while self.accept('and'):
+            node = ('and', check_condition(node), check_condition(self.parse_not()))
+        return node
+
+    def parse_not(self):
+        if self.accept('not'):
+            return 'not', check_condition(self.parse_not())
+        return self.parse_compare()
+
+    def parse_compare(self):
+        node = self.parse_arith()
+        token = self.peek()
+        if token[0] == 'op' and token[1] in compare_operators:
+            self.next()
+            node = ('cmp', compare_operators[token[1]], check_value(node), check_value(self.parse_arith()))
+        return node
+
+    def parse_arith(self):
+        node = self.parse_term()
+        while self.peek()[0] == 'op' and self.peek()[1] in ('+', '-'):
+            op = self.next()[1]
+            node = ('arith', op, check_value(node), check_value(self.parse_term()))
+        return node
+
+    def parse_term(self):
+        node = self.parse_unary()
+        while self.peek()[0] == 'op' and self.peek()[1] in ('*', '/'):
+            op = self.next()[1]
+            node = ('arith', op, check_value(node), check_value(self.parse_unary()))
+        return node
+
+    def parse_unary(self):
+        if self.accept('op', '-'):
+            return 'neg', check_value(self.parse_unary())
+        return self.parse_primary()
+
+    def parse_primary(self):
+        token = self.next()
+        kind, value = token[0], token[1]
+        if kind == 'number':
+            return 'num', float(value)
+        if kind == 'name' and value in functions:
+            self.expect('op', '(')
+            args = [self.parse_value()]
+            while self.accept('op', ','):
+                args.append(self.parse_value())
+            self.expect('op', ')')
+            if len(args) < functions[value] or (value == 'abs' and len(args) != 1):
+                raise Exception('invalid expression: wrong number of arguments for ' + value)
+            return 'call', value, args
+        if kind == 'name':
+            if value not in fields:
+                raise Exception('invalid expression: unknown field ' + value + ', available: ' + ', '.join(fields))
+            return 'field', value
+        if kind == 'op' and value == '(':
+            node = self.parse_or()
+            self.expect('op', ')')
+            return node
+        self.pos -= 1
+        self.error('expect a number, field or (')
+
+
+def is_condition(node):
+    return node[0] in ('cmp', 'and', 'or', 'not')
+
+
+def check_condition(node):
+    if not is_condition(node):
+        raise Exception('invalid expression: and/or/not need conditions')
+    return node
+
+
+def check_value(node):
+    if is_condition(node):
+        raise Exception('invalid expression: a condition can not be calculated or compared')
+    return node
+
+
+def to_text(node):
+    """规范化的表达式文本, 用来做缓存的key"""
+    kind = node[0]
+    if kind == 'num':
+        return repr(node[1])
+    if kind == 'field':
+        return node[1]
+    if kind == 'neg':
+        return '(-' + to_text(node[1]) + ')'
+    if kind in ('arith', 'cmp'):
+        return '(' + to_text(node[2]) + ' ' + node[1] + ' ' + to_text(node[3]) + ')'
+    if kind == 'call':
+        return node[1] + '(' + ', '.join(to_text(arg) for arg in node[2]) + ')'
+    if kind == 'not':
+        return '(not ' + to_text(node[1]) + ')'
+    return '(' + to_text(node[1]) + ' ' + kind + ' ' + to_text(node[2]) + ')'
+
+
+def to_sql(node):
+    kind = node[0]
+    if kind == 'num':
+        return repr(node[1])
+    if kind == 'field':
+        return fields[node[1]]
+    if kind == 'neg':
+        return '(-' + to_sql(node[1]) + ')'
+    if kind in ('arith', 'cmp'):
+        return '(' + to_sql(node[2]) + ' ' + node[1] + ' ' + to_sql(node[3]) + ')'
+    if kind == 'call':
+        return node[1] + '(' + ', '.join(to_sql(arg) for arg in node[2]) + ')'
+    if kind == 'not':
+        return '(not ' + to_sql(node[1]) + ')'
+    return '(' + to_sql(node[1]) + ' ' + kind + ' ' + to_sql(node[2]) + ')'
+
+
+def evaluate(node, panel):
+    """在面板上计算, 返回 交易日 x 转债 的数组(常量时为标量), 和sql一样, 有空值参与的比较都不成立"""
+    kind = node[0]
+    if kind == 'num':
+        return node[1]
+    if kind == 'field':
+        return getattr(panel, node[1])
+    if kind == 'neg':
+        return -evaluate(node[1], panel)
+    if kind == 'arith':
+        a = evaluate(node[2], panel)
+        b = evaluate(node[3], panel)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if node[1] == '+':
+                return a + b
+            if node[1] == '-':
+                return a - b
+            if node[1] == '*':
+                return a * b
+            # 和sql一样, 除以0为空
+            return np.where(b == 0, np.nan, a / np.where(b == 0, 1, b))
+    if kind == 'call':
+        args = [evaluate(arg, panel) for arg in node[2]]
+        if node[1] == 'abs':
+            return np.abs(args[0])
+        reduce = np.minimum if node[1] == 'min' else np.maximum
+        value = args[0]
+        for arg in args[1:]:
+            value = reduce(value, arg)
+        return value
+    if kind == 'cmp':
+        a = evaluate(node[2], panel)
+        b = evaluate(node[3], panel)
+        if node[1] == '!=':
+            return np.asarray((a != b) & ~np.isnan(a) & ~np.isnan(b))
+        return np.asarray(operators[node[1]](a, b))
+    if kind == 'not':
+        # 空值的比较本身就不成立, not之后也不成立
+        return ~evaluate(node[1], panel) & ~is_null(node[1], panel)
+    if kind == 'and':
+        return evaluate(node[1], panel) & evaluate(node[2], panel)
+    return evaluate(node[1], panel) | evaluate(node[2], panel)
+
+
+def is_null(node, panel):
+    """条件里有空值参与比较的(sql里结果为NULL)"""
+    kind = node[0]
+    if kind == 'cmp':
+        return np.isnan(evaluate(node[2], panel)) | np.isnan(evaluate(node[3], panel))
+    if kind == 'not':
+        return is_null(node[1], panel)
+    return is_null(node[1], panel) | is_null(node[2], panel)
+
+
+class ExprSelector:
+    """和strategy_spec.CompiledSelector的用法一样, 调仓时在第一级筛选之前排除已持有的转债"""
+
+    def __init__(self, text):
+        self.text = text
+        self.stages = Parser(text).parse_rule()
+        self.stage_keys = [(tuple(to_text(key) for key in keys), None if where is None else to_text(where))
+                           for keys, where, limit in self.stages]
+
+    def select_rows(self, panel, day, count, exclude_ids=None):
+        # 在内存数据面板上选债
+        i = panel.get_day_idx(day)
+        if i is None:
+            return []
+
+        excludes = []
+        if exclude_ids:
+            excludes = [panel.bond_index[bond_id] for bond_id in exclude_ids if bond_id in panel.bond_index]
+
+        # 第一级筛选用缓存的排名, 要排除的转债最多占掉len(excludes)个位置, 所以多取这么多
+        limit = self.get_limit(0, count)
+        candidates = self.get_ranks(panel, limit + len(excludes))[i]
+        candidates = candidates[candidates >= 0]
+        if excludes:
+            candidates = candidates[~np.isin(candidates, excludes)]
+        candidates = candidates[0:limit]
+
+        for k in range(1, len(self.stages)):
+            keys, where, limit = self.stages[k]
+            if where is not None:
+                candidates = candidates[self.get_values(panel, where)[i, candidates]]
+            candidates = panel.top_by(i, candidates, [self.get_values(panel, key) for key in keys],
+                                      self.get_limit(k, count))
+
+        return panel.build_rows(i, candidates)
+
+    def warm(self, panel, count):
+        self.get_ranks(panel, self.get_limit(0, count) + count)
+
+    def get_ranks(self, panel, depth):
+        keys, where, limit = self.stages[0]
+
+        def build():
+            mask = np.ones(panel.price.shape, dtype=bool) if where is None else self.get_values(panel, where)
+            return mask, [self.get_values(panel, key) for key in keys]
+
+        return panel.get_ranks(('expr',) + self.stage_keys[0], build, depth)
+
+    @staticmethod
+    def get_values(panel, node):
+        return panel.get_values(to_text(node), lambda: evaluate(node, panel))
+
+    def get_limit(self, k, count):
+        # 最后一级最多取需要买入的数量
+        limit = self.stages[k][2]
+        if k == len(self.stages) - 1:
+            return count if limit is None else min(limit, count)
+        return limit
+
+    def query_rows(self, cur, day, count, exclude_ids=None):
+        # 查库选债, 连接上需要先注册is_eligible函数(见eligibility.Eligibility.install)
+        params = {"current": day}
+        ids = parse_bond_ids_params(exclude_ids or [], params)
+        cur.execute(self.build_sql(ids, count), params)
+        return cur.fetchall()
+
+    def build_sql(self, ids, count):
+        where = ["last_chg_dt = :current",
+                 "is_eligible(bond_id, :current)",
+                 "price is not NULL"]
+        if ids != '':
+            where.append("bond_id not in (" + ids + ")")
+
+        sql = "select * from cb_history where " + " and ".join(where)
+        for k, (keys, condition, limit) in enumerate(self.stages):
+            if k == len(self.stages) - 1:
+                sql = "select bond_id, bond_nm, price, premium_rt, round(price + premium_rt * 100, 2) from (" + sql + ")"
+            else:
+                sql = "select * from (" + sql + ")"
+            if condition is not None:
+                sql += " where " + to_sql(condition)
+            # 和面板一样, 空值排在最后, 相同的按bond_id排
+            order_by = [to_sql(key) + " is NULL, " + to_sql(key) for key in keys] + ['bond_id']
+            sql += " order by " + ", ".join(order_by) + " limit " + str(self.get_limit(k, count))
+        return sql
+
+
+def get_expr_selector(text):
+    """编译好的选债表达式, 同样的表达式只解析一次"""
+    text = ' '.join(text.split())
+    selector = expr_selector_cache.get(text)
+    if selector is None:
+        selector = ExprSelector(text)
+        expr_selector_cache[text] = selector
+    return selector
@@ -0,0 +1,173 @@
+# 轮动策略的声明式定义
+# 每个策略的选债规则由 过滤条件 + 逐级"按某字段取前N只" + 最后一级的排序 组成,
+# 编译后既可以在内存数据面板上向量化选债, 也可以生成等价的sql查库
+import numpy as np
+
+from backtest.data_panel import operators
+from utils.bond_utils import parse_bond_ids_params
+
+# 可以用来过滤/排序的字段: 对应的sql表达式
+fields = {
+    'price': 'price',
+    'premium_rt': 'premium_rt',
+    'ytm_rt': 'ytm_rt',
+    'curr_iss_amt': 'curr_iss_amt',
+    'double_low': '(price + premium_rt * 100)',
+}
+
+# 策略定义
+# max_price: 持有的转债价格超过多少轮出(可以被自定义参数覆盖)
+# need_check_double_low: 是否检查组合整体的双低值
+# start/push: 建仓/调仓时的选债规则
+#   filters: 过滤条件[(字段, 比较符, 值)]
+#   stages: 逐级筛选[(排序字段, 数量)], 字段前加'-'表示倒序, 数量为None时取需要买入的数量, 最后一级的排序就是最终顺序
+#   exclude_stage: 调仓时在第几级筛选之前排除已持有的转债
+strategy_specs = {
+    '低溢价策略': {
+        'max_price': 20000,
+        'need_check_double_low': False,
+        'start': {'stages': [(['premium_rt'], None)]},
+        'push': {'stages': [(['premium_rt'], None)]},
+    },
+    '低余额+低溢价+双低策略': {
+        'max_price': 200,
+        'need_check_double_low': True,
+        'start': {'filters': [('price', '<', 200)],
+                  'stages': [(['premium_rt'], 60), (['curr_iss_amt'], 30), (['double_low', 'curr_iss_amt'], None)]},
+        'push': {'filters': [('price', '<', 200)],
+                 'stages': [(['premium_rt'], 60), (['curr_iss_amt'], 30), (['double_low', 'curr_iss_amt'], None)],
+                 'exclude_stage': 1},
+    },
+    '低余额+双低策略': {
+        'max_price': 200,
+        'need_check_double_low': True,
+        'start': {'filters': [('price', '<', 200)],
+                  'stages': [(['curr_iss_amt'], 30), (['double_low', 'curr_iss_amt'], None)]},
+        'push': {'stages': [(['curr_iss_amt'], 30), (['double_low', 'curr_iss_amt'], None)]},
+    },
+    '低溢价+双低策略': {
+        'max_price': 200,
+        'need_check_double_low': True,
+        'start': {'filters': [('price', '<', 200)],
+                  'stages': [(['premium_rt'], 30), (['double_low', 'premium_rt'], None)]},
+        'push': {'stages': [(['premium_rt'], 30), (['double_low', 'premium_rt'], None)]},
+    },
+    '双低策略': {
+        'max_price': 130,
+        'need_check_double_low': True,
+        'start': {'filters': [('price', '<', 130)], 'stages': [(['double_low', 'premium_rt'], None)]},
+        'push': {'stages': [(['double_low', 'premium_rt'], None)]},
+    },
+    '高收益率策略': {
+        'max_price': 130,
+        'need_check_double_low': False,
+        'start': {'filters': [('price', '<', 130)], 'stages': [(['-ytm_rt'], None)]},
+        'push': {'stages': [(['-ytm_rt'], None)]},
+    },
+    '低价格策略': {
+        'max_price': 130,
+        'need_check_double_low': False,
+        'start': {'stages': [(['price'], None)]},
+        'push': {'stages': [(['price'], None)]},
+    },
+}
+
+
+class CompiledSelector:
+
+    def __init__(self, spec):
+        self.filters = tuple(tuple(f) for f in spec.get('filters', ()))
+        self.stages = [(tuple(keys), limit) for keys, limit in spec['stages']]
+        self.exclude_stage = spec.get('exclude_stage', 0)
+
+        for field, op, value in self.filters:
+            if field not in fields or op not in operators:
+                raise Exception('unknown filter: ' + str((field, op, value)))
+        if len(self.stages) == 0:
+            raise Exception('stages is required')
+        for keys, limit in self.stages:
+            for key in keys:
+                if key.lstrip('-') not in fields:
+                    raise Exception('unknown sort field: ' + key)
+        if self.exclude_stage >= len(self.stages):
+            raise Exception('exclude_stage is out of stages: ' + str(self.exclude_stage))
+
+    def select_rows(self, panel, day, count, exclude_ids=None):
+        # 在内存数据面板上选债
+        i = panel.get_day_idx(day)
+        if i is None:
+            return []
+
+        excludes = []
+        if exclude_ids:
+            excludes = [panel.bond_index[bond_id] for bond_id in exclude_ids if bond_id in panel.bond_index]
+
+        # 第一级筛选直接用缓存的排名, 要排除的转债最多占掉len(excludes)个位置, 所以多取这么多
+        keys, limit = self.stages[0]
+        limit = count if limit is None else limit
+        extra = len(excludes) if self.exclude_stage == 0 else 0
+        candidates = panel.get_stage_ranks(self.filters, keys, limit + extra)[i]
+        candidates = candidates[candidates >= 0]
+        if extra > 0:
+            candidates = candidates[~np.isin(candidates, excludes)]
+        candidates = candidates[0:limit]
+
+        # 后面几级筛选的候选很少, 直接排序
+        for k, (keys, limit) in enumerate(self.stages[1:], 1):
+            if k == self.exclude_stage and excludes:
+                candidates = candidates[~np.isin(candidates, excludes)]
+            candidates = panel.top(i, candidates, keys, count if limit is None else limit)
+
+        return panel.build_rows(i, candidates)
+
+    def warm(self, panel, count):
+        # count: 最多需要买入的数量, 调仓时最多还要排除同样多的持有转债
+        keys, limit = self.stages[0]
+        panel.get_stage_ranks(self.filters, keys, (count if limit is None else limit) + count)
+
+    def query_rows(self, cur, day, count, exclude_ids=None):
+        # 查库选债, 连接上需要先注册is_eligible函数(见eligibility.Eligibility.install)
+        params = {"current": day, "count": count}
+        ids = parse_bond_ids_params(exclude_ids or [], params)
+        cur.execute(self.build_sql(ids), params)
+        return cur.fetchall()
+
+    def build_sql(self, ids):
+        where = ["last_chg_dt = :current",
+                 "is_eligible(bond_id, :current)",
+                 "price is not NULL"]
+        for field, op, value in self.filters:
+            where.append(fields[field] + " " + op + " " + str(value))
+
+        sql = "select * from cb_history where " + " and ".join(where)
+        for k, (keys, limit) in enumerate(self.stages):
+            if k == self.exclude_stage and ids != '':
+                sql = "select * from (" + sql + ") where bond_id not in (" + ids + ")"
+            order_by = self.build_order_by(keys)
+            limit = ':count' if limit is None else str(limit)
+            if k == len(self.stages) - 1:
+                sql = """select bond_id, bond_nm, price, premium_rt, round(price + premium_rt * 100, 2)
+                from (""" + sql + ") order by " + order_by + " limit " + limit
+            else:
+                sql = "select * from (" + sql + ") order by " + order_by + " limit " + limit
+        return sql
+
+    @staticmethod
+    def build_order_by(keys):
+        order_by = []
+        for key in keys:
+            if key.startswith('-'):
+                order_by.append(fields[key[1:]] + " desc")
+            else:
+                order_by.append(fields[key])
+        # 和面板一样, 相同的按bond_id排(不然取决于查库时的扫描顺序)
+        order_by.append("bond_id")
+        return ", ".join(order_by)
+
+
+def compile_strategy_specs(specs):
+    return {name: (CompiledSelector(spec['start']), CompiledSelector(spec['push'])) for name, spec in specs.items()}
+
+
+# 编译好的各策略选债规则: (建仓, 调仓)
+strategy_selectors = compile_strategy_specs(strategy_specs)
@@ -0,0 +1,119 @@
+# 回测断点
+# 每组回测参数跑完后, 把最后一个交易日的组合状态(持仓/零头/轮动计数/收益率曲线)保存下来,
+# 下次有了新数据可以从断点接着跑, 不用再从头回测
+# 断点里记下当时用到的数据的版本(最后那天及之前的行情 + 强赎/退市), 这些数据改过的话断点作废, 从头再跑
+import hashlib
+import json
+
+from backtest.eligibility import get_eligibility_version
+from utils import db_utils
+from utils.trade_calendar import parse_day, get_trade_calendar
+
+
+def create_checkpoint_table(cur):
+    cur.execute("""
+        create table if not exists cb_backtest_checkpoint(
+            key text PRIMARY KEY,
+            name text NOT NULL,
+            last_dt text NOT NULL,
+            day_idx int NOT NULL,
+            data_version text,
+            data text NOT NULL
+        )""")
+    # 之前建的表没有data_version, 补上(原来的断点没有版本, 都会作废)
+    cur.execute("PRAGMA table_info(cb_backtest_checkpoint)")
+    if 'data_version' not in [row[1] for row in cur.fetchall()]:
+        cur.execute("alter table cb_backtest_checkpoint add column data_version text")
+
+
+def get_history_version(cur, last_dt):
+    # last_dt及之前的行情的校验和, 选债用到的字段都算上, 再按bond_id加权一份, 数据挪到别的转债上也能发现
+    # 都换成整数求和, 结果和扫描的顺序无关
+    cur.execute("""
+        select count(*),
+               sum(cast(round(price * 1000) as integer)),
+               sum(cast(round(price * 1000) as integer) * bond_id),
+               sum(cast(round(premium_rt * 100000) as integer)),
+               sum(cast(round(ytm_rt * 100000) as integer)),
+               sum(cast(round(curr_iss_amt * 1000) as integer))
+        from cb_history
+        where last_chg_dt <= :last_dt
+    """, {'last_dt': str(last_dt)})
+    return cur.fetchone()
+
+
+def get_data_version(cur, last_dt, versions):
+    """断点依赖的数据的版本, versions: {last_dt: 版本}, 同一天的断点只算一次"""
+    key = str(last_dt)
+    if key not in versions:
+        versions[key] = json.dumps([get_history_version(cur, key), get_eligibility_version(cur)])
+    return versions[key]
+
+
+def get_checkpoint_key(config, start, spec):
+    # 选债规则变了, 之前的断点也就作废了
+    params = [config.strategy_type, config.roll_period, config.bond_count, config.max_price, config.max_rise,
+              config.max_double_low, config.pre_day, str(start), spec]
+    return hashlib.md5(json.dumps(params, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def get_checkpoint_name(config, start):
+    return config.strategy_type + "_" + str(config.roll_period) + "日轮动_" + str(config.bond_count) + "只_" \
+           + start.strftime('%Y-%m-%d')
+
+
+def load_checkpoints(keys):
+    checkpoints = {}
+    if len(keys) == 0:
+        return checkpoints
+
+    calendar = get_trade_calendar()
+    with db_utils.get_daily_connect() as con:
+        cur = con.cursor()
+        create_checkpoint_table(cur)
+        cur.execute("select key, last_dt, day_idx, data_version, data from cb_backtest_checkpoint")
+        versions = {}
+        for key, last_dt, day_idx, data_version, data in cur.fetchall():
+            if key not in keys:
+                continue
+            # 最后那天之前的数据有变化(比如补了数据, 改了价格或强赎日期), 断点就不准了, 从头再跑
+            if calendar.index_of(last_dt) != day_idx or get_data_version(cur, last_dt, versions) != data_version:
+                print('checkpoint is expired. key:' + key)
+                continue
+            checkpoints[key] = decode_state(data)
+    return checkpoints
+
+
+def save_checkpoints(items):
+    # items: [(key, name, state)]
+    calendar = get_trade_calendar()
+    with db_utils.get_daily_connect() as con:
+        cur = con.cursor()
+        create_checkpoint_table(cur)
+        versions = {}
+        for key, name, state in items:
+            last_dt = state['trade_day']
+            cur.execute("insert or replace into cb_backtest_checkpoint(key, name, last_dt, day_idx, data_version, data) values(:key, :name, :last_dt, :day_idx, :data_version, :data)",
+                        {"key": key, "name": name, "last_dt": str(last_dt), "day_idx": calendar.index_of(last_dt),
+                         "data_version": get_data_version(cur, last_dt, versions), "data": encode_state(state)})
+    print('save backtest checkpoints: ' + str(len(items)))
+
+
+def encode_state(state):
+    test_result = state['test_result']
+    data = dict(state)
+    data['test_result'] = {k: v for k, v in test_result.items() if k not in ('rows', 'roll_rows')}
+    data['test_result']['rows'] = [[str(day), row] for day, row in test_result['rows'].items()]
+    for name in ('previous_day', 'trade_day'):
+        data[name] = str(state[name])
+    return json.dumps(data, ensure_ascii=False)
+
+
+def decode_state(data):
+    state = json.loads(data)
+    test_result = state['test_result']
+    test_result['rows'] = {parse_day(day): row for day, row in test_result['rows']}
+    test_result['roll_rows'] = {}
+    for name in ('previous_day', 'trade_day'):
+        state[name] = parse_day(state[name])
+    return state
@@ -0,0 +1,107 @@
+# 自定义回测的后台任务
+# 提交后马上返回任务id, 回测在后台线程中执行, 进度通过Task表(/get_task_data.html)查看, 完成后再取结果
+# 参数完全一样(且数据没有更新)的回测只跑一次, 重复提交直接复用结果
+import collections
+import concurrent.futures
+import hashlib
+import json
+import logging
+import threading
+
+from flask import current_app
+
+from backtest import jsl_test
+from models import db, Task
+from utils.task_utils import start_task, process_task_when_normal, process_task_when_error, \
+    process_task_when_finish, delete_tasks
+from utils.trade_calendar import get_trade_calendar
+
+# 一次只跑一个任务, 其他的排队
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+# 回测在任务线程里用run_multi_test跑, 不开进程池: web服务是多线程的, 从线程里fork出来的子进程可能卡在继承来的锁上
+job_workers = 1
+
+# 最多保留多少个任务的结果
+max_jobs = 50
+
+# {job_id: {"status": 0执行中/1完成/-1失败, "html": 结果, "desc": 出错信息}}
+jobs = collections.OrderedDict()
+jobs_lock = threading.Lock()
+
+
+def get_job_id(params):
+    # 有新数据之后, 同样的参数结果也不一样了
+    calendar = get_trade_calendar()
+    last_day = calendar.days[-1] if len(calendar) > 0 else None
+    data = dict(params)
+    data['data_version'] = last_day
+    return hashlib.md5(json.dumps(data, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+
+def get_task_name(job_id):
+    return 'custom_back_test_' + job_id
+
+
+def submit_back_test(params):
+    """params: jsl_test.test_group的参数, 返回任务id"""
+    # 参数有问题(比如表达式写错了)直接报错, 不生成任务
+    configs, line_names = jsl_test.build_test_configs(params['strategy_types'], params['is_single_strategy'],
+                                                      params['roll_period'], params['bond_count'],
+                                                      select_expr=params.get('select_expr'),
+                                                      exchange_expr=params.get('exchange_expr'))
+    job_id = get_job_id(params)
+    with jobs_lock:
+        job = jobs.get(job_id)
+        # 正在跑或者已经跑完的, 直接复用
+        if job is not None and job['status'] != -1:
+            jobs.move_to_end(job_id)
+            return job_id
+
+        jobs[job_id] = {"status": 0, "html": None, "desc": None}
+        evicted = evict_jobs()
+
+    delete_tasks([get_task_name(evicted_id) for evicted_id in evicted])
+    start_task(len(configs), get_task_name(job_id))
+
+    executor.submit(run_back_test, current_app._get_current_object(), job_id, params)
+    return job_id
+
+
+def evict_jobs():
+    """超过max_jobs时从最早的开始去掉已经结束的任务(排队/执行中的不动), 返回去掉的任务id, 需要在jobs_lock里调用"""
+    evicted = []
+    for job_id in list(jobs.keys()):
+        if len(jobs) <= max_jobs:
+            break
+        if jobs[job_id]['status'] != 0:
+            del jobs[job_id]
+            evicted.append(job_id)
+    return evicted
+
+
+def run_back_test(app, job_id, params):
+    with app.app_context():
+        task = db.session.query(Task).filter(Task.name == get_task_name(job_id)).first()
+        try:
+            html = jsl_test.test_group(on_progress=lambda num: process_task_when_normal(task, num),
+                                       workers=job_workers, **params)
+            update_job(job_id, 1, html=html)
+            process_task_when_finish(task, "回测完成")
+        except BaseException as e:
+            logging.exception(e)
+            update_job(job_id, -1, desc=str(e))
+            process_task_when_error(task, 'occur error:' + str(e))
+        finally:
+            db.session.remove()
+
+
+def update_job(job_id, status, html=None, desc=None):
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is not None:
+            job.update(status=status, html=html, desc=desc)
+
+
+def get_job(job_id):
+    with jobs_lock:
+        return jobs.get(job_id)
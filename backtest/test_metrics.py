@@ -0,0 +1,112 @@
+# 回测指标
+# 所有回测线的资金曲线放在一个二维数组里(回测线 x 交易日), 一次算出最大回撤(及起止日期)/年化收益/波动率/夏普/卡玛/换手率
+import numpy as np
+
+# 每年的交易日数
+trade_days_per_year = 252
+
+
+def fill_forward(values):
+    """回测线 x 交易日, nan用前一天的值补上, 开头的nan用第一个有效值补上"""
+    values = np.array(values, dtype=np.float64, ndmin=2)
+    n = values.shape[1]
+    valid = ~np.isnan(values)
+    idx = np.where(valid, np.arange(n)[None, :], 0)
+    np.maximum.accumulate(idx, axis=1, out=idx)
+    values = values[np.arange(len(values))[:, None], idx]
+
+    first = valid.argmax(axis=1)
+    first_values = values[np.arange(len(values)), first]
+    head = np.arange(n)[None, :] < first[:, None]
+    return np.where(head, first_values[:, None], values)
+
+
+def calc_max_drawdown(moneys):
+    """返回每条回测线的 最大回撤(%), 开始回撤的下标(最高点), 回撤结束的下标(最低点)"""
+    moneys = fill_forward(moneys)
+    peaks = np.maximum.accumulate(moneys, axis=1)
+    drawdowns = np.where(peaks > 0, 1 - moneys / np.where(peaks > 0, peaks, 1), 0)
+    low_idx = drawdowns.argmax(axis=1)
+    # 最低点之前的最高点
+    before_low = np.arange(moneys.shape[1])[None, :] <= low_idx[:, None]
+    high_idx = np.where(before_low, moneys, -np.inf).argmax(axis=1)
+    max_drawdown = np.round(drawdowns[np.arange(len(moneys)), low_idx] * 100, 2)
+    return max_drawdown, high_idx, low_idx
+
+
+def calc_max_money_drawdown(rates, moneys):
+    """
+    图例里的最大回撤(和原来get_max_drawdown的算法一致): 按收益率找最高点, 取回撤金额最大的一段(金额一样的取后面的),
+    返回每条回测线的 回撤(占最高点金额的%), 最高点的下标, 最低点的下标
+    """
+    rates = fill_forward(rates)
+    moneys = fill_forward(moneys)
+    n = moneys.shape[1]
+    rows = np.arange(len(moneys))
+    # 收益率创新高(或持平)的是最高点, 每天对应的是之前最近的那个最高点
+    is_peak = rates >= np.maximum.accumulate(rates, axis=1)
+    peak_idx = np.maximum.accumulate(np.where(is_peak, np.arange(n)[None, :], 0), axis=1)
+    peak_moneys = moneys[rows[:, None], peak_idx]
+    amounts = np.where(is_peak, 0, np.round(peak_moneys - moneys, 2))
+    low_idx = n - 1 - amounts[:, ::-1].argmax(axis=1)
+    high_idx = peak_idx[rows, low_idx]
+    max_drawdown = np.round(amounts[rows, low_idx] / moneys[rows, high_idx] * 100, 2)
+    return max_drawdown, high_idx, low_idx
+
+
+def calc_metrics(days, moneys, buy_moneys=None, risk_free_rate=0):
+    """
+    days: 交易日(升序)
+    moneys: 回测线 x 交易日 的总金额, 没有数据的为nan
+    buy_moneys: 回测线 x 交易日 的累计买入金额(用来算换手率)
+    risk_free_rate: 无风险年化收益率(%)
+    返回每条回测线的指标[{...}]
+    """
+    moneys = fill_forward(moneys)
+    lines = len(moneys)
+    if lines == 0 or len(days) == 0:
+        return []
+
+    max_drawdown, high_idx, low_idx = calc_max_drawdown(moneys)
+
+    years = max((days[-1] - days[0]).days / 365.0, 1 / 365.0)
+    total_return = moneys[:, -1] / moneys[:, 0] - 1
+    annual_return = (1 + total_return) ** (1 / years) - 1
+
+    day_returns = moneys[:, 1:] / moneys[:, :-1] - 1
+    if day_returns.shape[1] > 1:
+        day_std = day_returns.std(axis=1, ddof=1)
+        day_mean = day_returns.mean(axis=1)
+    else:
+        day_std = np.zeros(lines)
+        day_mean = np.zeros(lines)
+    volatility = day_std * np.sqrt(trade_days_per_year)
+    excess_return = day_mean * trade_days_per_year - risk_free_rate / 100
+    sharpe = np.divide(excess_return, volatility, out=np.zeros(lines), where=volatility > 0)
+    calmar = np.divide(annual_return * 100, max_drawdown, out=np.zeros(lines), where=max_drawdown > 0)
+
+    turnover = np.zeros(lines)
+    if buy_moneys is not None:
+        buy_moneys = fill_forward(buy_moneys)
+        buy_total = np.nan_to_num(buy_moneys[:, -1] - buy_moneys[:, 0])
+        # 年换手率: 一年里买入的金额是平均资金的几倍
+        turnover = buy_total / moneys.mean(axis=1) / years
+
+    metrics = []
+    for i in range(lines):
+        # 没有任何数据的回测线(比如一直没选出转债)
+        if np.isnan(moneys[i, 0]):
+            metrics.append(None)
+            continue
+        metrics.append({
+            'max_drawdown': float(max_drawdown[i]),
+            'max_drawdown_start': days[high_idx[i]].strftime('%Y-%m-%d'),
+            'max_drawdown_end': days[low_idx[i]].strftime('%Y-%m-%d'),
+            'total_return': round(float(total_return[i]) * 100, 2),
+            'annual_return': round(float(annual_return[i]) * 100, 2),
+            'volatility': round(float(volatility[i]) * 100, 2),
+            'sharpe': round(float(sharpe[i]), 2),
+            'calmar': round(float(calmar[i]), 2),
+            'turnover': round(float(turnover[i]), 2),
+        })
+    return metrics
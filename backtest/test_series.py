@@ -0,0 +1,180 @@
+# 回测结果的存储
+# 只保存各回测线的收益率/总金额/累计买入金额序列(float32)和日期下标, 以及各回测线的指标, 页面访问时再按需生成图表,
+# 生成好的html按版本缓存, 回测结果更新后才重新生成
+import datetime
+import json
+
+import numpy as np
+
+from backtest.test_metrics import calc_metrics
+from backtest.test_utils import get_back_test_data, build_series, series_fields
+from backtest.view_test import generate_series_html
+from utils import db_utils
+
+# 已生成的html {name: (version, html)}
+html_cache = {}
+
+
+def create_series_table(cur):
+    cur.execute("""
+        create table if not exists cb_backtest_series(
+            name text PRIMARY KEY,
+            version int NOT NULL,
+            meta text NOT NULL,
+            dates blob NOT NULL,
+            data blob NOT NULL
+        )""")
+
+
+def new_chart(results, roll_period, bond_count, strategy_types, is_single_strategy, line_names):
+    """一张回测图, results和line_names一一对应"""
+    return {
+        'roll_period': roll_period,
+        'bond_count': bond_count,
+        'strategy_types': list(strategy_types),
+        'is_single_strategy': is_single_strategy,
+        'line_names': list(line_names),
+        'results': results,
+    }
+
+
+def save_back_test_series(name, start, end, charts):
+    if end is None:
+        end = datetime.datetime.now()
+
+    # 回测会一直跑到最新的数据, 只保存start~end这段, 指标也只按这段算
+    days, data = build_series([rows for chart in charts for rows in chart['results']], start, end)
+
+    meta = {
+        'start': start.strftime('%Y-%m-%d'),
+        'end': end.strftime('%Y-%m-%d'),
+        'fields': series_fields,
+        'charts': [],
+    }
+    i = 0
+    for chart in charts:
+        size = len(chart['results'])
+        chart_meta = {k: v for k, v in chart.items() if k != 'results'}
+        # 各回测线的指标
+        chart_meta['metrics'] = calc_metrics(days, data[i:i + size, :, 1], data[i:i + size, :, 2])
+        meta['charts'].append(chart_meta)
+        i += size
+
+    dates = np.array([day.toordinal() for day in days], dtype=np.int32).tobytes()
+    data = data.astype(np.float32).tobytes()
+
+    with db_utils.get_daily_connect() as con:
+        cur = con.cursor()
+        create_series_table(cur)
+        cur.execute("select version from cb_backtest_series where name=:name", {"name": name})
+        row = cur.fetchone()
+        version = 1 if row is None else row[0] + 1
+        cur.execute("insert or replace into cb_backtest_series(name, version, meta, dates, data) values(:name, :version, :meta, :dates, :data)",
+                    {"name": name, "version": version, "meta": json.dumps(meta, ensure_ascii=False),
+                     "dates": dates, "data": data})
+    print('save cb_backtest_series is successful. name:' + name + ', size:' + str(len(dates) + len(data)))
+
+
+def load_back_test_series(name, cur=None):
+    """
+    保存的回测序列: 指标等信息 + days(交易日) + data(回测线 x 交易日 x 字段, 没有数据的为nan),
+    每张图的chart['data']是其中几条回测线
+    """
+    if cur is None:
+        with db_utils.get_daily_connect() as con:
+            return load_back_test_series(name, con.cursor())
+
+    create_series_table(cur)
+    cur.execute("select version, meta, dates, data from cb_backtest_series where name=:name", {"name": name})
+    row = cur.fetchone()
+    if row is None:
+        return None
+
+    version, meta, dates, data = row
+    series = json.loads(meta)
+    series['version'] = version
+    # 以前保存的只有收益率和总金额
+    series.setdefault('fields', ['all_rate', 'total_money'])
+    days = [datetime.datetime.fromordinal(int(d)) for d in np.frombuffer(dates, dtype=np.int32)]
+    data = np.frombuffer(data, dtype=np.float32).reshape(-1, len(days), len(series['fields']))
+    # 存的是float32, 还原成两位小数
+    series['days'] = days
+    series['data'] = np.round(data.astype(np.float64), 2)
+    i = 0
+    for chart in series['charts']:
+        size = len(chart['line_names'])
+        chart['data'] = series['data'][i:i + size]
+        i += size
+    return series
+
+
+def get_back_test_html(name):
+    with db_utils.get_daily_connect() as con:
+        cur = con.cursor()
+        create_series_table(cur)
+        cur.execute("select version from cb_backtest_series where name=:name", {"name": name})
+        row = cur.fetchone()
+        # 还没有保存过序列的, 用以前生成好的html
+        if row is None:
+            return get_back_test_data(name)
+
+        cached = html_cache.get(name)
+        if cached is not None and cached[0] == row[0]:
+            return cached[1]
+
+        series = load_back_test_series(name, cur)
+
+    html = render_back_test_html(series)
+    html_cache[name] = (series['version'], html)
+    return html
+
+
+def render_back_test_html(series):
+    start = datetime.datetime.strptime(series['start'], '%Y-%m-%d')
+    end = datetime.datetime.strptime(series['end'], '%Y-%m-%d')
+    rate_idx = series['fields'].index('all_rate')
+    money_idx = series['fields'].index('total_money')
+    # 回测会一直跑到最新的数据, 图上只画start~end这段
+    in_range = [k for k, day in enumerate(series['days']) if start <= day <= end]
+    days = [series['days'][k] for k in in_range]
+    charts = series['charts']
+    content = ''
+    for chart in charts:
+        data = chart['data'][:, in_range]
+        content += generate_series_html(days, data[:, :, rate_idx], data[:, :, money_idx],
+                                        start, end, chart['roll_period'], chart['bond_count'],
+                                        chart['strategy_types'], chart['is_single_strategy'], chart['line_names'])
+    return '<br/><br/>' + content if len(charts) > 1 else content
+
+
+def get_back_test_series_data(name):
+    """给其他地方直接用的回测序列: 日期 + 各回测线的收益率/总金额, 没有数据的为None"""
+    series = load_back_test_series(name)
+    if series is None:
+        return None
+
+    rate_idx = series['fields'].index('all_rate')
+    money_idx = series['fields'].index('total_money')
+    charts = []
+    for chart in series['charts']:
+        lines = []
+        for line_name, values in zip(chart['line_names'], chart['data']):
+            lines.append({'name': line_name,
+                          'rate': to_list(values[:, rate_idx]),
+                          'money': to_list(values[:, money_idx])})
+        chart = {k: v for k, v in chart.items() if k != 'data'}
+        chart['lines'] = lines
+        charts.append(chart)
+
+    return {
+        'name': name,
+        'version': series['version'],
+        'start': series['start'],
+        'end': series['end'],
+        'dates': [day.strftime('%Y-%m-%d') for day in series['days']],
+        'charts': charts,
+    }
+
+
+def to_list(values):
+    return [None if np.isnan(value) else value for value in values.tolist()]
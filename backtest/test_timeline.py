@@ -0,0 +1,121 @@
+# 回测持仓时间线
+# 不再每天存一份{转债名: 金额}, 只记录持仓的变化(买入/卖出/调仓/价格变动), 事件按顺序放在几个紧凑的数组里,
+# 画图时再按天(或按周/按月抽样)回放出每一帧的持仓
+import datetime
+from array import array
+
+from utils.trade_calendar import parse_day
+
+# 事件类型
+EVENT_OPEN = 0
+EVENT_CLOSE = 1
+EVENT_RESIZE = 2
+EVENT_PRICE = 3
+
+# 自动抽样时最多画多少帧
+max_auto_frames = 260
+
+
+class HoldingsRecorder:
+
+    def __init__(self):
+        # 记录过的交易日(ordinal)
+        self.days = array('i')
+        # 转债名 <=> 下标
+        self.names = []
+        self.name_index = {}
+        # 事件: 第几个交易日, 类型, 转债下标, 数量, 价格
+        self.event_days = array('i')
+        self.event_types = array('b')
+        self.event_bonds = array('i')
+        self.event_amounts = array('q')
+        self.event_prices = array('d')
+        # 当前持仓 {转债下标: (数量, 价格)}
+        self.current = {}
+
+    def __len__(self):
+        return len(self.days)
+
+    def get_bond_index(self, name):
+        i = self.name_index.get(name)
+        if i is None:
+            i = len(self.names)
+            self.names.append(name)
+            self.name_index[name] = i
+        return i
+
+    def add_event(self, event_type, bond, amount, price):
+        self.event_days.append(len(self.days) - 1)
+        self.event_types.append(event_type)
+        self.event_bonds.append(bond)
+        self.event_amounts.append(amount)
+        self.event_prices.append(price)
+
+    def record(self, day, group):
+        """记录某个交易日收盘后的持仓, 同一天只记第一次"""
+        ordinal = parse_day(day).toordinal()
+        if len(self.days) > 0 and self.days[-1] == ordinal:
+            return
+        self.days.append(ordinal)
+
+        holdings = {}
+        for bond in group.values():
+            holdings.setdefault(self.get_bond_index(bond['bond_nm']), (bond['amount'], bond['price']))
+
+        for i, (amount, price) in holdings.items():
+            old = self.current.get(i)
+            if old is None:
+                self.add_event(EVENT_OPEN, i, amount, price)
+            elif old[0] != amount:
+                self.add_event(EVENT_RESIZE, i, amount, price)
+            elif old[1] != price:
+                self.add_event(EVENT_PRICE, i, amount, price)
+        for i in self.current.keys() - holdings.keys():
+            self.add_event(EVENT_CLOSE, i, 0, 0)
+        self.current = holdings
+
+    def get_frame_days(self, freq='day'):
+        """要画的帧(交易日下标), freq: day/week/month, 按周/按月时取每周/每月最后一个交易日"""
+        if freq == 'day':
+            return list(range(len(self.days)))
+        if freq == 'week':
+            key = lambda d: d.isocalendar()[0:2]
+        elif freq == 'month':
+            key = lambda d: (d.year, d.month)
+        else:
+            raise Exception('unknown timeline freq: ' + str(freq))
+
+        frames = []
+        last_key = None
+        for i, ordinal in enumerate(self.days):
+            k = key(datetime.date.fromordinal(ordinal))
+            if k == last_key:
+                frames[-1] = i
+            else:
+                frames.append(i)
+                last_key = k
+        return frames
+
+    def get_auto_freq(self):
+        # 天数太多时按周/按月抽样, 页面不至于太大
+        for freq in ['day', 'week', 'month']:
+            if len(self.get_frame_days(freq)) <= max_auto_frames:
+                return freq
+        return 'month'
+
+    def frames(self, freq='day'):
+        """按顺序回放事件, 只在要画的交易日生成一帧: (日期, {转债名: 投入资金})"""
+        if freq == 'auto':
+            freq = self.get_auto_freq()
+        holdings = {}
+        k = 0
+        n = len(self.event_days)
+        for i in self.get_frame_days(freq):
+            while k < n and self.event_days[k] <= i:
+                if self.event_types[k] == EVENT_CLOSE:
+                    holdings.pop(self.event_bonds[k], None)
+                else:
+                    holdings[self.event_bonds[k]] = (self.event_amounts[k], self.event_prices[k])
+                k += 1
+            day = datetime.datetime.fromordinal(self.days[i])
+            yield day, {self.names[j]: int(price * amount) for j, (amount, price) in holdings.items()}
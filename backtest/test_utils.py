@@ -1,24 +1,18 @@
-import datetime
 import math
 
+import numpy as np
+
 from utils import db_utils
+from utils.trade_calendar import get_trade_calendar
+
+
+# 每条回测线每天的结果字段
+series_fields = ['all_rate', 'total_money', 'buy_money']
 
 
 # 获取下一个交易日
 def get_next_day(current, cur=None):
-    if cur is None:
-        cur = db_utils.get_daily_connect().cursor()
-
-    cur.execute("""
-                SELECT min(DISTINCT (last_chg_dt))
-                from cb_history
-                where last_chg_dt > :current and price is not NULL
-                order by last_chg_dt            
-        """, {"current": current})
-    next_day = cur.fetchone()[0]
-    if next_day is not None:
-        return datetime.datetime.strptime(next_day, '%Y-%m-%d %H:%M:%S')
-    return None
+    return get_trade_calendar(cur).next_day(current)
 
 
 # 计算收益率并保存到结果中
@@ -31,7 +25,8 @@ def calc_test_result(test_result, current_total_money, current_day, previous_day
 
     all_rate = round(100 * (current_total_money - start_total_money) / start_total_money, 2)
     test_result['rows'].setdefault(current_day, {"total_money": current_total_money,
-                                                 "day_rate": day_rate, "all_rate": all_rate})
+                                                 "day_rate": day_rate, "all_rate": all_rate,
+                                                 "buy_money": test_result.get('buy_money', 0)})
 
 
 def get_pre_total_money(previous_day, test_result):
@@ -42,11 +37,14 @@ def init_test_result(day, total_money, remain_money):
     return {
         "start_total_money": total_money,
         'remain_money': remain_money,
+        # 累计买入的金额(不含建仓), 用来算换手率
+        'buy_money': 0,
         'rows': {
             day: {
                 'total_money': total_money,
                 'day_rate': 0,
-                'all_rate': 0
+                'all_rate': 0,
+                'buy_money': 0
             }
         },
         'roll_rows': {
@@ -103,34 +101,24 @@ def update_bond(group, rows):
             bond['old_price'] = old_price
 
 
-def get_max_drawdown(x, rates, moneys):
-    drawdowns = {}
-    max_money = moneys[0]
-    max_rate = rates[0]
-    low_idx = 0
-    high_idx = 0
-    for i in range(len(rates)):
-        if rates[i] >= max_rate:
-            high_idx = i
-            drawdowns[0] = {"low_idx": low_idx, "high_idx": high_idx}
-            max_money = moneys[i]
-            max_rate = rates[i]
-        else:
-            low_idx = i
-            drawdown = round(max_money - moneys[i], 2)
-            drawdowns[drawdown] = {"low_idx": low_idx, "high_idx": high_idx}
-    max_drawdown = max(drawdowns.keys())
-    idx = drawdowns[max_drawdown]
-    high_value = moneys[idx['high_idx']]
-    low_value = moneys[idx['low_idx']]
-    max_drawdown_rate = round(max_drawdown / high_value * 100, 2)
-    print(str(max_drawdown_rate) + "%:" + str(x[idx['high_idx']]) + "(" + str(high_value) + ")~" + str(
-        x[idx['low_idx']]) + "(" + str(low_value) + ")")
-    return max_drawdown_rate, idx['high_idx'], idx['low_idx'], max_rate
+def build_series(results, start=None, end=None):
+    """
+    各回测线的结果{day: {all_rate, total_money, buy_money}} => 共用的交易日 + 回测线 x 交易日 x 字段(series_fields),
+    没有数据的为nan, start/end不为None时只取这段时间的
+    """
+    days = sorted({day for rows in results for day in rows.keys()
+                   if (start is None or day >= start) and (end is None or day <= end)})
+    day_index = {day: i for i, day in enumerate(days)}
+    data = np.full((len(results), len(days), len(series_fields)), np.nan)
+    for k, rows in enumerate(results):
+        items = [(day_index[day], row) for day, row in rows.items() if day in day_index]
+        if len(items) == 0:
+            continue
+        data[k, [i for i, row in items]] = [[row.get(field, np.nan) for field in series_fields] for i, row in items]
+    return days, data
 
 
 def get_back_test_data(name):
-    with db_utils.get_daily_connect() as con:
-        cur = con.cursor()
+    with db_utils.daily_connection() as cur:
         cur.execute("select data from cb_backtest_data where name=:name", {"name": name})
         return cur.fetchone()[0]
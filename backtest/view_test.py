@@ -1,15 +1,20 @@
 import datetime
 import json
 
+import numpy as np
 from pyecharts import options as opts
 from pyecharts.charts import Line, Timeline, Bar
 from pyecharts.globals import ThemeType
 
-from backtest.test_utils import get_max_drawdown
+from backtest.test_metrics import calc_max_money_drawdown, fill_forward
+from backtest.test_utils import build_series
 from utils.html_utils import env
 
 # from empyrical import max_drawdown, alpha_beta
 
+# fixme 这里先写死, 总投入可能做成一个配置变量
+start_total_money = 1000000
+
 # fixme 手工更新
 index_date = ['2017-12-29', '2018-01-02', '2018-01-03', '2018-01-04', '2018-01-05', '2018-01-08', '2018-01-09',
               '2018-01-10', '2018-01-11', '2018-01-12', '2018-01-15', '2018-01-16', '2018-01-17', '2018-01-18',
@@ -491,12 +496,13 @@ def get_data():
     print(json.dumps(idx_data))
 
 
-def generate_timeline_html(time_data):
+def generate_timeline_html(timeline, freq='auto'):
+    """timeline: 回测过程中记录的持仓(HoldingsRecorder), freq: day/week/month, auto时天数太多会按周/按月抽样"""
     tl = Timeline()
     tl.add_schema(is_auto_play=False,
                   play_interval=500,
                   is_loop_play=False)
-    for date, bonds in time_data.items():
+    for date, bonds in timeline.frames(freq):
         _date = datetime.datetime.strftime(date, '%Y-%m-%d')
         x = []
         y = []
@@ -522,11 +528,39 @@ def generate_timeline_html(time_data):
     return "<center>" + tl.render_embed('template.html', env) + "</center>"
 
 
-def generate_line_html(rows, period, start, end, bond_num, line_names=[], title=None):
+def generate_test_group_html(results, start, end, roll_period, bond_count, strategy_types, is_single_strategy,
+                             line_names):
+    if end is None:
+        end = datetime.datetime.now()
+
+    days, data = build_series(results, start, end)
+    return generate_series_html(days, data[:, :, 0], data[:, :, 1], start, end, roll_period, bond_count,
+                                strategy_types, is_single_strategy, line_names)
+
+
+def generate_series_html(days, rates, moneys, start, end, roll_period, bond_count, strategy_types, is_single_strategy,
+                         line_names):
+    """days: 共用的交易日, rates/moneys: 回测线 x 交易日 的收益率/总金额, 没有数据的为nan"""
+    title = strategy_types[0] + "回测结果" if is_single_strategy else None
+    roll_period = None if is_single_strategy else roll_period
+    return generate_line_html(days, fill_line_values(rates, 0), fill_line_values(moneys, start_total_money),
+                              roll_period, start, end, bond_count, line_names, title=title)
+
+
+def fill_line_values(values, default):
+    # 没有数据的交易日沿用前一天的值, 还没开始的用default
+    values = np.array(values, dtype=np.float64, ndmin=2)
+    if values.size == 0:
+        return values
+    head = np.cumsum(~np.isnan(values), axis=1) == 0
+    return fill_forward(np.where(head, default, values))
+
+
+def generate_line_html(days, rates, moneys, period, start, end, bond_num, line_names=[], title=None):
     # 用散点图展示
     line = Line(opts.InitOpts(height='700px', width='1424px', theme=ThemeType.LIGHT))
 
-    x, data = get_line_data(rows, line_names)
+    x, data = get_line_data(days, rates, moneys, line_names)
     # i = 0
     # y1_max = None
     # y1_min = None
@@ -629,57 +663,58 @@ def get_subtitle(bond_num, end, period, start):
         s += ", " + str(bond_num) + "只可转债, " + str(period) + "个交易日轮动"
     return s
 
-def get_line_data(rows, line_names=[]):
+def get_line_data(days, rates, moneys, line_names=[]):
+    x = [datetime.datetime.strftime(date, '%Y-%m-%d') for date in days]
+
+    # 回测线 x 交易日
+    rates = np.round(np.reshape(rates, (len(line_names), len(x))), 2)
+    moneys = np.reshape(moneys, (len(line_names), len(x)))
+    # 一条数据都没有
+    if len(x) == 0:
+        return x, []
+
+    index_rates, index_moneys = get_index_line_data(x)
+    names = list(line_names) + ['可转债等权指数']
+    rates = np.vstack([rates, [index_rates]])
+    moneys = np.vstack([moneys, [index_moneys]])
+
+    mdds, high_idx, low_idx = calc_max_money_drawdown(rates, moneys)
+    max_profits = rates.max(axis=1)
+
     data = []
-    x = []
-    base = None
-    price_value = 0
-    original_price = 1000
+    for i, line in enumerate(names):
+        line_rates = rates[i].tolist()
+        current_rate = line_rates[-1]
+        data.append(
+            [line
+             + "(最大回撤:" + str(mdds[i]) + "%, "
+             + "最高收益:" + str(max_profits[i]) + "%, "
+             + "当前收益:" + str(current_rate) + "%)",
+             line_rates, current_rate])
 
-    lines_data = {}
-    for line_name in line_names:
-        lines_data.setdefault(line_name, {"rate": [], "money": []})
+    data = sorted(data, key=lambda d: d[2], reverse=True)
+    return x, data
 
-    index_line_data = {"rate": [], "money": []}
-    for date, value in rows.items():
-        price = idx_data.get(datetime.datetime.strftime(date, '%Y-%m-%d'))
 
+def get_index_line_data(x):
+    # 可转债等权指数, 没有数据的日期沿用前一天的值
+    base = None
+    price_value = 0
+    original_price = 1000
+    rates = []
+    moneys = []
+    for date in x:
+        price = idx_data.get(date)
         if base is None:
             if price is not None:
                 base = price
 
-        x.append(datetime.datetime.strftime(date, '%Y-%m-%d'))
-
-        i = 0
-        for v in lines_data.values():
-            v['rate'].append(value[i][0])
-            v['money'].append(value[i][1])
-            i += 1
-
         if price is not None:
             price_value = round((price - base) / base * 100, 2)
             original_price = price
-        index_line_data['rate'].append(price_value)
-        index_line_data['money'].append(original_price)
-
-    lines_data.setdefault('可转债等权指数', index_line_data)
-
-    for line_data in lines_data.values():
-        mdd, start, end, max_profit = get_max_drawdown(x, line_data['rate'], line_data['money'])
-        line_data.setdefault('mdd', mdd)
-        line_data.setdefault('max_profit', max_profit)
-
-    for line, line_data in lines_data.items():
-        current_rate = line_data['rate'][len(line_data['rate']) - 1]
-        data.append(
-            [line
-             + "(最大回撤:" + str(line_data['mdd']) + "%, "
-             + "最高收益:" + str(line_data['max_profit']) + "%, "
-             + "当前收益:" + str(current_rate) + "%)",
-             line_data['rate'], current_rate])
-
-    data = sorted(data, key=lambda d: d[2], reverse=True)
-    return x, data
+        rates.append(price_value)
+        moneys.append(original_price)
+    return rates, moneys
 
 
 if __name__ == "__main__":
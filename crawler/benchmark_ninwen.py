@@ -0,0 +1,203 @@
+# 宁稳网可转债列表(cb_all)解析的性能测试
+# 用保存下来的页面(--page, 可以先用--save抓一份), 或者按页面结构生成的模拟页面,
+# 比较原来的html5lib解析(parse_page_bs4)和lxml按列下标解析(parse_page)的耗时, 并检查两者的解析结果是否一致
+# 模拟页面还会换几种表格写法(没有<tbody>, 表头行在表格里, 有不完整的行), 检查parse_page的结果不变
+#
+# python -m crawler.benchmark_ninwen --save cb_all.html
+# python -m crawler.benchmark_ninwen --page cb_all.html --repeat 5
+# python -m crawler.benchmark_ninwen --bonds 400
+import argparse
+import datetime
+import html
+import random
+import time
+
+from prettytable import PrettyTable
+
+from crawler import cb_ninwen
+
+# 模拟页面的列(td的class), 顺序和宁稳网一致, 同一个class的列按出现的先后对应不同的字段
+fixture_columns = [
+    ('cb_num_id', lambda r: str(r.randint(1, 999))),
+    ('bond_code_id bond_code', None),
+    ('cb_name_id', None),
+    ('bond_date_id', lambda r: '20%02d-%02d-%02d' % (r.randint(17, 21), r.randint(1, 12), r.randint(1, 28))),
+    ('stock_code', None),
+    ('stock_name', lambda r: '股票' + str(r.randint(1, 999))),
+    ('industry', lambda r: r.choice(['电子', '医药', '化工', '机械'])),
+    ('industry', lambda r: r.choice(['半导体', '化学制药', '化学原料', '通用设备'])),
+    ('cb_price2_id', lambda r: '%.3f' % r.uniform(90, 200)),
+    ('cb_mov2_id', lambda r: '%.2f%%' % r.uniform(-5, 5)),
+    ('cb_mov2_id', lambda r: '%.2f%%' % r.uniform(-2, 2)),
+    ('stock_price_id', lambda r: '%.2f' % r.uniform(3, 80)),
+    ('cb_mov_id', lambda r: '%.2f%%' % r.uniform(-10, 10)),
+    ('cb_price2_id', lambda r: '%.2f' % r.uniform(100, 120)),
+    ('cb_strike_id', lambda r: '%.2f' % r.uniform(3, 80)),
+    ('cb_premium_id', lambda r: '%.2f%%' % r.uniform(-5, 80)),
+    ('cb_value_id', lambda r: '%.2f' % r.uniform(50, 200)),
+    ('cb_t_id', lambda r: '20%02d-%02d-%02d' % (r.randint(23, 27), r.randint(1, 12), r.randint(1, 28))),
+    ('cb_t_id bond_t1', lambda r: '%d年%d天' % (r.randint(0, 5), r.randint(1, 364))),
+    ('cb_t_id red_t', lambda r: '%d天' % r.randint(1, 364)),
+    ('stock_price_id remain_amount', lambda r: '%.3f' % r.uniform(0.5, 50)),
+    ('cb_trade_amount_id', lambda r: '%.2f' % r.uniform(0.1, 50)),
+    ('cb_trade_amount_id', lambda r: '%.2f%%' % r.uniform(0, 300)),
+    ('cb_to_share', lambda r: '%.2f%%' % r.uniform(0, 30)),
+    ('cb_to_share_shares', lambda r: '%.2f%%' % r.uniform(0, 30)),
+    ('market_cap', lambda r: '%.2f' % r.uniform(10, 2000)),
+    ('cb_elasticity_id', lambda r: '%.2f' % r.uniform(0.5, 10)),
+    ('BT_yield', lambda r: '%.2f%%' % r.uniform(-10, 5)),
+    ('AT_yield', lambda r: '%.2f%%' % r.uniform(-10, 5)),
+    ('BT_red', lambda r: '%.2f%%' % r.uniform(-10, 5)),
+    ('AT_red', lambda r: '%.2f%%' % r.uniform(-10, 5)),
+    ('cb_value_id npv_red', lambda r: '%.2f' % r.uniform(80, 120)),
+    ('cb_value_id npv_value', lambda r: '%.2f' % r.uniform(80, 120)),
+    ('rating', lambda r: r.choice(['AAA', 'AA+', 'AA', 'AA-', 'A+'])),
+    ('discount_rate', lambda r: '%.2f%%' % r.uniform(-5, 5)),
+    ('cb_elasticity_id', lambda r: '%.2f' % r.uniform(0, 1)),
+    ('cb_wa_id', lambda r: '%.2f' % r.uniform(100, 250)),
+    ('cb_elasticity_id', lambda r: str(r.randint(1, 400))),
+    ('cb_wa_id', lambda r: '%.2f' % r.uniform(100, 250)),
+    ('cb_elasticity_id', lambda r: str(r.randint(1, 400))),
+    ('cb_value_id', lambda r: '%.2f%%' % r.uniform(-20, 20)),
+    ('cb_elasticity_id', lambda r: str(r.randint(0, 5))),
+]
+
+# 转债名称后面的提示(标签颜色, title)
+fixture_titles = [
+    '',
+    '最快3个交易日后可能满足强赎条件！',
+    '2021-08-23已满足强赎条件，且公司已经发出公告，2021-12-12前暂不行使强赎权利！',
+    '2021-08-24已满足强赎条件，且不强赎承诺截止日2021-08-23已过！',
+    '2021-07-20已满足强赎条件，且距离不强赎承诺截止日2021-11-03仅剩3个交易日了！',
+    '2021-09-16已满足强赎条件，且满足强赎条件后，超过一个月未公告是否行使强赎权利！',
+    '2021-11-02已满足强赎条件，且暂未公告是否行使强赎权利！',
+    '2021-10-29已满足强赎条件，且公司已经发出公告，将行使强赎权利！',
+    '2021-09-30已满足强赎条件，且最后交易日：2021-11-04，最后转股日：2021-11-04，赎回价格：101.307！',
+]
+fixture_styles = ['color:red', 'color:Fuchsia', 'color:gray', 'color:#3cb371', 'color:blue']
+fixture_names = ['平银', '东财', '蓝帆', '英科', '重银', '长汽', '苏银', '兴业', '大秦', '广汽', '乐普', '银轮']
+
+
+# 表格的几种写法: thead+tbody / 没有<tbody>(lxml不会补上) / 表头<th>行直接在表格里, 中间还有不完整的行
+page_layouts = ['tbody', 'no_tbody', 'inline_header']
+
+
+def generate_page(bond_count, seed=1, layout='tbody'):
+    r = random.Random(seed)
+    trs = []
+    for k in range(bond_count):
+        tds = []
+        for cls, value in fixture_columns:
+            attrs = ''
+            if cls == 'bond_code_id bond_code':
+                text = str(110000 + k)
+            elif cls == 'stock_code':
+                text = '%06d' % (600000 + k)
+            elif cls == 'cb_name_id':
+                title = r.choice(fixture_titles)
+                tags = ''.join('<span style="%s">!</span>' % style for style in fixture_styles if r.random() < 0.1)
+                text = ('<a href="#">%s%s</a><span title="%s">%s</span>'
+                        % (fixture_names[k % len(fixture_names)] + str(k) + '转债', tags, html.escape(title),
+                           '*' if title else ''))
+            elif cls == 'BT_red':
+                attrs = ' title="税后回售收益率"'
+                text = value(r)
+            else:
+                text = value(r)
+            tds.append('<td class="%s"%s>%s</td>' % (cls, attrs, text))
+        trs.append('<tr data-id="%d">%s</tr>' % (k + 1, ''.join(tds)))
+    header = '<tr>' + ''.join('<th>%s</th>' % cls for cls, value in fixture_columns) + '</tr>'
+    if layout == 'tbody':
+        table = '<thead>' + header + '</thead><tbody>' + ''.join(trs) + '</tbody>'
+    elif layout == 'no_tbody':
+        table = '<thead>' + header + '</thead>' + ''.join(trs)
+    elif layout == 'inline_header':
+        short_tr = '<tr><td colspan="%d">以下为新上市转债</td></tr>' % len(fixture_columns)
+        table = header + short_tr + ''.join(trs[:1]) + short_tr + ''.join(trs[1:])
+    else:
+        raise Exception('unknown page layout: ' + layout)
+    return ('<html><head><meta charset="utf-8"></head><body><table id="cb_menu"><tr><td>menu</td></tr></table>'
+            '<table id="cb_hq">' + table + '</table></body></html>')
+
+
+def time_parser(parser, page, repeat):
+    rows = None
+    seconds = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        rows = parser(page)
+        seconds.append(time.perf_counter() - start)
+    return rows, round(min(seconds), 4)
+
+
+def normalize_value(value):
+    # 有的日期是按当前时间算的(最快N个交易日后满足强赎), 只比较日期
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return value
+
+
+def diff_rows(old_rows, new_rows):
+    """两种解析结果不一致的地方[(行号, 字段, 原来的值, 现在的值)]"""
+    diffs = []
+    if len(old_rows) != len(new_rows):
+        diffs.append((None, 'rows', len(old_rows), len(new_rows)))
+    for i, (old, new) in enumerate(zip(old_rows, new_rows)):
+        for key in sorted(set(old.keys()) | set(new.keys())):
+            if normalize_value(old.get(key)) != normalize_value(new.get(key)):
+                diffs.append((i, key, old.get(key), new.get(key)))
+    return diffs
+
+
+def check_layouts(bond_count, seed):
+    """{写法: 和thead+tbody写法的解析结果不一致的地方}"""
+    expected = cb_ninwen.parse_page(generate_page(bond_count, seed))
+    return {layout: diff_rows(expected, cb_ninwen.parse_page(generate_page(bond_count, seed, layout)))
+            for layout in page_layouts}
+
+
+def run_benchmark(page, repeat):
+    old_rows, old_seconds = time_parser(cb_ninwen.parse_page_bs4, page, repeat)
+    new_rows, new_seconds = time_parser(cb_ninwen.parse_page, page, repeat)
+    return {'bytes': len(page), 'rows': len(new_rows), 'html5lib': old_seconds, 'lxml': new_seconds,
+            'speedup': round(old_seconds / new_seconds, 1), 'diffs': diff_rows(old_rows, new_rows)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='宁稳网可转债列表解析性能测试')
+    parser.add_argument('--page', help='保存下来的页面')
+    parser.add_argument('--save', help='抓取当前页面保存到这个文件')
+    parser.add_argument('--bonds', type=int, default=400, help='没有--page时, 生成的模拟页面的转债数量')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.save is not None:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            f.write(cb_ninwen.get_page())
+        print('save page: ' + args.save)
+
+    if args.page is not None:
+        with open(args.page, encoding='utf-8') as f:
+            page = f.read()
+    else:
+        page = generate_page(args.bonds, args.seed)
+
+    result = run_benchmark(page, args.repeat)
+    table = PrettyTable()
+    table.field_names = ['bytes', 'rows', 'html5lib', 'lxml', 'speedup', 'diffs']
+    table.add_row([result['bytes'], result['rows'], result['html5lib'], result['lxml'], result['speedup'],
+                   len(result['diffs'])])
+    print(table)
+    for diff in result['diffs'][:20]:
+        print('diff: ' + str(diff))
+
+    failures = len(result['diffs'])
+    if args.page is None:
+        for layout, diffs in check_layouts(args.bonds, args.seed).items():
+            print('layout ' + layout + ', diffs: ' + str(len(diffs)))
+            for diff in diffs[:20]:
+                print('diff: ' + str(diff))
+            failures += len(diffs)
+    if failures > 0:
+        raise Exception('parse cb_all page is failure.')
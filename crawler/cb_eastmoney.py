@@ -4,8 +4,7 @@ import json
 import re
 import time
 
-import requests
-
+from crawler.fetch_engine import fetch_text
 from utils.db_utils import get_cursor, execute_sql_with_rowcount
 
 userAgent = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/88.0.4324.192 Safari/537.36"
@@ -20,12 +19,7 @@ def get_content():
     # https://32.push2.eastmoney.com/api/qt/clist/get?cb=jQuery1124045700749086112435_1634389030530&pn=3&pz=100&po=1&np=1&ut=bd1d9ddb04089700cf9c27f6f7426281&fltt=2&invt=2&fid=f243&fs=b:MK0354&fields=f2,f3,f12,f14,f229,f230,f237&_=1634389030541
     url = "http://32.push2.eastmoney.com/api/qt/clist/get?cb=jQuery1124045700749086112435_" + str(int(round(time.time() * 1000))) + "&pn=1&pz=400&po=1&np=1&ut=bd1d9ddb04089700cf9c27f6f7426281&fltt=2&invt=2&fid=f243&fs=b:MK0354&fields=f2,f3,f12,f14,f229,f230,f237&_=" + str(int(round(time.time() * 1000)))
 
-    response = requests.get(url)
-    code = response.status_code
-    if code != 200:
-        print("获取数据失败， 状态码：" + code)
-
-    content = response.text
+    content = fetch_text(url)
 
     return parse_content(content)
 
@@ -59,25 +59,15 @@ def build_row(row, td, i):
 
 
 def insert_db(rows):
-    err_row = None
     try:
-        i = 0
-        with db_utils.get_connect() as con:
-            cur = con.cursor()
-            for row in rows:
-                err_row = row
-                result = cur.execute("""insert into cb_index_history( date, mid_price, avg_premium) values(:date, :mid_price, :avg_premium)""",
-                                     {'date': row['date'], 'mid_price': row['mid_price'], 'avg_premium': row['avg_premium']})
-                if result.rowcount != 1:
-                    print('insert db_index is failure. row:' + row['date'])
-                else:
-                    i += 1
+        with db_utils.connection() as cur:
+            i = db_utils.bulk_insert(cur, 'cb_index_history', ['date', 'mid_price', 'avg_premium'], rows)
 
         print("insert db_index is complete. count:" + str(i))
 
     except Exception as e:
         # cur_file.close()
-        print("db操作出现异常. err_row" + str(err_row), e)
+        print("db操作出现异常. rows" + str(rows), e)
         raise e
 
 
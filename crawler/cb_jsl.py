@@ -3,8 +3,7 @@
 import json
 import time
 
-import requests
-
+from crawler.fetch_engine import fetch_text
 from utils.db_utils import execute_sql_with_rowcount
 
 userAgent = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/88.0.4324.192 Safari/537.36"
@@ -18,12 +17,7 @@ header = {
 def get_content():
     url = "https://www.jisilu.cn/data/cbnew/cb_list/?___jsl=LST___t=" + str(int(round(time.time() * 1000))) + "&btype=C"
 
-    response = requests.get(url, headers=header)
-    code = response.status_code
-    if code != 200:
-        print("获取数据失败， 状态码：" + code)
-
-    content = response.text
+    content = fetch_text(url, headers=header)
 
     return parse_content(content)
 
@@ -1,12 +1,11 @@
 # 抓取宁稳网的数据(每天中午, 下午收盘更新, 非实时, 但是最全)
 import json
-import time
 from datetime import datetime
 
-import requests
-
 from crawler import cb_ninwen
-from utils import db_utils
+from crawler.fetch_engine import fetch_all, fetch_text, set_rate_limit
+from crawler.history_sync import create_history_index, load_sync_state, plan_sync, filter_new_rows
+from utils import db_utils, trade_calendar
 
 header = {
     "Referer": "http://www.ninwin.cn/index.php?m=profile",
@@ -15,28 +14,25 @@ header = {
 }
 
 
-def get_daily_rows(bond_id, bond_nm=None):
-    url = "https://www.jisilu.cn/data/cbnew/detail_hist/" + bond_id
+# 集思录的限速: 每秒1个请求, 同时最多2个请求, 避免被网站屏蔽掉
+jsl_host = 'www.jisilu.cn'
+jsl_rate = 1
+jsl_concurrency = 2
+set_rate_limit(jsl_host, jsl_rate, concurrency=jsl_concurrency)
 
-    response = requests.get(url, headers=header)
-    code = response.status_code
-    if code != 200:
-        print("获取数据失败， 状态码：" + code)
 
-    content = response.text
+def get_daily_rows(bond_id, bond_nm=None):
+    return parse_content(get_daily_content(bond_id), bond_nm)
 
-    return parse_content(content, bond_nm)
+
+def get_daily_content(bond_id):
+    return fetch_text("https://" + jsl_host + "/data/cbnew/detail_hist/" + bond_id, headers=header)
 
 
 def get_delisted_rows():
     url = "https://www.jisilu.cn/data/cbnew/delisted/"
 
-    response = requests.get(url, headers=header)
-    code = response.status_code
-    if code != 200:
-        print("获取数据失败， 状态码：" + code)
-
-    content = response.text
+    content = fetch_text(url, headers=header)
 
     return parse_content(content, row_builder=row_mapper)
 
@@ -44,15 +40,11 @@ def get_delisted_rows():
 def row_mapper(row, cell, bond_nm):
     row['bond_code'] = cell['bond_id']
     row['bond_nm'] = bond_nm
+    row['delist_dt'] = cell.get('delist_dt')
 
 
 def get_data(url):
-    response = requests.get(url, headers=header)
-    code = response.status_code
-    if code != 200:
-        print("获取数据失败， 状态码：" + code)
-
-    content = response.text
+    content = fetch_text(url, headers=header)
 
     return parse_content(content)
 
@@ -87,18 +79,7 @@ def build_rows(rows, bond_nm=None, row_builder=None):
                 build_row(new_row, cell, bond_nm)
             else:
                 row_builder(new_row, cell, bond_nm)
-            # 检查是否添加过
-            bond_id = new_row['bond_id']
-            last_chg_dt = new_row['last_chg_dt']
-
-            with db_utils.get_daily_connect() as con:
-                cur = con.cursor()
-                cur.execute("select count(*) from cb_history where bond_id=:bond_id and last_chg_dt=:last_chg_dt",
-                            {"bond_id": bond_id, "last_chg_dt": last_chg_dt})
-                result = cur.fetchone()
-                if result[0] > 0:
-                    continue
-
+            # 是否添加过在入库前判断(filter_new_rows/唯一索引)
         except Exception as e:
             print("数据解析出错.row=" + str(new_row), e)
             raise e
@@ -183,37 +164,62 @@ def percentage2float(cell, name, default_value=0):
         return default_value
 
 
-def do_fetch_data():
+def do_fetch_data(full=False):
+    """full: 不管是否已经同步过, 全部重新抓一遍(补缺失的数据)"""
+    with db_utils.get_daily_connect() as con:
+        cur = con.cursor()
+        create_history_index(cur)
+        sync_state = None if full else load_sync_state(cur)
+
     # 上市中的, 从ningwen拿上市的可转债列表
     rows = cb_ninwen.get_rows()
     # 从jsl遍历每一个转债的交易记录
-    add_rows(rows, bond_nm_field_name='cb_name_id')
+    add_rows(rows, bond_nm_field_name='cb_name_id', sync_state=sync_state)
 
     # 退市的
     rows = get_delisted_rows()
 
-    add_rows(rows)
+    add_rows(rows, sync_state=sync_state)
 
+    # 有了新的交易日, 交易日历需要重新加载
+    trade_calendar.reset_trade_calendar()
 
-def add_rows(rows, bond_nm_field_name='bond_nm'):
-    size = len(rows)
-    i = 0
-    for row in rows:
-        # 异常后的判重处理
-        # with db_utils.get_daily_connect() as con:
-        #     cur = con.cursor()
-        #     cur.execute("select count(*) from cb_history where bond_id=:bond_id", {"bond_id": bond_id})
-        #     result = cur.fetchone()
-        #     if result[0] > 0:
-        #         continue
-        bond_id = row['bond_code']
-        bond_nm = row[bond_nm_field_name]
-        daily_rows = get_daily_rows(str(bond_id), bond_nm)
-        insert_db(daily_rows)
-        i += 1
-        print("market bonds insert complete:" + str(i) + "/" + str(size))
-        # 暂停3s再执行， 避免被网站屏蔽掉
-        time.sleep(3)
+
+def add_rows(rows, bond_nm_field_name='bond_nm', sync_state=None):
+    # 并发抓取(按集思录的限速), 抓到一个就在当前线程解析入库, 某个转债失败不影响其他转债
+    bonds = [(str(row['bond_code']), row[bond_nm_field_name], row.get('delist_dt')) for row in rows]
+    if sync_state is not None:
+        # 已经同步到最新交易日的不用再抓
+        bonds = plan_sync(bonds, sync_state)
+        print("market bonds need to sync:" + str(len(bonds)) + "/" + str(len(rows)))
+    size = len(bonds)
+    # 解析/入库失败的
+    failures = []
+    done = [0]
+
+    def on_result(bond, content, error):
+        bond_id, bond_nm, delist_dt = bond
+        done[0] += 1
+        if error is not None:
+            print("fetch bond_id:" + bond_id + " is failure.", error)
+        else:
+            try:
+                daily_rows = parse_content(content, bond_nm)
+                if sync_state is not None:
+                    daily_rows = filter_new_rows(daily_rows, sync_state)
+                insert_db(daily_rows)
+            except Exception as e:
+                print("insert bond_id:" + bond_id + " is failure.", e)
+                failures.append((bond, e))
+        print("market bonds insert complete:" + str(done[0]) + "/" + str(size))
+
+    # 加上抓取失败的
+    failures.extend(fetch_all(bonds, lambda bond: get_daily_content(bond[0]), max_workers=jsl_concurrency,
+                              on_result=on_result))
+    if len(failures) > 0:
+        print("market bonds insert failure:" + str(len(failures)) + "/" + str(size) + ", bond_ids:"
+              + ",".join(bond[0] for bond, e in failures))
+    return failures
 
 
 # 退市数据
@@ -6672,40 +6678,27 @@ def insert_delist_data():
         print("insert bond_id:" + str(bond_id) + " is complete. count:" + str(i))
 
 
+# cb_history的字段
+history_columns = ['bond_id', 'bond_nm', 'last_chg_dt', 'ytm_rt', 'premium_rt', 'convert_value', 'price', 'volume',
+                   'stock_volume', 'curr_iss_amt', 'amt_change', 'turnover_rt']
+
+
 def insert_db(rows):
+    # 过滤掉可交换债
+    rows = [row for row in rows
+            if row.get("price") is not None and row.get("price") != 0 and 'EB' not in row["bond_nm"]]
     if len(rows) == 0:
         return
 
-    err_row = None
     try:
-        i = 0
-        with db_utils.get_daily_connect() as con:
-            cur = con.cursor()
-            for row in rows:
-                # 过滤掉可交换债
-                if row.get("price") is None or row.get("price") == 0 or 'EB' in row["bond_nm"]:
-                    continue
-
-                err_row = row
-                result = cur.execute(
-                    """insert into cb_history(bond_id, bond_nm, last_chg_dt, ytm_rt, premium_rt, convert_value, price, volume, stock_volume, curr_iss_amt, amt_change, turnover_rt) 
-                    values(:bond_id, :bond_nm, :last_chg_dt, :ytm_rt, :premium_rt, :convert_value, :price, :volume, :stock_volume, :curr_iss_amt, :amt_change, :turnover_rt)""",
-                    {"bond_id": row["bond_id"], "bond_nm": row["bond_nm"], "last_chg_dt": row["last_chg_dt"],
-                     "ytm_rt": row.get("ytm_rt"),
-                     "premium_rt": row.get("premium_rt"), "convert_value": row.get("convert_value"),
-                     "price": row.get("price"),
-                     "volume": row.get("volume"), "stock_volume": row.get("stock_volume"),
-                     "curr_iss_amt": row.get("curr_iss_amt"),
-                     "amt_change": row.get("amt_change"), "turnover_rt": row.get("turnover_rt")})
-                if result.rowcount != 1:
-                    print('insert db_history is failure. row:' + row['last_chg_dt'])
-                else:
-                    i += 1
+        with db_utils.daily_connection() as cur:
+            # 重复的记录(唯一索引)直接忽略
+            i = db_utils.bulk_insert(cur, 'cb_history', history_columns, rows, conflict='ignore')
 
-        print("insert bond_id:" + str(row["bond_id"]) + " is complete. count:" + str(i))
+        print("insert bond_id:" + str(rows[-1]["bond_id"]) + " is complete. count:" + str(i))
 
     except Exception as e:
-        print("db操作出现异常. err_row" + str(err_row), e)
+        print("db操作出现异常. bond_id:" + str(rows[0]["bond_id"]), e)
         raise e
 
 
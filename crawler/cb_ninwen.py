@@ -1,16 +1,13 @@
 #抓取宁稳网的数据(每天中午, 下午收盘更新, 非实时, 但是最全)
 
 import datetime
-import re
-from itertools import product
 
 import bs4
-import requests
-from pypinyin import pinyin, Style
+import lxml.html
 
-from utils import db_utils
-from utils.db_utils import get_cursor
-from utils.trade_utils import get_trade_date
+from crawler import enforce_title
+from crawler.fetch_engine import fetch_text, set_cookies
+from utils import db_utils, pinyin_utils
 
 header = {
     "Referer": "http://www.ninwin.cn/index.php?m=profile",
@@ -19,21 +16,58 @@ header = {
 }
 
 
+ninwen_host = 'www.ninwin.cn'
+cookie = "csrf_token=8919ea04925831e8; __51cke__=; P0s_winduser=RaqSRnBfFwDoLZv5tGFqXXLD4fXwVZQynHEOTJOsq1fzXIiXiCJW%2FWYIGis%3D; P0s_cbQuestion=1; __tins__4771153=%7B%22sid%22%3A%201631088120422%2C%20%22vd%22%3A%207%2C%20%22expires%22%3A%201631089976917%7D; __51laig__=234; PHPSESSID=jpl3tag9rff4l4mtdndsm36n44; P0s_visitor=Ncd58ncEEFs83Y9d2knG3OnEWpLyZm3YRPK8yFD6ja5fvV52; P0s_lastvisit=242%091631159109%09%2Findex.php%3Fm%3DmyAdmin%26c%3Dlog"
+set_cookies(ninwen_host, cookie)
+
+
 def get_rows():
-    url = "http://www.ninwin.cn/index.php?m=cb&a=cb_all&show_cb_only=Y&show_listed_only=Y"
+    return parse_page(get_page())
+
+
+def get_page():
+    url = "http://" + ninwen_host + "/index.php?m=cb&a=cb_all&show_cb_only=Y&show_listed_only=Y"
+    # 页面没更新时(304)直接用上次的内容
+    return fetch_text(url, headers=header, conditional=True)
+
+
+def parse_page(page):
+    """用lxml解析, 先根据第一行各单元格的class确定每一列对应的字段, 之后每一行按下标直接取值"""
+    tables = lxml.html.fromstring(page).xpath('//table[contains(@id, "cb_hq")]')
+    if len(tables) == 0:
+        print("table元素找的不对。id必须为cb_hq")
+        return
+    # 所有数据行 <tr>, lxml不会像html5lib那样补上<tbody>, 两种写法都要找; 只有<th>的表头行不算
+    trs = tables[0].xpath('./tr[td] | ./tbody/tr[td]')
 
-    cookies = {}
-    s = "csrf_token=8919ea04925831e8; __51cke__=; P0s_winduser=RaqSRnBfFwDoLZv5tGFqXXLD4fXwVZQynHEOTJOsq1fzXIiXiCJW%2FWYIGis%3D; P0s_cbQuestion=1; __tins__4771153=%7B%22sid%22%3A%201631088120422%2C%20%22vd%22%3A%207%2C%20%22expires%22%3A%201631089976917%7D; __51laig__=234; PHPSESSID=jpl3tag9rff4l4mtdndsm36n44; P0s_visitor=Ncd58ncEEFs83Y9d2knG3OnEWpLyZm3YRPK8yFD6ja5fvV52; P0s_lastvisit=242%091631159109%09%2Findex.php%3Fm%3DmyAdmin%26c%3Dlog"
-    for ss in s.split(";"):
-        name, value = ss.strip().split("=", 1)
-        cookies[name] = value
+    if len(trs) == 0:
+        print("未获取到数据。")
+        return []
+
+    # 按单元格最多的那行确定列, 第一行可能是不完整的行
+    tds_list = [tr.findall('td') for tr in trs]
+    columns = resolve_columns(max(tds_list, key=len))
+    column_count = max([i for i, field, parser in columns], default=-1) + 1
+    rows = []
+    for tr, tds in zip(trs, tds_list):
+        row = {'data_id': tr.get('data-id')}
+        # 单元格不够的行(合并单元格的提示行之类)跳过, 不影响其他行
+        if len(tds) < column_count:
+            print("跳过不完整的行, 单元格数: " + str(len(tds)) + ", data-id: " + str(row['data_id']))
+            continue
+        try:
+            for i, field, parser in columns:
+                parser(row, field, tds[i])
+        except Exception as e:
+            print("数据解析出错.row=" + str(row), e)
+            raise e
+        rows.append(row)
+    return rows
 
-    response = requests.get(url, headers=header, cookies=cookies)
-    code = response.status_code
-    if code != 200:
-        print("获取数据失败， 状态码：" + code)
 
-    soup = bs4.BeautifulSoup(response.text, "html5lib")
+def parse_page_bs4(page):
+    # 原来的解析方式(html5lib + 逐个单元格判断class), 比较解析结果和速度时用
+    soup = bs4.BeautifulSoup(page, "html5lib")
     table = soup.find_all('table')[1]
     attr_id = table.attrs['id']
     if 'cb_hq' not in attr_id:
@@ -94,25 +128,28 @@ def buildTag(row, td):
         return
 
     # 检查所满足的各种条件
-    tags = list(td.next())
-    if len(tags) > 0:
-        for tag in tags:
-            if tag.text == '!':
-                # 强赎中(将退市)
-                if tag.attrs['style'].find('color:red') > -1:
-                    row['enforce_get'] = '强赎中'
-                # 满足强赎条件
-                if tag.attrs['style'].find('color:Fuchsia') > -1:
-                    row['enforce_get'] = '满足强赎'
-                # 公告不强赎条件
-                if tag.attrs['style'].find('color:gray') > -1:
-                    row['enforce_get'] = '公告不强赎'
-                # 满足回售条件
-                if tag.attrs['style'].find('color:#3cb371') > -1:
-                    row['buy_back'] = 1
-                # 满足下修条件
-                if tag.attrs['style'].find('color:blue') > -1:
-                    row['down_revise'] = 1
+    build_tags(row, [(tag.text, tag.attrs.get('style')) for tag in td.next()])
+
+
+def build_tags(row, tags):
+    # tags: 转债名称里各个标签的(文字, 样式)
+    for text, style in tags:
+        if text == '!':
+            # 强赎中(将退市)
+            if style.find('color:red') > -1:
+                row['enforce_get'] = '强赎中'
+            # 满足强赎条件
+            if style.find('color:Fuchsia') > -1:
+                row['enforce_get'] = '满足强赎'
+            # 公告不强赎条件
+            if style.find('color:gray') > -1:
+                row['enforce_get'] = '公告不强赎'
+            # 满足回售条件
+            if style.find('color:#3cb371') > -1:
+                row['buy_back'] = 1
+            # 满足下修条件
+            if style.find('color:blue') > -1:
+                row['down_revise'] = 1
 
 
 def build_row(row, td):
@@ -279,67 +316,145 @@ def build_row(row, td):
     return row
 
 
+def resolve_field(cls, title, fields):
+    """和build_row的判断一样, 根据单元格的class(和前面已经出现过的字段fields)确定是哪个字段"""
+    if 'cb_num_id' in cls:
+        return 'cb_num_id'
+    if 'bond_code_id' in cls and 'bond_code' in cls:
+        return 'bond_code'
+    for name in ['cb_name_id', 'bond_date_id', 'stock_code', 'stock_name']:
+        if name in cls:
+            return name
+    # 同一个class的第二列
+    for name, second in [('industry', 'sub_industry'), ('cb_price2_id', 'cb_price3_id'), ('cb_mov2_id', 'cb_mov3_id')]:
+        if name in cls:
+            return second if name in fields else name
+    if 'stock_price_id' in cls:
+        return 'remain_amount' if 'remain_amount' in cls else 'stock_price_id'
+    for name in ['cb_mov_id', 'cb_strike_id', 'cb_premium_id']:
+        if name in cls:
+            return name
+    if 'cb_value_id' in cls:
+        for name in ['npv_red', 'npv_value']:
+            if name in cls:
+                return name
+        return 'cb_ma20_deviate' if 'cb_value_id' in fields else 'cb_value_id'
+    if 'cb_t_id' in cls:
+        for name in ['bond_t1', 'red_t']:
+            if name in cls:
+                return name
+        return 'cb_t_id'
+    if 'cb_trade_amount_id' in cls:
+        return 'cb_trade_amount2_id' if 'cb_trade_amount_id' in fields else 'cb_trade_amount_id'
+    for name in ['cb_to_share', 'cb_to_share_shares', 'market_cap']:
+        if name in cls:
+            return name
+    if 'cb_elasticity_id' in cls:
+        for name in ['stock_pb', 'elasticity', 'cb_ol_rank', 'cb_nl_rank', 'cb_hot']:
+            if name not in fields:
+                return name
+        return None
+    for name in ['BT_yield', 'AT_yield']:
+        if name in cls:
+            return name
+    if 'BT_red' in cls:
+        return 'AT_red' if (title or '').find('税后回售收益率') == -1 else 'BT_red'
+    for name in ['AT_red', 'rating', 'discount_rate']:
+        if name in cls:
+            return name
+    if 'cb_wa_id' in cls:
+        return 'cb_nl_value' if 'cb_ol_value' in fields else 'cb_ol_value'
+    return None
+
+
+def resolve_columns(tds):
+    """[(列下标, 字段, 解析函数)], 每页只算一次"""
+    columns = []
+    fields = set()
+    for i, td in enumerate(tds):
+        field = resolve_field(td.get('class', '').split(), td.get('title'), fields)
+        if field is None:
+            print("未知的数据， class为：" + str(td.get('class')))
+            continue
+        fields.add(field)
+        columns.append((i, field, column_parsers.get(field, parse_text_cell)))
+    return columns
+
+
+def get_cell_text(td):
+    return td.text_content().strip()
+
+
+def parse_text_cell(row, field, td):
+    row[field] = get_cell_text(td)
+
+
+def parse_percentage_cell(row, field, td):
+    row[field] = percentage2float(row.get('cb_name_id'), field, get_cell_text(td))
+
+
+def parse_year_cell(row, field, td):
+    row[field] = dayYear2Year(get_cell_text(td))
+
+
+def parse_date_cell(row, field, td):
+    text = get_cell_text(td)
+    # 今日上市需要转换成当前日期
+    if '今日上市' == text:
+        text = datetime.datetime.now().strftime("%Y-%m-%d")
+
+    row[field] = text
+
+    # 计算续存期
+    d = datetime.datetime.strptime(text, '%Y-%m-%d')
+    row['duration'] = round((datetime.datetime.now() - d).days/365, 2)
+
+
+def parse_name_cell(row, field, td):
+    # 子节点(包括文字), 和bs4的td.children一样
+    nodes = [td.text] if td.text else []
+    for child in td:
+        nodes.append(child)
+        if child.tail:
+            nodes.append(child.tail)
+
+    if len(nodes) > 0 and not isinstance(nodes[0], str):
+        build_tags(row, [(tag.text_content(), tag.get('style')) for tag in nodes[0].iterdescendants()
+                         if isinstance(tag.tag, str)])
+    text = get_cell_text(td).replace('!', '').replace('*', '')
+    row[field] = text
+    if len(nodes) > 1 and not isinstance(nodes[1], str):
+        parse_enforce_title(row, nodes[1].get('title'))
+    add_pinyin_field(row, text)
+
+
+column_parsers = {
+    'cb_name_id': parse_name_cell,
+    'bond_date_id': parse_date_cell,
+    'bond_t1': parse_year_cell,
+    'red_t': parse_year_cell,
+}
+for name in ['cb_mov2_id', 'cb_mov3_id', 'cb_mov_id', 'cb_premium_id', 'cb_ma20_deviate', 'cb_trade_amount2_id',
+             'cb_to_share', 'cb_to_share_shares', 'BT_yield', 'AT_yield', 'BT_red', 'AT_red', 'discount_rate']:
+    column_parsers[name] = parse_percentage_cell
+
+
 def parse_enforce_data(row, td):
     children = list(td.children)
     if len(children) > 1:
-        title = children[1].attrs['title']
-        if title is not None and title.strip(' ') != '':
-            # 公告不强赎
-            # 2021-08-23已满足强赎条件，且公司已经发出公告，2021-12-12前暂不行使强赎权利！
-            r = re.findall(r"([\d\-]+)已满足强赎条件，且公司已经发出公告，([\d\-]+)前暂不行使强赎权利！", title)
-            if len(r) == 1:
-                row["enforce_start_date"] = datetime.datetime.strptime(r[0][0], '%Y-%m-%d')
-                row["enforce_stop_date"] = datetime.datetime.strptime(r[0][1], '%Y-%m-%d')
-
-            # 满足强赎
-            # 最快2个交易日后可能满足强赎条件！
-            r = re.findall(r"最快(\d+)个交易日后可能满足强赎条件！", title)
-            if len(r) == 1:
-                row["enforce_start_date"] = get_trade_date(int(r[0]))
-            # 2021-08-24已满足强赎条件，且不强赎承诺截止日2021-08-23已过！
-            r = re.findall(r"([\d\-]+)已满足强赎条件，且不强赎承诺截止日([\d\-]+)已过！", title)
-            if len(r) == 1:
-                row["enforce_start_date"] = datetime.datetime.strptime(r[0][0], '%Y-%m-%d')
-                row["enforce_stop_date"] = datetime.datetime.strptime(r[0][1], '%Y-%m-%d')
-            # 2021-07-20已满足强赎条件，且距离不强赎承诺截止日2021-11-03仅剩3个交易日了！
-            r = re.findall(r"([\d\-]+)已满足强赎条件，且距离不强赎承诺截止日([\d\-]+)仅剩(\d+)个交易日了！", title)
-            if len(r) == 1:
-                row["enforce_start_date"] = datetime.datetime.strptime(r[0][0], '%Y-%m-%d')
-                row["enforce_stop_date"] = datetime.datetime.strptime(r[0][1], '%Y-%m-%d')
-            # 2021-09-16已满足强赎条件，且满足强赎条件后，超过一个月未公告是否行使强赎权利！
-            r = re.findall(r"([\d\-]+)已满足强赎条件，且满足强赎条件后，超过一个月未公告是否行使强赎权利！", title)
-            if len(r) == 1:
-                row["enforce_start_date"] = datetime.datetime.strptime(r[0], '%Y-%m-%d')
-            # 2021-11-02已满足强赎条件，且暂未公告是否行使强赎权利！
-            r = re.findall(r"([\d\-]+)已满足强赎条件，且暂未公告是否行使强赎权利！", title)
-            if len(r) == 1:
-                row["enforce_start_date"] = datetime.datetime.strptime(r[0], '%Y-%m-%d')
-
-            # 强赎中
-            # 2021-10-29已满足强赎条件，且公司已经发出公告，将行使强赎权利！
-            r = re.findall(r"([\d\-]+)已满足强赎条件，且公司已经发出公告，将行使强赎权利！", title)
-            if len(r) == 1:
-                row["enforce_start_date"] = datetime.datetime.strptime(r[0], '%Y-%m-%d')
-            # 2021-09-30已满足强赎条件，且最后交易日：2021-11-04，最后转股日：2021-11-04，赎回价格：101.307！
-            r = re.findall(r"([\d\-]+)已满足强赎条件，且最后交易日：([\d\-]+)，最后转股日：([\d\-]+)，赎回价格：([\d\\.]+)！", title)
-            if len(r) == 1:
-                row["enforce_start_date"] = datetime.datetime.strptime(r[0][0], '%Y-%m-%d')
-                row["enforce_last_date"] = datetime.datetime.strptime(r[0][1], '%Y-%m-%d')
-                row["enforce_price"] = float(r[0][3])
-
-            row['declare_desc'] = title.replace('\n', '')
+        parse_enforce_title(row, children[1].attrs['title'])
+
+
+def parse_enforce_title(row, title):
+    if title is not None and title.strip(' ') != '':
+        # 强赎日期/价格(各种提示的写法见enforce_title)
+        row.update(enforce_title.parse_title(title))
+        row['declare_desc'] = title.replace('\n', '')
 
 
 def add_pinyin_field(row, text):
-    # 增加拼音首字母处理
-    o = pinyin(text, heteronym=True, style=Style.FIRST_LETTER)
-    ps = []
-    for i in product(*o):  # 用笛卡尔积解决多音字问题
-        if type(i) == tuple:
-            ps.append(''.join(list(i)))
-        else:
-            ps.append(''.join[i])
-    row['pinyin'] = ','.join(ps)
+    # 增加拼音首字母处理(已经算过的名称直接从缓存取)
+    row['pinyin'] = pinyin_utils.get_pinyin(text)
 
 
 # 百分比转换成小数
@@ -355,15 +470,19 @@ def percentage2float(bond_name, name, text):
         return None
 
 
-def create_db():
+# 新数据先写到这张表, 检查没问题后再整个换成changed_bond
+staging_table = 'changed_bond_staging'
+
+
+def create_db(table=staging_table):
     # 使用:memory:标识打开的是内存数据库
     # con = sqlite3.connect(":memory:")
 
     with db_utils.get_connect() as con:
         # 使用executescript可以执行多个脚本
         con.executescript("""
-            drop table if exists changed_bond;
-            create table if not exists changed_bond(
+            drop table if exists """ + table + """;
+            create table if not exists """ + table + """(
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 cb_num_id int NOT NULL,
                 bond_code text NOT NULL, 
@@ -422,43 +541,66 @@ def create_db():
                 )""")
 
 
-def insert_db(rows):
-    err_row = None
-    try:
+# changed_bond的字段(不含id)
+changed_bond_columns = ['cb_num_id', 'bond_code', 'cb_name_id', 'bond_date_id', 'stock_code', 'stock_name', 'industry',
+                        'sub_industry', 'cb_price2_id', 'cb_mov2_id', 'cb_mov3_id', 'stock_price_id', 'cb_mov_id',
+                        'cb_price3_id', 'cb_strike_id', 'cb_premium_id', 'cb_value_id', 'cb_t_id', 'bond_t1', 'red_t',
+                        'remain_amount', 'cb_trade_amount_id', 'cb_trade_amount2_id', 'cb_to_share',
+                        'cb_to_share_shares', 'market_cap', 'stock_pb', 'BT_yield', 'AT_yield', 'BT_red', 'AT_red',
+                        'npv_red', 'npv_value', 'rating', 'discount_rate', 'elasticity', 'cb_ol_value', 'cb_ol_rank',
+                        'cb_nl_value', 'cb_nl_rank', 'cb_ma20_deviate', 'cb_hot', 'duration', 'enforce_get',
+                        'buy_back', 'down_revise', 'data_id', 'pinyin', 'declare_desc', 'enforce_start_date',
+                        'enforce_stop_date', 'enforce_declare_date', 'enforce_last_date', 'enforce_price']
 
-        for row in rows:
-            err_row = row
-            # execute执行脚本 cb_num_id
-            get_cursor("""insert into 
-            changed_bond( cb_num_id, bond_code, cb_name_id, bond_date_id, stock_code, stock_name, industry, sub_industry, cb_price2_id, cb_mov2_id, cb_mov3_id, stock_price_id, cb_mov_id, cb_price3_id, cb_strike_id, cb_premium_id, cb_value_id, cb_t_id, bond_t1, red_t, remain_amount, cb_trade_amount_id, cb_trade_amount2_id, cb_to_share, cb_to_share_shares, market_cap, stock_pb, BT_yield, AT_yield, BT_red, AT_red, npv_red, npv_value, rating, discount_rate, elasticity, cb_ol_value, cb_ol_rank, cb_nl_value, cb_nl_rank, cb_ma20_deviate, cb_hot, duration, enforce_get, buy_back, down_revise, data_id, pinyin, 
-            declare_desc, enforce_start_date, enforce_stop_date, enforce_declare_date, enforce_last_date, enforce_price)
-            values(:cb_num_id,:bond_code,:cb_name_id,:bond_date_id,:stock_code,:stock_name,:industry,:sub_industry,:cb_price2_id,:cb_mov2_id,:cb_mov3_id,:stock_price_id,:cb_mov_id,:cb_price3_id,:cb_strike_id,:cb_premium_id,:cb_value_id,:cb_t_id,:bond_t1,:red_t,:remain_amount,:cb_trade_amount_id,:cb_trade_amount2_id,:cb_to_share,:cb_to_share_shares,:market_cap,:stock_pb,:BT_yield,:AT_yield,:BT_red,:AT_red,:npv_red,:npv_value,:rating,:discount_rate,:elasticity,:cb_ol_value,:cb_ol_rank,:cb_nl_value,:cb_nl_rank,:cb_ma20_deviate,:cb_hot,:duration,:enforce_get,:buy_back,:down_revise,:data_id, :pinyin, 
-            :declare_desc, :enforce_start_date, :enforce_stop_date, :enforce_declare_date, :enforce_last_date, :enforce_price)""",
-                       {'cb_num_id' : row['cb_num_id'], 'bond_code' : row['bond_code'], 'cb_name_id' : row['cb_name_id'], 'bond_date_id' : row['bond_date_id'], 'stock_code' : row['stock_code'],
-                          'stock_name' : row['stock_name'], 'industry' : row['industry'], 'sub_industry' : row['sub_industry'], 'cb_price2_id' : row['cb_price2_id'],
-                          'cb_mov2_id' : row['cb_mov2_id'], 'cb_mov3_id' : row['cb_mov3_id'], 'stock_price_id' : row['stock_price_id'], 'cb_mov_id' : row['cb_mov_id'],
-                          'cb_price3_id' : row['cb_price3_id'], 'cb_strike_id' : row['cb_strike_id'], 'cb_premium_id' : row['cb_premium_id'], 'cb_value_id' : row['cb_value_id'],
-                          'cb_t_id' : row['cb_t_id'], 'bond_t1' : row['bond_t1'], 'red_t' : row['red_t'], 'remain_amount' : row['remain_amount'], 'cb_trade_amount_id' : row['cb_trade_amount_id'],
-                          'cb_trade_amount2_id' : row['cb_trade_amount2_id'], 'cb_to_share' : row['cb_to_share'], 'cb_to_share_shares' : row['cb_to_share_shares'], 'market_cap' : row['market_cap'],
-                          'stock_pb' : row['stock_pb'], 'BT_yield' : row['BT_yield'], 'AT_yield' : row['AT_yield'], 'BT_red' : row['BT_red'], 'AT_red' : row['AT_red'],
-                          'npv_red' : row['npv_red'], 'npv_value' : row['npv_value'], 'rating' : row['rating'], 'discount_rate' : row['discount_rate'], 'elasticity' : row['elasticity'],
-                          'cb_ol_value' : row['cb_ol_value'], 'cb_ol_rank' : row['cb_ol_rank'], 'cb_nl_value' : row['cb_nl_value'], 'cb_nl_rank' : row['cb_nl_rank'],
-                          'cb_ma20_deviate' : row['cb_ma20_deviate'], 'cb_hot' : row['cb_hot'], 'duration' : row['duration'], 'enforce_get' : row.get('enforce_get'),
-                          'buy_back': row.get('buy_back'), 'down_revise' : row.get('down_revise'), 'data_id' : row['data_id'], 'pinyin': row['pinyin'],
-                          'declare_desc' : row.get('declare_desc'), 'enforce_start_date': row.get('enforce_start_date'),
-                          'enforce_stop_date' : row.get('enforce_stop_date'),'enforce_declare_date' : row.get('enforce_declare_date'),
-                          'enforce_last_date' : row.get('enforce_last_date'),'enforce_price' : row.get('enforce_price'),
-                        }
-            )
+
+def insert_db(rows, table=staging_table):
+    # 所有转债在一个事务里一次性写入
+    try:
+        with db_utils.connection() as cur:
+            i = db_utils.bulk_insert(cur, table, changed_bond_columns, rows)
+        print("insert " + table + " is complete. count:" + str(i))
     except Exception as e:
         # cur_file.close()
-        print("db操作出现异常. err_row" + str(err_row), e)
+        print("db操作出现异常.", e)
         raise e
 
+# 新数据比当前数据少太多时, 认为没抓全
+min_snapshot_ratio = 0.8
+
+
+def validate_snapshot(cur, table=staging_table):
+    cur.execute("select count(*), count(distinct bond_code) from " + table)
+    count, codes = cur.fetchone()
+    if count == 0:
+        raise Exception('changed_bond snapshot is empty')
+    if codes != count:
+        raise Exception('changed_bond snapshot has duplicate bond_code. count:' + str(count) + ', bond_code:' + str(codes))
+    cur.execute("select count(*) from " + table + """
+        where bond_code = '' or cb_name_id = '' or stock_code = '' or cb_price2_id <= 0""")
+    invalid = cur.fetchone()[0]
+    if invalid > 0:
+        raise Exception('changed_bond snapshot has invalid rows. count:' + str(invalid))
+    cur.execute("select count(*) from sqlite_master where type='table' and name='changed_bond'")
+    if cur.fetchone()[0] > 0:
+        cur.execute("select count(*) from changed_bond")
+        current = cur.fetchone()[0]
+        if count < current * min_snapshot_ratio:
+            raise Exception('changed_bond snapshot is too small. count:' + str(count) + ', current:' + str(current))
+    return count
+
+
 def fetch_data():
-    create_db()
+    with db_utils.connection() as cur:
+        pinyin_utils.load_pinyin_cache(cur)
     rows = get_rows()
+    # 先写到临时表, 检查通过后一次性替换, 页面查询时不会看到空表或者一半的数据
+    create_db()
     insert_db(rows)
+    with db_utils.connection() as cur:
+        count = validate_snapshot(cur)
+        pinyin_utils.save_pinyin_cache(cur)
+    version = db_utils.swap_table(db_utils.get_connect(), 'changed_bond', staging_table)
+    print("update changed_bond is complete. count:" + str(count) + ", version:" + str(version))
     return 'OK'
 
 if __name__ == "__main__":
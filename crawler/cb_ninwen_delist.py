@@ -8,9 +8,10 @@ import time
 from itertools import product
 
 import bs4
-import requests
 from pypinyin import pinyin, Style
 
+from crawler import cb_ninwen
+from crawler.fetch_engine import fetch_text, set_cookies
 from utils import db_utils
 from utils.db_utils import get_cursor
 from utils.trade_utils import get_trade_date
@@ -22,6 +23,10 @@ header = {
 }
 
 
+# 和cb_ninwen共用同一个域名的Session
+set_cookies(cb_ninwen.ninwen_host, cb_ninwen.cookie)
+
+
 def get_cb_delist_json():
     return [
         {
@@ -1156,17 +1161,7 @@ def get_cb_delist_rows():
 
 
 def get_text(url):
-    cookies = {}
-    s = "csrf_token=8919ea04925831e8; __51cke__=; P0s_winduser=RaqSRnBfFwDoLZv5tGFqXXLD4fXwVZQynHEOTJOsq1fzXIiXiCJW%2FWYIGis%3D; P0s_cbQuestion=1; __tins__4771153=%7B%22sid%22%3A%201631088120422%2C%20%22vd%22%3A%207%2C%20%22expires%22%3A%201631089976917%7D; __51laig__=234; PHPSESSID=jpl3tag9rff4l4mtdndsm36n44; P0s_visitor=Ncd58ncEEFs83Y9d2knG3OnEWpLyZm3YRPK8yFD6ja5fvV52; P0s_lastvisit=242%091631159109%09%2Findex.php%3Fm%3DmyAdmin%26c%3Dlog"
-    for ss in s.split(";"):
-        name, value = ss.strip().split("=", 1)
-        cookies[name] = value
-    response = requests.get(url, headers=header, cookies=cookies)
-    code = response.status_code
-    if code != 200:
-        print("获取数据失败， 状态码：" + code)
-    text = response.text
-    return text
+    return fetch_text(url, headers=header)
 
 
 def build_rows(trs):
@@ -1228,28 +1223,22 @@ def build_row(row, td, i):
 
 
 def insert_db(rows):
-    err_row = None
     try:
-        i = 0
-        with db_utils.get_daily_connect() as con:
-            cur = con.cursor()
-            for row in rows:
-                err_row = row
-                enforce_dt = row.get('enforce_dt')
-                if enforce_dt is None:
-                    print("not enforce_dt value." + str(row))
-                    continue
-                result = cur.execute("""insert into cb_enforce (bond_id, bond_name, enforce_dt) VALUES (:bond_id, :bond_name, :enforce_dt)""",
-                                     {'enforce_dt': datetime.strptime(enforce_dt, '%Y-%m-%d'), 'bond_id': row.get('bond_code'), 'bond_name': row.get('cb_name_id')})
-                if result.rowcount != 1:
-                    print('insert cb_enforce is failure. row:' + str(row))
-                else:
-                    i += 1
+        enforce_rows = []
+        for row in rows:
+            enforce_dt = row.get('enforce_dt')
+            if enforce_dt is None:
+                print("not enforce_dt value." + str(row))
+                continue
+            enforce_rows.append((row.get('bond_code'), row.get('cb_name_id'), datetime.strptime(enforce_dt, '%Y-%m-%d')))
+
+        with db_utils.daily_connection() as cur:
+            i = db_utils.bulk_insert(cur, 'cb_enforce', ['bond_id', 'bond_name', 'enforce_dt'], enforce_rows)
 
         print("insert complete. count:" + str(i))
 
     except Exception as e:
-        print("db操作出现异常. err_row" + str(err_row), e)
+        print("db操作出现异常.", e)
         raise e
     finally:
         # 暂停3s再执行， 避免被网站屏蔽掉
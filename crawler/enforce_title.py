@@ -0,0 +1,121 @@
+# 宁稳网转债名称后面的强赎提示(title)的解析
+# 所有提示的写法合成一个预编译的正则(每种写法一个命名分组), 扫一遍就知道是哪种写法, 再按分组取出对应的字段
+#
+# python -m crawler.enforce_title 检查每种写法的解析结果
+import datetime
+import re
+
+from utils.trade_utils import get_trade_date
+
+date_pattern = r'[\d\-]+'
+
+
+def parse_date(text):
+    return datetime.datetime.strptime(text, '%Y-%m-%d')
+
+
+def parse_trade_days(text):
+    # N个交易日后
+    return get_trade_date(int(text))
+
+
+# (写法, 正则(用{组名}占位), {字段: (组名, 转换)})
+title_formats = [
+    # 公告不强赎
+    # 2021-08-23已满足强赎条件，且公司已经发出公告，2021-12-12前暂不行使强赎权利！
+    ('not_enforce', '{start}已满足强赎条件，且公司已经发出公告，{stop}前暂不行使强赎权利！',
+     {'enforce_start_date': ('start', parse_date), 'enforce_stop_date': ('stop', parse_date)}),
+    # 满足强赎
+    # 最快2个交易日后可能满足强赎条件！
+    ('coming', '最快{days}个交易日后可能满足强赎条件！',
+     {'enforce_start_date': ('days', parse_trade_days)}),
+    # 2021-08-24已满足强赎条件，且不强赎承诺截止日2021-08-23已过！
+    ('stop_passed', '{start}已满足强赎条件，且不强赎承诺截止日{stop}已过！',
+     {'enforce_start_date': ('start', parse_date), 'enforce_stop_date': ('stop', parse_date)}),
+    # 2021-07-20已满足强赎条件，且距离不强赎承诺截止日2021-11-03仅剩3个交易日了！
+    ('stop_coming', '{start}已满足强赎条件，且距离不强赎承诺截止日{stop}仅剩{days}个交易日了！',
+     {'enforce_start_date': ('start', parse_date), 'enforce_stop_date': ('stop', parse_date)}),
+    # 2021-09-16已满足强赎条件，且满足强赎条件后，超过一个月未公告是否行使强赎权利！
+    ('no_notice_month', '{start}已满足强赎条件，且满足强赎条件后，超过一个月未公告是否行使强赎权利！',
+     {'enforce_start_date': ('start', parse_date)}),
+    # 2021-11-02已满足强赎条件，且暂未公告是否行使强赎权利！
+    ('no_notice', '{start}已满足强赎条件，且暂未公告是否行使强赎权利！',
+     {'enforce_start_date': ('start', parse_date)}),
+    # 强赎中
+    # 2021-10-29已满足强赎条件，且公司已经发出公告，将行使强赎权利！
+    ('enforce', '{start}已满足强赎条件，且公司已经发出公告，将行使强赎权利！',
+     {'enforce_start_date': ('start', parse_date)}),
+    # 2021-09-30已满足强赎条件，且最后交易日：2021-11-04，最后转股日：2021-11-04，赎回价格：101.307！
+    ('enforce_last', '{start}已满足强赎条件，且最后交易日：{last}，最后转股日：{convert}，赎回价格：{price}！',
+     {'enforce_start_date': ('start', parse_date), 'enforce_last_date': ('last', parse_date),
+      'enforce_price': ('price', float)}),
+]
+
+group_patterns = {
+    'start': date_pattern,
+    'stop': date_pattern,
+    'last': date_pattern,
+    'convert': date_pattern,
+    'days': r'\d+',
+    'price': r'[\d\.]+',
+}
+
+
+def build_title_regex(formats):
+    # 分组名在整个正则里不能重复, 每种写法的分组加上写法名做前缀: (?P<coming>最快(?P<coming__days>\d+)个...)
+    branches = []
+    for name, pattern, fields in formats:
+        text = re.escape(pattern).replace('\\{', '{').replace('\\}', '}')
+        for group, group_pattern in group_patterns.items():
+            text = text.replace('{' + group + '}', '(?P<' + name + '__' + group + '>' + group_pattern + ')')
+        branches.append('(?P<' + name + '>' + text + ')')
+    return re.compile('|'.join(branches))
+
+
+title_regex = build_title_regex(title_formats)
+title_fields = {name: fields for name, pattern, fields in title_formats}
+
+
+def parse_title(title):
+    """解析提示里的强赎日期/价格, 返回{字段: 值}, 不认识的写法返回空dict"""
+    result = {}
+    for match in title_regex.finditer(title):
+        name = match.lastgroup
+        for field, (group, convert) in title_fields[name].items():
+            result[field] = convert(match.group(name + '__' + group))
+    return result
+
+
+if __name__ == "__main__":
+    day = parse_date
+    fixtures = [
+        ('2021-08-23已满足强赎条件，且公司已经发出公告，2021-12-12前暂不行使强赎权利！',
+         {'enforce_start_date': day('2021-08-23'), 'enforce_stop_date': day('2021-12-12')}),
+        ('最快2个交易日后可能满足强赎条件！', {'enforce_start_date': get_trade_date(2)}),
+        ('2021-08-24已满足强赎条件，且不强赎承诺截止日2021-08-23已过！',
+         {'enforce_start_date': day('2021-08-24'), 'enforce_stop_date': day('2021-08-23')}),
+        ('2021-07-20已满足强赎条件，且距离不强赎承诺截止日2021-11-03仅剩3个交易日了！',
+         {'enforce_start_date': day('2021-07-20'), 'enforce_stop_date': day('2021-11-03')}),
+        ('2021-09-16已满足强赎条件，且满足强赎条件后，超过一个月未公告是否行使强赎权利！',
+         {'enforce_start_date': day('2021-09-16')}),
+        ('2021-11-02已满足强赎条件，且暂未公告是否行使强赎权利！', {'enforce_start_date': day('2021-11-02')}),
+        ('2021-10-29已满足强赎条件，且公司已经发出公告，将行使强赎权利！', {'enforce_start_date': day('2021-10-29')}),
+        ('2021-09-30已满足强赎条件，且最后交易日：2021-11-04，最后转股日：2021-11-04，赎回价格：101.307！',
+         {'enforce_start_date': day('2021-09-30'), 'enforce_last_date': day('2021-11-04'), 'enforce_price': 101.307}),
+        ('2021-09-30已满足强赎条件，且最后交易日：2021-11-04，最后转股日：2021-11-04，赎回价格：100！',
+         {'enforce_start_date': day('2021-09-30'), 'enforce_last_date': day('2021-11-04'), 'enforce_price': 100.0}),
+        # 不认识的写法
+        ('', {}),
+        ('暂无强赎提示', {}),
+    ]
+    failures = 0
+    for title, expected in fixtures:
+        actual = parse_title(title)
+        # 按当前时间算的日期只比较到天
+        if {k: v.date() if isinstance(v, datetime.datetime) else v for k, v in actual.items()} != \
+                {k: v.date() if isinstance(v, datetime.datetime) else v for k, v in expected.items()}:
+            failures += 1
+            print('parse title is failure. title: ' + title + ', expected: ' + str(expected) + ', actual: ' + str(actual))
+    print('check ' + str(len(fixtures)) + ' titles, failures: ' + str(failures))
+    if failures > 0:
+        raise Exception('parse enforce title is failure.')
@@ -0,0 +1,222 @@
+# 并发抓取
+# 线程池并发请求, 每个域名一个令牌桶限速(同时限制并发数), 失败按指数退避重试, 每个任务的结果互不影响
+# 所有爬虫共用: 每个域名一个Session(连接池保持长连接, cookie只解析一次), 支持ETag/If-Modified-Since, 按域名统计耗时/流量
+import concurrent.futures
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from prettytable import PrettyTable
+from requests.adapters import HTTPAdapter
+
+# 默认每个域名每秒1个请求, 最多攒2个令牌, 同时最多2个请求
+default_rate = 1
+default_burst = 2
+default_concurrency = 2
+
+# 默认的超时(秒)和重试
+default_timeout = 10
+default_retries = 3
+default_backoff = 1
+
+# 需要重试的状态码
+retry_status_codes = {429, 500, 502, 503, 504}
+
+# {域名: Session}, 每个Session保持的连接数(不小于域名的并发数)
+sessions = {}
+pool_maxsize = 4
+sessions_lock = threading.Lock()
+
+# 条件请求的缓存 {url: (ETag, Last-Modified, 上次的文本)}
+validators = {}
+validators_lock = threading.Lock()
+
+# 按域名的统计 {域名: {requests, errors, retries, not_modified, bytes, seconds}}
+host_stats = {}
+stats_lock = threading.Lock()
+
+# {域名: (令牌桶, 并发信号量)}
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        # 每秒生成的令牌数, 桶的容量
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # 拿到令牌才返回, 拿不到就睡到下一个令牌生成
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def set_rate_limit(host, rate, burst=1, concurrency=default_concurrency):
+    with rate_limiters_lock:
+        rate_limiters[host] = (TokenBucket(rate, burst), threading.BoundedSemaphore(concurrency))
+
+
+def get_rate_limiter(host):
+    with rate_limiters_lock:
+        limiter = rate_limiters.get(host)
+        if limiter is None:
+            limiter = (TokenBucket(default_rate, default_burst), threading.BoundedSemaphore(default_concurrency))
+            rate_limiters[host] = limiter
+        return limiter
+
+
+def get_session(host):
+    with sessions_lock:
+        session = sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            # 重试由fetch_text自己控制
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=0)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            sessions[host] = session
+        return session
+
+
+def set_cookies(host, cookie):
+    """cookie: 浏览器里复制出来的cookie字符串(a=1; b=2), 解析后放到域名的Session里"""
+    session = get_session(host)
+    for item in cookie.split(';'):
+        if item.strip() == '':
+            continue
+        name, value = item.strip().split('=', 1)
+        session.cookies.set(name, value)
+
+
+def close_sessions():
+    with sessions_lock:
+        for session in sessions.values():
+            session.close()
+        sessions.clear()
+
+
+def add_stats(host, **counts):
+    with stats_lock:
+        stats = host_stats.get(host)
+        if stats is None:
+            stats = {'requests': 0, 'errors': 0, 'retries': 0, 'not_modified': 0, 'bytes': 0, 'seconds': 0.0}
+            host_stats[host] = stats
+        for key, value in counts.items():
+            stats[key] += value
+
+
+def get_stats():
+    with stats_lock:
+        return {host: dict(stats) for host, stats in host_stats.items()}
+
+
+def reset_stats():
+    with stats_lock:
+        host_stats.clear()
+
+
+def print_stats():
+    table = PrettyTable()
+    table.field_names = ['host', 'requests', 'errors', 'retries', 'not_modified', 'KB', 'avg_ms']
+    for host, stats in sorted(get_stats().items()):
+        avg = stats['seconds'] / stats['requests'] * 1000 if stats['requests'] > 0 else 0
+        table.add_row([host, stats['requests'], stats['errors'], stats['retries'], stats['not_modified'],
+                       round(stats['bytes'] / 1024, 1), round(avg, 1)])
+    print(table)
+
+
+class FetchError(Exception):
+
+    def __init__(self, url, status_code):
+        super().__init__('fetch ' + url + ' is failure. status_code:' + str(status_code))
+        self.url = url
+        self.status_code = status_code
+
+
+def fetch_text(url, headers=None, timeout=default_timeout, retries=default_retries, backoff=default_backoff,
+               conditional=False):
+    """
+    限速后用域名的Session请求url, 返回文本, 网络异常或者5xx/429时退避重试, 重试完还失败就抛异常
+    conditional: 带上次的ETag/Last-Modified请求, 没变化(304)时直接返回上次的文本
+    """
+    host = urlparse(url).netloc
+    bucket, slots = get_rate_limiter(host)
+    session = get_session(host)
+    request_headers = dict(headers or {})
+    cached = None
+    if conditional:
+        with validators_lock:
+            cached = validators.get(url)
+        if cached is not None:
+            if cached[0] is not None:
+                request_headers['If-None-Match'] = cached[0]
+            if cached[1] is not None:
+                request_headers['If-Modified-Since'] = cached[1]
+
+    attempt = 0
+    while True:
+        bucket.acquire()
+        start = time.perf_counter()
+        try:
+            with slots:
+                response = session.get(url, headers=request_headers, timeout=timeout)
+            add_stats(host, requests=1, bytes=len(response.content), seconds=time.perf_counter() - start)
+            if response.status_code == 304 and cached is not None:
+                add_stats(host, not_modified=1)
+                return cached[2]
+            if response.status_code == 200:
+                if conditional:
+                    etag = response.headers.get('ETag')
+                    last_modified = response.headers.get('Last-Modified')
+                    if etag is not None or last_modified is not None:
+                        with validators_lock:
+                            validators[url] = (etag, last_modified, response.text)
+                return response.text
+            error = FetchError(url, response.status_code)
+            retryable = response.status_code in retry_status_codes
+        except requests.RequestException as e:
+            add_stats(host, requests=1, seconds=time.perf_counter() - start)
+            error = e
+            retryable = True
+
+        if not retryable or attempt >= retries:
+            add_stats(host, errors=1)
+            raise error
+        add_stats(host, retries=1)
+        # 1s, 2s, 4s... 加一点随机, 避免一起重试
+        time.sleep(backoff * (2 ** attempt) * (1 + random.random() * 0.5))
+        attempt += 1
+
+
+def fetch_all(items, fetch, max_workers=4, on_result=None):
+    """
+    并发执行fetch(item), 按完成顺序在当前线程回调on_result(item, result, error), 单个任务失败不影响其他任务
+    返回失败的[(item, error)]
+    """
+    failures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch, item): item for item in items}
+        for future in concurrent.futures.as_completed(futures):
+            item = futures[future]
+            error = future.exception()
+            result = None if error is not None else future.result()
+            if error is not None:
+                failures.append((item, error))
+            if on_result is not None:
+                on_result(item, result, error)
+    return failures
@@ -0,0 +1,88 @@
+# 每日交易数据(cb_history)的增量同步
+# 先一次性查出每个转债最后一条记录的日期, 只去抓还没同步到最新交易日的转债, 入库前在内存里过滤掉已有的日期,
+# (bond_id, last_chg_dt)上有唯一索引, 重复的记录直接忽略(insert or ignore)
+import datetime
+
+# 最近几天内退市的转债还要再抓一次, 补上退市前最后几天的数据
+delisted_sync_days = 7
+
+
+def create_history_index(cur):
+    cur.execute("select 1 from sqlite_master where type='index' and name='cb_history_bond_day'")
+    if cur.fetchone() is not None:
+        return
+    # 建唯一索引前先去掉重复的记录, 留最后写入的那条(id最大), 删掉的先备份到cb_history_duplicate
+    duplicate_sql = "from cb_history where id not in (select max(id) from cb_history group by bond_id, last_chg_dt)"
+    cur.execute("select count(*), min(id), max(id) " + duplicate_sql)
+    count, min_id, max_id = cur.fetchone()
+    if count > 0:
+        cur.execute("create table if not exists cb_history_duplicate as select * from cb_history where 0")
+        cur.execute("insert into cb_history_duplicate select * " + duplicate_sql)
+        cur.execute("delete " + duplicate_sql)
+        # 删掉的记录都在cb_history_duplicate里, 这里只打印条数和id范围
+        print('delete duplicate cb_history rows: ' + str(count) + ', ids: ' + str(min_id) + '~' + str(max_id)
+              + ', backup to cb_history_duplicate')
+    cur.execute("create unique index cb_history_bond_day on cb_history(bond_id, last_chg_dt)")
+
+
+def format_day(value):
+    # 库里的日期格式: 2021-11-18 00:00:00 或 2021-11-18
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.strftime('%Y-%m-%d')
+    return str(value)[0:10]
+
+
+def load_last_days(cur):
+    """{bond_id: 最后一条记录的日期(yyyy-mm-dd)}"""
+    cur.execute("select bond_id, max(last_chg_dt) from cb_history group by bond_id")
+    return {bond_id: format_day(day) for bond_id, day in cur.fetchall() if day is not None}
+
+
+def get_latest_trade_day(now=None):
+    # fixme 不包括节假日, 节假日当天会多抓一遍(重复的记录会被过滤掉)
+    day = (now or datetime.datetime.now()).date()
+    while day.isoweekday() > 5:
+        day -= datetime.timedelta(days=1)
+    return day.strftime('%Y-%m-%d')
+
+
+def is_current(bond_id, last_days, latest_day, delist_dt=None):
+    last_day = last_days.get(bond_id)
+    if last_day is None:
+        return False
+    if delist_dt is None:
+        return last_day >= latest_day
+    # 已退市的, 退市一段时间后数据不会再变了
+    delist_day = datetime.datetime.strptime(format_day(delist_dt), '%Y-%m-%d').date()
+    latest = datetime.datetime.strptime(latest_day, '%Y-%m-%d').date()
+    return (latest - delist_day).days > delisted_sync_days
+
+
+def load_sync_state(cur, now=None):
+    return {
+        # {bond_id: 最后一条记录的日期}
+        'last_days': load_last_days(cur),
+        'latest_day': get_latest_trade_day(now),
+        # 本次已经入库的(bond_id, 日期)
+        'seen': set(),
+    }
+
+
+def plan_sync(bonds, state):
+    """bonds: [(bond_id, bond_nm, delist_dt)], 返回需要抓的转债, 已经是最新的跳过"""
+    return [bond for bond in bonds if not is_current(bond[0], state['last_days'], state['latest_day'], bond[2])]
+
+
+def filter_new_rows(rows, state):
+    """只留下比已有记录新的, 且本次还没入库的"""
+    last_days = state['last_days']
+    seen = state['seen']
+    new_rows = []
+    for row in rows:
+        key = (row['bond_id'], format_day(row['last_chg_dt']))
+        last_day = last_days.get(key[0])
+        if (last_day is not None and key[1] <= last_day) or key in seen:
+            continue
+        seen.add(key)
+        new_rows.append(row)
+    return new_rows
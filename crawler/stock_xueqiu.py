@@ -3,8 +3,7 @@ import datetime
 import json
 import time
 
-import requests
-
+from crawler.fetch_engine import fetch_text, set_rate_limit
 from utils import trade_utils, db_utils
 from utils.db_utils import get_cursor
 from utils.task_utils import *
@@ -59,6 +58,11 @@ def create_db():
     print("create db is successful")
 
 
+# 雪球: 每秒3个请求
+xueqiu_host = 'stock.xueqiu.com'
+set_rate_limit(xueqiu_host, 3, burst=3)
+
+
 def fetch_data(task_name):
 
     # 遍历可转债列表
@@ -219,20 +223,7 @@ def get_report_date():
 
 
 def get_data(url):
-    i = 0
-    while i < 3:
-        try:
-            response = requests.get(url=url, headers=header, timeout=5)
-            code = response.status_code
-            if code != 200:
-                print("获取数据失败， 状态码：" + str(code) + ', url:' + url)
-
-            return json.loads(response.text)
-        except requests.exceptions.RequestException as e:
-            i += 1
-            print("connect occur error. retry time: " + str(i) + "e" + str(e))
-
-    raise TimeoutError
+    return json.loads(fetch_text(url, headers=header, timeout=5))
 
 
 def get_earnings(stock_code):
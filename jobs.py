@@ -5,8 +5,9 @@ from datetime import datetime, date
 
 from apscheduler.schedulers.background import BackgroundScheduler
 
-from backtest.jsl_test import generate_long_year_back_test_data, generate_good_year_back_test_data, test_group
-from crawler import cb_ninwen, crawler_utils, cb_jsl_daily, stock_10jqka
+from backtest.jsl_test import generate_long_year_back_test_data, generate_good_year_back_test_data, \
+    generate_strategy_test_data
+from crawler import cb_ninwen, crawler_utils, cb_jsl_daily, stock_10jqka, fetch_engine
 from models import InvestYield, db, HoldBond, HoldBondHistory
 from utils import trade_utils, db_utils
 from utils.db_utils import get_cursor, execute_sql_with_rowcount
@@ -33,14 +34,13 @@ def task_pre_week(app):
     print("begin to run task_pre_week job...")
     try:
         with app.app_context():
-            # 更新回测数据
-            generate_good_year_back_test_data()
-            generate_long_year_back_test_data()
+            # 更新回测数据(从上周的断点接着跑, 只需要回测新增的交易日)
+            generate_good_year_back_test_data(resume=True)
+            generate_long_year_back_test_data(resume=True)
 
             strategy_types = ['低溢价策略', '低余额+低溢价+双低策略', '低余额+双低策略', '低溢价+双低策略', '双低策略', '高收益率策略', '低价格策略']
             start = datetime.strptime('2018-01-01', '%Y-%m-%d')
-            for name in strategy_types:
-                test_group(start, strategy_types=[name], is_single_strategy=True, is_save_test_result=True)
+            generate_strategy_test_data(start, strategy_types, resume=True)
     except Exception as e:
         print('task_pre_week is failure. ', e)
 
@@ -56,6 +56,8 @@ def sync_cb_data_job(app):
 
             # 先同步一下可转债数据
             cb_ninwen.fetch_data()
+            # 各网站的请求次数/耗时/流量
+            fetch_engine.print_stats()
     except Exception as e:
         print('sync_cb_data_job is failure. ', e)
 
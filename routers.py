@@ -12,17 +12,16 @@ from flask_login import login_user, login_required, logout_user
 from prettytable import from_db_cursor
 from sqlalchemy import or_, and_, func
 
-import backtest.jsl_test
-import backtest.test_utils
+import backtest.test_job
+import backtest.test_series
 import utils.table_html_utils
 import utils.trade_utils
 from backtest import jsl_test
-from config import db_file_path, db_daily_file_path
 from crawler import cb_ninwen, cb_jsl, cb_ninwen_detail, stock_10jqka, stock_xueqiu, stock_eastmoney, cb_eastmoney
 from jobs import do_update_data_after_trade_is_end, do_update_data_before_trade_is_start
 from models import User, ChangedBond, HoldBond, ChangedBondSelect, db, TradeHistory, HoldBondHistory, Task
-from utils import trade_utils
-from utils.db_utils import get_connect, get_cursor, get_daily_connect
+from utils import trade_utils, pinyin_utils, db_utils
+from utils.db_utils import get_connect, get_cursor, get_daily_connect, connection
 from utils.html_utils import get_strategy_options_html
 from views import view_market, view_my_account, view_my_select, view_my_strategy, view_my_yield, view_up_down, \
     view_my_up_down, view_turnover, view_discount, view_stock, view_tree_map_industry, view_industry_premium, \
@@ -127,14 +126,21 @@ def find_bond_by_code():
         return dict(bond)
 
 
+def find_names_by_pinyin(bond_name):
+    # 从拼音缓存里找名称, 持仓/自选里没存拼音的也能搜到
+    with connection() as cur:
+        return pinyin_utils.find_names_by_pinyin(cur, bond_name)
+
+
 @cb.route('/find_bond_by_name.html/<bond_name>/', methods=['GET'])
 @login_required
 def find_bond_by_name(bond_name):
 
     if bond_name != '':
-        bond1s = db.session.query(HoldBond).filter(or_(HoldBond.cb_name_id.like('%' + bond_name + '%'), HoldBond.pinyin.like('%' + bond_name + '%'))).all()
+        names = find_names_by_pinyin(bond_name)
+        bond1s = db.session.query(HoldBond).filter(or_(HoldBond.cb_name_id.like('%' + bond_name + '%'), HoldBond.pinyin.like('%' + bond_name + '%'), HoldBond.cb_name_id.in_(names))).all()
 
-        bond2s = db.session.query(ChangedBond).filter(or_(ChangedBond.cb_name_id.like('%' + bond_name + '%'), ChangedBond.pinyin.like('%' + bond_name + '%'))).all()
+        bond2s = db.session.query(ChangedBond).filter(or_(ChangedBond.cb_name_id.like('%' + bond_name + '%'), ChangedBond.pinyin.like('%' + bond_name + '%'), ChangedBond.cb_name_id.in_(names))).all()
 
         bonds = []
         bonds.extend(bond1s)
@@ -221,8 +227,9 @@ def find_changed_bond_select_by_code():
 def find_changed_bond_select_by_name(bond_name):
     bonds = None
     if bond_name != '':
-        bond1s = db.session.query(ChangedBondSelect).filter(or_(ChangedBondSelect.cb_name_id.like('%' + bond_name + '%'), ChangedBondSelect.pinyin.like('%' + bond_name + '%')), ChangedBondSelect.is_deleted != 1).all()
-        bond2s = db.session.query(ChangedBond).filter(or_(ChangedBond.cb_name_id.like('%' + bond_name + '%'), ChangedBond.pinyin.like('%' + bond_name + '%'))).all()
+        names = find_names_by_pinyin(bond_name)
+        bond1s = db.session.query(ChangedBondSelect).filter(or_(ChangedBondSelect.cb_name_id.like('%' + bond_name + '%'), ChangedBondSelect.pinyin.like('%' + bond_name + '%'), ChangedBondSelect.cb_name_id.in_(names)), ChangedBondSelect.is_deleted != 1).all()
+        bond2s = db.session.query(ChangedBond).filter(or_(ChangedBond.cb_name_id.like('%' + bond_name + '%'), ChangedBond.pinyin.like('%' + bond_name + '%'), ChangedBond.cb_name_id.in_(names))).all()
         bonds = []
         bonds.extend(bond1s)
         bonds.extend(bond2s)
@@ -757,7 +764,7 @@ def init_strategy_groups_view():
 
 @cb.route('/view_good_year_back_test.html')
 def good_year_back_test_view():
-    content = backtest.test_utils.get_back_test_data("good_year_back_test")
+    content = backtest.test_series.get_back_test_html("good_year_back_test")
 
     return render_template("page_with_navbar.html",
                            title='轮动策略回测分析',
@@ -768,7 +775,7 @@ def good_year_back_test_view():
 
 @cb.route('/view_bad_year_back_test.html')
 def bad_year_back_test_view():
-    content = backtest.test_utils.get_back_test_data("bad_year_back_test")
+    content = backtest.test_series.get_back_test_html("bad_year_back_test")
     return render_template("page_with_navbar.html",
                            title='轮动策略回测分析',
                            navbar=build_back_test_nav_html(request.url_rule),
@@ -777,7 +784,7 @@ def bad_year_back_test_view():
 
 @cb.route('/view_long_year_back_test.html')
 def long_back_test_view():
-    content = backtest.test_utils.get_back_test_data("long_year_back_test")
+    content = backtest.test_series.get_back_test_html("long_year_back_test")
     return render_template("page_with_navbar.html",
                            title='轮动策略回测分析',
                            navbar=build_back_test_nav_html(request.url_rule),
@@ -786,7 +793,7 @@ def long_back_test_view():
 
 @cb.route('/view_back_test_1.html')
 def back_test_1_view():
-    content = backtest.test_utils.get_back_test_data("低溢价策略")
+    content = backtest.test_series.get_back_test_html("低溢价策略")
     return render_template("page_with_navbar.html",
                            title='轮动策略回测分析',
                            navbar=build_back_test_nav_html(request.url_rule),
@@ -795,7 +802,7 @@ def back_test_1_view():
 
 @cb.route('/view_back_test_2.html')
 def back_test_2_view():
-    content = backtest.test_utils.get_back_test_data("低余额+低溢价+双低策略")
+    content = backtest.test_series.get_back_test_html("低余额+低溢价+双低策略")
     return render_template("page_with_navbar.html",
                            title='轮动策略回测分析',
                            navbar=build_back_test_nav_html(request.url_rule),
@@ -804,7 +811,7 @@ def back_test_2_view():
 
 @cb.route('/view_back_test_3.html')
 def back_test_3_view():
-    content = backtest.test_utils.get_back_test_data("低余额+双低策略")
+    content = backtest.test_series.get_back_test_html("低余额+双低策略")
     return render_template("page_with_navbar.html",
                            title='轮动策略回测分析',
                            navbar=build_back_test_nav_html(request.url_rule),
@@ -813,7 +820,7 @@ def back_test_3_view():
 
 @cb.route('/view_back_test_4.html')
 def back_test_4_view():
-    content = backtest.test_utils.get_back_test_data("低溢价+双低策略")
+    content = backtest.test_series.get_back_test_html("低溢价+双低策略")
     return render_template("page_with_navbar.html",
                            title='轮动策略回测分析',
                            navbar=build_back_test_nav_html(request.url_rule),
@@ -822,7 +829,7 @@ def back_test_4_view():
 
 @cb.route('/view_back_test_5.html')
 def back_test_5_view():
-    content = backtest.test_utils.get_back_test_data("双低策略")
+    content = backtest.test_series.get_back_test_html("双低策略")
     return render_template("page_with_navbar.html",
                            title='轮动策略回测分析',
                            navbar=build_back_test_nav_html(request.url_rule),
@@ -831,7 +838,7 @@ def back_test_5_view():
 
 @cb.route('/view_back_test_6.html')
 def back_test_6_view():
-    content = backtest.test_utils.get_back_test_data("高溢价策略")
+    content = backtest.test_series.get_back_test_html("高溢价策略")
     return render_template("page_with_navbar.html",
                            title='轮动策略回测分析',
                            navbar=build_back_test_nav_html(request.url_rule),
@@ -840,13 +847,21 @@ def back_test_6_view():
 
 @cb.route('/view_back_test_7.html')
 def back_test_7_view():
-    content = backtest.test_utils.get_back_test_data("低价格策略")
+    content = backtest.test_series.get_back_test_html("低价格策略")
     return render_template("page_with_navbar.html",
                            title='轮动策略回测分析',
                            navbar=build_back_test_nav_html(request.url_rule),
                            content=content)
 
 
+@cb.route('/get_back_test_series.html/<name>/', methods=['GET'])
+def get_back_test_series(name):
+    data = backtest.test_series.get_back_test_series_data(name)
+    if data is None:
+        return "{}"
+    return json.dumps(data, ensure_ascii=False)
+
+
 @cb.route('/view_custom_back_test.html')
 @login_required
 def custom_back_test_view():
@@ -916,30 +931,48 @@ def custom_back_test_result_view():
         else:
             is_single_strategy = False
 
-        s_select_sql = request.form.get("select_sql")
-        select_sql = None if len(strategy_types) != 1 else (None if s_select_sql is None or s_select_sql.strip(' ') == '' else s_select_sql)
-        s_exchange_sql = request.form.get("exchange_sql")
-        exchange_sql = None if len(strategy_types) != 1 else None if s_exchange_sql is None or s_exchange_sql.strip(' ') == '' else s_exchange_sql
-
-        content += backtest.jsl_test.test_group(start,
-                                                end=end,
-                                                roll_period=period,
-                                                bond_count=count,
-                                                strategy_types=strategy_types,
-                                                is_single_strategy=is_single_strategy,
-                                                pre_day=pre_day,
-                                                max_rise=max_rise,
-                                                max_price=max_price,
-                                                max_double_low=max_double_low,
-                                                select_sql=select_sql,
-                                                exchange_sql=exchange_sql,
-                                            )
+        s_select_expr = request.form.get("select_expr")
+        select_expr = None if len(strategy_types) != 1 else (None if s_select_expr is None or s_select_expr.strip() == '' else s_select_expr)
+        s_exchange_expr = request.form.get("exchange_expr")
+        exchange_expr = None if len(strategy_types) != 1 else None if s_exchange_expr is None or s_exchange_expr.strip() == '' else s_exchange_expr
+
+        job_id = backtest.test_job.submit_back_test({
+            'start': start,
+            'end': end,
+            'roll_period': period,
+            'bond_count': count,
+            'strategy_types': strategy_types,
+            'is_single_strategy': is_single_strategy,
+            'pre_day': pre_day,
+            'max_rise': max_rise,
+            'max_price': max_price,
+            'max_double_low': max_double_low,
+            'select_expr': select_expr,
+            'exchange_expr': exchange_expr,
+        })
+        job = backtest.test_job.get_job(job_id)
+        return json.dumps({'job_id': job_id,
+                           'task_name': backtest.test_job.get_task_name(job_id),
+                           'status': job['status']})
     except BaseException as e:
         logging.exception(e)
         content = 'occur error:' + str(e)
     return content
 
 
+@cb.route('/get_custom_back_test_result.html/<job_id>/', methods=['GET'])
+@login_required
+def get_custom_back_test_result(job_id):
+    job = backtest.test_job.get_job(job_id)
+    if job is None:
+        return 'not found back test job:' + job_id
+    if job['status'] == -1:
+        return 'occur error:' + str(job['desc'])
+    if job['status'] == 0:
+        return 'back test job is running'
+    return job['html']
+
+
 @cb.route('/view_enforce_list.html')
 def enforce_list_view():
     # current_user = None
@@ -1067,9 +1100,8 @@ def upload_cb_daily_data():
 @cb.route('/save_db_data.html', methods=['POST'])
 @login_required
 def save_db_data():
-    # 删除整个db
-    if os.path.exists(db_file_path):
-        os.unlink(db_file_path)
+    # 删除整个db(其他线程的连接下次使用时会重新建)
+    db_utils.remove_db_file(db_utils.get_db_file())
     # 获取文件(字符串?)
     file = request.files['file']
     s = file.read().decode('utf-8')
@@ -1083,9 +1115,8 @@ def save_db_data():
 @cb.route('/save_cb_daily_data.html', methods=['POST'])
 @login_required
 def save_cb_daily_data():
-    # 删除整个db
-    if os.path.exists(db_daily_file_path):
-        os.unlink(db_daily_file_path)
+    # 删除整个db(其他线程的连接下次使用时会重新建)
+    db_utils.remove_db_file(db_utils.get_db_daily_file())
 
     # 获取文件(字符串?)
     file = request.files['file']
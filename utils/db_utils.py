@@ -1,5 +1,8 @@
+import contextlib
 import os
 import sqlite3
+import threading
+from datetime import datetime
 
 from prettytable import PrettyTable
 
@@ -34,6 +37,20 @@ def get_dict_row(cursor, row):
 
 local_con = {}
 
+# 每个线程每个库文件一个连接, 用完不关闭, 下次直接复用
+pooled_cons = threading.local()
+# 缓存的预编译sql数量
+cached_statements = 256
+# 连接建好后执行一次
+connect_pragmas = [
+    # 读写不互相阻塞(爬虫写库的时候页面还能查)
+    "pragma journal_mode=WAL",
+    "pragma synchronous=NORMAL",
+    "pragma temp_store=MEMORY",
+    # 单位KB
+    "pragma cache_size=-32000",
+]
+
 
 def get_db_file():
     return os.path.join(basedir, db_file_path)
@@ -43,12 +60,178 @@ def get_db_daily_file():
     return os.path.join(basedir, db_daily_file_path)
 
 
+def new_connect(path):
+    con = sqlite3.connect(path, timeout=30, cached_statements=cached_statements)
+    for pragma in connect_pragmas:
+        try:
+            con.execute(pragma)
+        except sqlite3.OperationalError as e:
+            # 第一次切换成WAL时如果有别的连接正在读, 会切换失败, 下次建连接时再试
+            print('execute ' + pragma + ' is failure.', e)
+    return con
+
+
+def get_file_id(path):
+    # 库文件被删除/替换后, inode会变
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_dev, stat.st_ino
+
+
+def get_pooled_connect(path):
+    """
+    当前线程的连接(每个库文件一个), 和sqlite3.connect一样可以用with提交/回滚事务, 但是不要close
+    fork出来的子进程不能用父进程的连接, 需要重新建
+    库文件被替换了(比如上传了新的库), 其他线程里的旧连接还指向原来的文件, 下次取的时候发现文件变了会重新建
+    """
+    cons = getattr(pooled_cons, 'cons', None)
+    if cons is None or pooled_cons.pid != os.getpid():
+        cons = {}
+        pooled_cons.cons = cons
+        pooled_cons.pid = os.getpid()
+    # {库文件: (连接, 建连接时的文件)}
+    pooled = cons.get(path)
+    if pooled is not None and pooled[1] != get_file_id(path):
+        pooled[0].close()
+        pooled = None
+    if pooled is None:
+        con = new_connect(path)
+        pooled = (con, get_file_id(path))
+        cons[path] = pooled
+    return pooled[0]
+
+
+def close_connections(path=None):
+    # 关闭当前线程的所有连接(或者只关path的), 比如库文件要被替换/删除时
+    cons = getattr(pooled_cons, 'cons', None)
+    if cons is None:
+        return
+    if pooled_cons.pid != os.getpid():
+        pooled_cons.cons = None
+        return
+    for key in list(cons.keys()):
+        if path is None or key == path:
+            cons.pop(key)[0].close()
+
+
+def remove_db_file(path):
+    """删除库文件, 连同WAL模式下的-wal/-shm文件, 当前线程的连接先关掉"""
+    close_connections(path)
+    for file in [path, path + '-wal', path + '-shm']:
+        if os.path.exists(file):
+            os.unlink(file)
+
+
 def get_connect():
-    return sqlite3.connect(get_db_file())
+    return get_pooled_connect(get_db_file())
 
 
 def get_daily_connect():
-    return sqlite3.connect(get_db_daily_file())
+    return get_pooled_connect(get_db_daily_file())
+
+
+@contextlib.contextmanager
+def connection():
+    """with connection() as cur: ... 正常结束提交, 出异常回滚"""
+    with get_connect() as con:
+        yield con.cursor()
+
+
+@contextlib.contextmanager
+def daily_connection():
+    with get_daily_connect() as con:
+        yield con.cursor()
+
+
+def to_tuples(rows, columns):
+    # dict行 => 按columns排好的tuple, 没有的字段为None, 已经是tuple的不变
+    return [row if isinstance(row, (tuple, list)) else tuple(row.get(column) for column in columns) for row in rows]
+
+
+def bulk_insert(cur, table, columns, rows, conflict=None, staging=False):
+    """
+    批量插入, 在调用方的事务里执行(with daily_connection() as cur: ...), 返回插入的行数
+    rows: dict行(按columns取值) 或 已按columns排好的tuple
+    conflict: 冲突时的处理, 比如ignore/replace
+    staging: 先写到临时表, 再insert ... select一次性写入
+    """
+    rows = to_tuples(rows, columns)
+    if len(rows) == 0:
+        return 0
+
+    fields = ', '.join(columns)
+    insert = 'insert ' + ('' if conflict is None else 'or ' + conflict + ' ') + 'into ' + table + '(' + fields + ')'
+    values = ' values(' + ', '.join(['?'] * len(columns)) + ')'
+    if not staging:
+        cur.executemany(insert + values, rows)
+        return cur.rowcount
+
+    staging_table = 'temp.' + table + '_staging'
+    cur.execute('drop table if exists ' + staging_table)
+    cur.execute('create table ' + staging_table + ' as select ' + fields + ' from main.' + table + ' where 0')
+    try:
+        cur.executemany('insert into ' + staging_table + '(' + fields + ')' + values, rows)
+        cur.execute(insert + ' select ' + fields + ' from ' + staging_table)
+        return cur.rowcount
+    finally:
+        cur.execute('drop table if exists ' + staging_table)
+
+
+def create_table_version(cur):
+    # 每次整表替换后版本号+1, 缓存可以用版本号判断数据是否变了
+    cur.execute("""
+        create table if not exists table_version(
+            name text PRIMARY KEY,
+            version integer NOT NULL,
+            modify_date datetime
+        )""")
+
+
+def get_table_version(cur, table):
+    create_table_version(cur)
+    cur.execute("select version from table_version where name = :name", {'name': table})
+    row = cur.fetchone()
+    return 0 if row is None else row[0]
+
+
+def swap_table(con, table, staging_table):
+    """
+    用staging_table整个替换掉table(原表的索引在新表上重建), 在一个事务里完成, 返回新的版本号
+    查询的页面要么看到旧数据, 要么看到新数据, 不会看到空表
+    """
+    cur = con.cursor()
+    create_table_version(cur)
+    con.commit()
+    # 改名时不要改写引用了原表的视图(比如changed_bond_view), 换完后视图直接指向新表
+    cur.execute("pragma legacy_alter_table=ON")
+    try:
+        cur.execute("begin immediate")
+        try:
+            cur.execute("select sql from sqlite_master where type='index' and tbl_name=:table and sql is not null",
+                        {'table': table})
+            index_sqls = [row[0] for row in cur.fetchall()]
+            cur.execute("select count(*) from sqlite_master where type='table' and name=:table", {'table': table})
+            if cur.fetchone()[0] > 0:
+                cur.execute("alter table " + table + " rename to " + table + "_old")
+            cur.execute("alter table " + staging_table + " rename to " + table)
+            cur.execute("drop table if exists " + table + "_old")
+            for sql in index_sqls:
+                cur.execute(sql)
+            cur.execute("""
+                insert into table_version(name, version, modify_date) values(:name, 1, :modify_date)
+                on conflict(name) do update set version = version + 1, modify_date = excluded.modify_date
+            """, {'name': table, 'modify_date': datetime.now()})
+            cur.execute("select version from table_version where name = :name", {'name': table})
+            version = cur.fetchone()[0]
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+    finally:
+        cur.execute("pragma legacy_alter_table=OFF")
+    return version
 
 
 def get_cursor(sql, params=None):
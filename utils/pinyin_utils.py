@@ -0,0 +1,74 @@
+# 转债名称的拼音首字母缓存
+# 名称几乎不会变, 算过的拼音(含多音字的所有组合)存在bond_pinyin表里, 爬虫开始时一次性加载到内存, 只有新名称才重新计算,
+# 按拼音搜索转债时也直接用这份缓存
+import threading
+from itertools import product
+
+from pypinyin import pinyin, Style
+
+# {名称: 拼音首字母(多个读音用逗号分隔)}
+pinyin_cache = {}
+# 还没写入库的新名称
+new_pinyins = {}
+# 已加载到的最大rowid, 之后只加载新增的
+loaded_rowid = 0
+pinyin_lock = threading.Lock()
+
+
+def build_pinyin(text):
+    o = pinyin(text, heteronym=True, style=Style.FIRST_LETTER)
+    # 用笛卡尔积解决多音字问题
+    return ','.join(''.join(i) for i in product(*o))
+
+
+def create_pinyin_table(cur):
+    cur.execute("""
+        create table if not exists bond_pinyin(
+            name text PRIMARY KEY,
+            pinyin text NOT NULL
+        )""")
+
+
+def load_pinyin_cache(cur):
+    """把库里新增的名称加载到内存, 返回加载的条数"""
+    global loaded_rowid
+    create_pinyin_table(cur)
+    with pinyin_lock:
+        cur.execute("select rowid, name, pinyin from bond_pinyin where rowid > :rowid order by rowid",
+                    {'rowid': loaded_rowid})
+        rows = cur.fetchall()
+        for rowid, name, value in rows:
+            pinyin_cache[name] = value
+            loaded_rowid = rowid
+    return len(rows)
+
+
+def get_pinyin(name):
+    value = pinyin_cache.get(name)
+    if value is None:
+        value = build_pinyin(name)
+        with pinyin_lock:
+            pinyin_cache[name] = value
+            new_pinyins[name] = value
+    return value
+
+
+def save_pinyin_cache(cur):
+    """新算出来的名称写入库, 返回写入的条数"""
+    with pinyin_lock:
+        rows = list(new_pinyins.items())
+        new_pinyins.clear()
+    if len(rows) == 0:
+        return 0
+    create_pinyin_table(cur)
+    cur.executemany("insert or ignore into bond_pinyin(name, pinyin) values(?, ?)", rows)
+    return cur.rowcount
+
+
+def find_names_by_pinyin(cur, keyword):
+    """拼音首字母包含keyword(不区分大小写)的名称"""
+    load_pinyin_cache(cur)
+    keyword = keyword.lower()
+    with pinyin_lock:
+        items = list(pinyin_cache.items())
+    return [name for name, value in items if keyword in value]
@@ -40,6 +40,34 @@ def new_or_update_task(total_num, task_name):
     return task, 1
 
 
+def start_task(total_num, task_name):
+    # 不管之前的任务是什么状态, 直接重新开始(用于按需提交的后台任务)
+    task = db.session.query(Task).filter(Task.name == task_name).first()
+    today = datetime.now()
+    if task is None:
+        task = Task()
+        task.name = task_name
+        task.create_date = today
+        db.session.add(task)
+    task.total_num = total_num
+    task.current_num = 0
+    task.process = 0
+    task.status = 0  # 执行中
+    task.desc = None
+    task.modify_date = today
+    db.session.commit()  # 为了后面能看到任务数据
+    return task
+
+
+def delete_tasks(task_names):
+    # 按需提交的后台任务, 结果不要了之后把任务记录也删掉
+    if len(task_names) == 0:
+        return 0
+    count = db.session.query(Task).filter(Task.name.in_(task_names)).delete(synchronize_session=False)
+    db.session.commit()
+    return count
+
+
 def process_task_when_normal(task, num=1):
     if task not in db.session:
         db.session.merge(task)
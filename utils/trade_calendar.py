@@ -0,0 +1,112 @@
+# 交易日历
+# 从cb_history中一次性取出所有交易日(升序), 之后的下一个/上一个/前后N个交易日都用二分查找, 不用再查库
+import bisect
+import datetime
+import time
+
+from utils import db_utils
+
+# 已加载的交易日历 {'version': ..., 'calendar': ..., 'checked': ...}
+# 本进程爬完数据后会直接重置, 别的进程(网站/回测)改了库, 按版本号发现后重新加载
+calendar_cache = {}
+# 回测每个交易日都要取日历, 最多每隔这么多秒才去库里查一次版本号
+calendar_check_seconds = 10
+
+
+def parse_day(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        return datetime.datetime(value.year, value.month, value.day)
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day)
+    # 库里的日期格式: 2021-11-18 00:00:00 或 2021-11-18
+    return datetime.datetime.strptime(str(value)[0:10], '%Y-%m-%d')
+
+
+class TradeCalendar:
+
+    def __init__(self, days):
+        # 升序的交易日
+        self.days = days
+        self.day_index = {day: i for i, day in enumerate(days)}
+
+    def __len__(self):
+        return len(self.days)
+
+    def index_of(self, day):
+        return self.day_index.get(parse_day(day))
+
+    def next_day(self, current):
+        i = bisect.bisect_right(self.days, parse_day(current))
+        return self.days[i] if i < len(self.days) else None
+
+    def previous_day(self, current):
+        i = bisect.bisect_left(self.days, parse_day(current))
+        return self.days[i - 1] if i > 0 else None
+
+    def offset_index(self, current, n, clamp=False):
+        """
+        current之后(n>0)或之前(n<0)的第n个交易日的下标, n=0时current必须是交易日
+        超出范围时返回None, clamp为True时取最早/最晚的那个交易日
+        """
+        day = parse_day(current)
+        if n > 0:
+            i = bisect.bisect_right(self.days, day) + n - 1
+        elif n < 0:
+            i = bisect.bisect_left(self.days, day) + n
+        else:
+            return self.day_index.get(day)
+
+        if 0 <= i < len(self.days):
+            return i
+        if not clamp or len(self.days) == 0:
+            return None
+        # 当前就是第一个交易日时, 前面没有可取的
+        if i < 0 and bisect.bisect_left(self.days, day) == 0:
+            return None
+        return min(max(i, 0), len(self.days) - 1)
+
+    def offset(self, current, n, clamp=False):
+        i = self.offset_index(current, n, clamp)
+        return None if i is None else self.days[i]
+
+
+def load_trade_calendar(cur):
+    cur.execute("""
+        SELECT DISTINCT last_chg_dt
+        from cb_history
+        where price is not NULL
+        order by last_chg_dt
+    """)
+    days = sorted({parse_day(row[0]) for row in cur.fetchall()})
+    return TradeCalendar(days)
+
+
+def get_calendar_version(cur):
+    cur.execute("select max(last_chg_dt), count(distinct last_chg_dt) from cb_history where price is not NULL")
+    return cur.fetchone()
+
+
+def get_trade_calendar(cur=None):
+    calendar = calendar_cache.get('calendar')
+    now = time.time()
+    if calendar is not None and now - calendar_cache['checked'] < calendar_check_seconds:
+        return calendar
+
+    if cur is None:
+        with db_utils.get_daily_connect() as con:
+            return get_trade_calendar(con.cursor())
+
+    # 交易日有变化才重新加载
+    version = get_calendar_version(cur)
+    if calendar is None or calendar_cache['version'] != version:
+        calendar = load_trade_calendar(cur)
+        calendar_cache['calendar'] = calendar
+        calendar_cache['version'] = version
+    calendar_cache['checked'] = now
+    return calendar
+
+
+def reset_trade_calendar():
+    calendar_cache.clear()
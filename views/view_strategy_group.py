@@ -5,6 +5,7 @@
 import json
 import math
 import threading
+from datetime import datetime
 
 from prettytable import from_db_cursor
 
@@ -16,6 +17,7 @@ from utils.bond_utils import is_too_expensive, parse_bond_ids_params
 from utils.db_utils import get_record, get_cursor
 
 from utils.echarts_html_utils import generate_scatter_html_with_multi_tables
+from utils.trade_calendar import get_trade_calendar
 from views import view_strategy_group_yield
 
 global_test_context = threading.local()
@@ -482,9 +484,11 @@ def do_sell_bonds(cur, current_rows, group_bonds, strategy_name):
             # 因为可能有一种情况, 买入的时候, 涨幅就已经超过最大涨幅(30%), 这样就会出现买入后就马上卖出
             create_date = group_bond[5]
             pre_price_row = get_pre_price_row(bond_code)
-            pre_price = pre_price_row[0]
-            if create_date > pre_price_row[1]:
+            # 还没有历史数据的, 和建仓价比
+            if pre_price_row is None or create_date > pre_price_row[1]:
                 pre_price = group_bond[2]
+            else:
+                pre_price = pre_price_row[0]
             if round((price - pre_price) / price * 100, 2) >= global_test_context.max_rise:
                 sell_num += 1
                 sell_total_money += price * amount
@@ -531,21 +535,30 @@ def sell_bond(cur, bond_code, before_percent, strategy_name, desc):
 
 
 def get_pre_price_row(bond_id):
-    with db_utils.get_daily_connect() as con_daily:
-        cur_daily = con_daily.cursor()
+    with db_utils.daily_connection() as cur_daily:
+        # 5个交易日前(不够的话取最早的那天), 当天停牌的话取之后最近的一条
+        pre_day = get_trade_calendar(cur_daily).offset(datetime.now(), -5, clamp=True)
         cur_daily.execute("""
             select price, last_chg_dt
             from cb_history
             where bond_id = :bond_id
-              and last_chg_dt in (select last_chg_dt
-                                  from (SELECT DISTINCT last_chg_dt
-                                        from cb_history
-                                        where bond_id = :bond_id
-                                          and last_chg_dt < date()
-                                        order by last_chg_dt desc
-                                        limit 5)
-                                  limit 1)                                                            
-                            """, {"bond_id": bond_id})
+              and last_chg_dt >= :pre_day
+              and last_chg_dt < date()
+            order by last_chg_dt
+            limit 1                                                            
+                            """, {"bond_id": bond_id, "pre_day": pre_day})
+        row = cur_daily.fetchone()
+        if row is not None:
+            return row
+        # 停牌超过5个交易日的, 这几天都没有数据, 取之前最近的一条
+        cur_daily.execute("""
+            select price, last_chg_dt
+            from cb_history
+            where bond_id = :bond_id
+              and last_chg_dt < :pre_day
+            order by last_chg_dt desc
+            limit 1
+                            """, {"bond_id": bond_id, "pre_day": pre_day})
         return cur_daily.fetchone()
 
 